@@ -0,0 +1,93 @@
+import threading
+from collections import defaultdict
+from appname.error import InvalidUsage
+from appname import metrics
+
+
+class Admission(object):
+    """Per worker in-flight counters with a concurrency budget per cost class.
+
+    Classes without a budget are never rejected, so cheap endpoints keep
+    their threads while heavy classes are shed.
+    """
+    def __init__(self, budgets=None, retry_after=1):
+        self.budgets = dict(budgets or {})
+        self.retry_after = retry_after
+        self.in_flight = defaultdict(int)
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def configure(self, budgets=None, retry_after=None):
+        if budgets is not None:
+            self.budgets = dict(budgets)
+        if retry_after is not None:
+            self.retry_after = retry_after
+
+    def enter(self, cost_class):
+        budget = self.budgets.get(cost_class)
+        with self._lock:
+            if budget is not None and self.in_flight[cost_class] >= budget:
+                self.rejected[cost_class] += 1
+                return False
+            self.in_flight[cost_class] += 1
+            self.admitted[cost_class] += 1
+            return True
+
+    def leave(self, cost_class):
+        with self._lock:
+            self.in_flight[cost_class] -= 1
+
+    def stats(self):
+        classes = set(self.budgets) | set(self.admitted) | set(self.rejected)
+        return {
+            name: dict(
+                budget=self.budgets.get(name),
+                in_flight=self.in_flight[name],
+                admitted=self.admitted[name],
+                rejected=self.rejected[name])
+            for name in classes
+        }
+
+
+admission = Admission()
+metrics.register('admission', admission.stats)
+
+
+def admit(cost_class):
+    """rejects with 503 + Retry-After once cost_class is over its budget"""
+    def decorator(func):
+        def new_func(*args, **kwargs):
+            if not admission.enter(cost_class):
+                raise InvalidUsage(
+                    'Server is busy. Try again.', 503,
+                    headers={'Retry-After': str(admission.retry_after)})
+            try:
+                return func(*args, **kwargs)
+            finally:
+                admission.leave(cost_class)
+
+        new_func._original = func
+        new_func.__name__ = func.__name__
+        return new_func
+    return decorator
+
+
+def cost_class(name, methods=None):
+    """Tags a Resource with a cost class, for all or only the given methods.
+
+    The check is added to method_decorators last, so it runs before
+    check_auth or any other work of the resource.
+    """
+    def decorator(cls):
+        admit_method = admit(name)
+
+        def method_decorator(func):
+            if methods is None or func.__name__ in methods:
+                return admit_method(func)
+            return func
+
+        cls.cost_class = name
+        cls.method_decorators = list(cls.method_decorators) + [method_decorator]
+        return cls
+    return decorator
@@ -7,12 +7,13 @@ from flask_restful_swagger_2 import Api
 from flask_swagger_ui import get_swaggerui_blueprint
 from flask_cors import CORS
 from mongoengine import connect
-from appname import auth, error, config, \
+from appname import auth, error, config, metrics, commands, admission, outbox, report, httpclient, social, breaker, upload, variants, \
         kakao, facebook, apitools, example-aws-s3, example-aws-ses, example-aws-iot
 import os
 from flask_restful.reqparse import Argument
 
 app = Flask(__name__)
+app.request_class = upload.SpooledRequest
 # cors ploblem
 cors = CORS(app, supports_credentials=True)
 api = Api(app, api_version='0.1', api_spec_url='/api/swagger')
@@ -41,6 +42,75 @@ else:
         host=app.config['MONGO_HOST'],
         port=app.config['MONGO_PORT'])
 
+# set caches
+auth.token_cache.configure(
+    maxsize=app.config['AUTH_TOKEN_CACHE_SIZE'],
+    ttl=app.config['AUTH_TOKEN_CACHE_TTL'])
+auth.password_pool.configure(
+    workers=app.config['PASSWORD_POOL_WORKERS'],
+    max_queue=app.config['PASSWORD_POOL_MAX_QUEUE'],
+    timeout=app.config['PASSWORD_POOL_TIMEOUT'],
+    rounds=app.config['BCRYPT_ROUNDS'],
+    rehash_queue=app.config['PASSWORD_REHASH_QUEUE'],
+    background=app.config['PASSWORD_REHASH_BACKGROUND'])
+auth.email_filter.configure(
+    capacity=app.config['EMAIL_FILTER_CAPACITY'],
+    error_rate=app.config['EMAIL_FILTER_ERROR_RATE'],
+    sync_interval=app.config['EMAIL_FILTER_SYNC_INTERVAL'],
+    rebuild_interval=app.config['EMAIL_FILTER_REBUILD_INTERVAL'],
+    sync_overlap=app.config['EMAIL_FILTER_SYNC_OVERLAP'],
+    lazy=app.config['EMAIL_FILTER_ENABLED'] and app.config['EMAIL_FILTER_LAZY'])
+if app.config['EMAIL_FILTER_ENABLED'] and not app.config['EMAIL_FILTER_LAZY']:
+    auth.email_filter.start()
+breaker.configure(
+    overrides=app.config['BREAKERS'],
+    window=app.config['BREAKER_WINDOW'],
+    min_calls=app.config['BREAKER_MIN_CALLS'],
+    error_rate=app.config['BREAKER_ERROR_RATE'],
+    slow_call=app.config['BREAKER_SLOW_CALL'],
+    open_for=app.config['BREAKER_OPEN_FOR'],
+    probes=app.config['BREAKER_PROBES'])
+variants.variant_pipeline.configure(
+    specs=app.config['IMAGE_VARIANTS'],
+    workers=app.config['IMAGE_VARIANT_WORKERS'],
+    background=app.config['IMAGE_VARIANTS_BACKGROUND'],
+    timeout=app.config['IMAGE_VARIANT_TIMEOUT'],
+    lease=app.config['IMAGE_VARIANT_LEASE'],
+    bucket=app.config['ATTACHMENT_S3_BUCKET'])
+httpclient.http_client.configure(
+    pool_size=app.config['HTTP_POOL_SIZE'],
+    connect_timeout=app.config['HTTP_CONNECT_TIMEOUT'],
+    read_timeout=app.config['HTTP_READ_TIMEOUT'],
+    retries=app.config['HTTP_RETRIES'],
+    backoff=app.config['HTTP_RETRY_BACKOFF'])
+social.verified_tokens.configure(
+    maxsize=app.config['SOCIAL_TOKEN_CACHE_SIZE'],
+    ttl=app.config['SOCIAL_TOKEN_CACHE_TTL'],
+    negative_ttl=app.config['SOCIAL_TOKEN_NEGATIVE_TTL'])
+admission.admission.configure(
+    budgets=app.config['ADMISSION_BUDGETS'],
+    retry_after=app.config['ADMISSION_RETRY_AFTER'])
+outbox.outbox.configure(
+    transport=outbox.make_transport(app.config),
+    batch_size=app.config['OUTBOX_BATCH_SIZE'],
+    concurrency=app.config['OUTBOX_CONCURRENCY'],
+    max_attempts=app.config['OUTBOX_MAX_ATTEMPTS'],
+    backoff_base=app.config['OUTBOX_BACKOFF_BASE'],
+    backoff_max=app.config['OUTBOX_BACKOFF_MAX'],
+    lease=app.config['OUTBOX_LEASE'],
+    poll_interval=app.config['OUTBOX_POLL_INTERVAL'])
+if app.config['OUTBOX_DISPATCHER_ENABLED']:
+    outbox.outbox.start()
+report.reporter.configure(
+    app=app,
+    to=app.config['EXCEPTION_REPORT_TO'],
+    source=app.config['EXCEPTION_REPORT_FROM'],
+    window=app.config['EXCEPTION_REPORT_WINDOW'],
+    max_fingerprints=app.config['EXCEPTION_REPORT_MAX_FINGERPRINTS'],
+    backend=app.config['EXCEPTION_REPORT_BACKEND'])
+if app.config['EXCEPTION_REPORT_ENABLED']:
+    report.reporter.start()
+
 # set swagger
 swaggerui_bp = get_swaggerui_blueprint(
     '/api/docs',
@@ -56,7 +126,38 @@ app.register_blueprint(swaggerui_bp, url_prefix='/api/docs')
 def handle_invalid_usage(err):
     response = jsonify(err.to_dict())
     response.status_code = err.status_code
+    for key, value in (err.headers or {}).items():
+        response.headers[key] = value
+    return response
+
+@app.errorhandler(413)
+def handle_too_large(err):
+    response = jsonify(dict(message='Request body is too large'))
+    response.status_code = 413
     return response
 
+# set cli commands
+app.cli.add_command(commands.calibrate_bcrypt)
+app.cli.add_command(commands.import_users)
+app.cli.add_command(commands.dispatch_outbox)
+app.cli.add_command(commands.generate_variants)
+app.cli.add_command(commands.configure_attachment_bucket)
+app.cli.add_command(commands.migrate_user_indexes)
+
+# set zappa events, lambda freezes background threads between requests
+def dispatch_outbox_event(event, context):
+    with app.app_context():
+        # digests of the windows that have ended go out with this batch
+        try:
+            report.reporter.flush(due=True)
+        except Exception:
+            app.logger.exception('exception digest flush failed')
+        while outbox.outbox.dispatch() == outbox.outbox.batch_size:
+            pass
+
+def generate_variants_event(event, context):
+    with app.app_context():
+        variants.variant_pipeline.drain(app.config['IMAGE_VARIANTS_DRAIN_BATCH'])
+
 apitools.init(app)
 apitools.add_resources(api)
@@ -1,4 +1,3 @@
-import bcrypt
 import uuid
 import datetime
 import jwt
@@ -6,17 +5,26 @@ import re
 import arrow
 import json
 import random
+import time
+import hashlib
 
 from flask import request, g, render_template
 from flask import current_app as app
 from flask_restful import Resource
-from appname.db import UserModel
+from appname.db import UserModel, SessionModel, load_user, find_user_record
 from appname.error import InvalidUsage
+from appname.cache import TTLCache
+from appname.bloom import EmailFilter
+from appname.password import password_pool
+from appname.ratelimit import rate_limit
+from appname.admission import cost_class
+from appname.outbox import outbox
+from appname import metrics
 from appname.apitools import get_args, \
     spec, ApiParam, ApiResponse, Swagger,\
     EnumConstraint, LengthConstraint
 import appname.apitools as apitools
-from mongoengine.queryset.visitor import Q
+from mongoengine import NotUniqueError
 from email_validator import validate_email
 
 
@@ -37,23 +45,64 @@ def gen_pwd():
     words[random.randint(0, 3)] = str(random.randint(0, 999))
     return "-".join(words)
 
+# verified auth token digest -> (user_id, jti)
+token_cache = TTLCache(maxsize=4096, ttl=60)
+metrics.register('auth_token_cache', token_cache.stats)
+metrics.register('password_pool', password_pool.stats)
+
+# signed up emails, answers definite "does not exist" without a query
+email_filter = EmailFilter(lambda: UserModel._get_collection())
+metrics.register('email_filter', email_filter.stats)
+
+def token_digest(token):
+    if isinstance(token, str):
+        token = token.encode()
+    return hashlib.sha256(token).hexdigest()
+
 class User(object):
-    def __init__(self, email=None, pwd=None, user_id=None, authenticated=False):
+    def __init__(self, email=None, pwd=None, user_id=None, authenticated=False,
+                 user_db=None, jti=None, fields=None):
         self.email = email
         self.pwd = pwd
+        self.user_id = user_id
+        self.jti = jti
         self.authenticated = authenticated
 
-        self.user_db = None
-        if user_id is not None:
-            try:
-                self.user_db = UserModel.objects.get(user_id=user_id)
-            except UserModel.DoesNotExist:
-                self.user_db = None
-        elif email is not None:
-            try:
-                self.user_db = UserModel.objects.get(email=email)
-            except UserModel.DoesNotExist:
-                self.user_db = None
+        # user document is loaded on first access, with only `fields`
+        self.fields = fields
+        self._user_db = user_db
+        self._loaded = user_db is not None
+        self._record = None
+
+    def load(self, fields=None):
+        """loads user_db with a named field set unless already loaded"""
+        if not self._loaded:
+            self._loaded = True
+            if self.user_id is not None:
+                self._user_db = load_user(fields, user_id=self.user_id)
+            elif self.email is not None:
+                self._user_db = load_user(fields, email=self.email)
+        return self._user_db
+
+    def record(self, fields=None):
+        """read-only view of the user, cheaper than user_db if nothing is saved"""
+        if self._loaded:
+            return self._user_db
+        if self._record is None:
+            if self.user_id is not None:
+                self._record = find_user_record(fields, user_id=self.user_id)
+            elif self.email is not None:
+                self._record = find_user_record(fields, email=self.email)
+        return self._record
+
+    @property
+    def user_db(self):
+        return self.load(self.fields)
+
+    @user_db.setter
+    def user_db(self, user_db):
+        self._user_db = user_db
+        self._loaded = True
 
     def is_user(self):
         return self.user_db and self.user_db.email == self.email
@@ -61,16 +110,12 @@ class User(object):
     def check_pwd(self, pwd):
         if not self.user_db.password:
             return False
-        return bcrypt.checkpw(
-                pwd.encode('utf-8'),
-                self.user_db.password.encode('utf-8'))
+        return password_pool.check(pwd, self.user_db.password)
 
     def check_tmp_pwd(self, pwd):
         if not self.user_db.tmp_password:
             return False
-        return bcrypt.checkpw(
-                pwd.encode('utf-8'),
-                self.user_db.tmp_password.encode('utf-8'))
+        return password_pool.check(pwd, self.user_db.tmp_password)
 
     def is_expired_tmp_pwd(self):
         valid_period = self.user_db.tmp_password_valid_period
@@ -82,50 +127,77 @@ class User(object):
     def is_authenticated(self):
         return self.authenticated
 
-    def generate_auth_token(self):
-        exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=0, hours=6)
-        iat_time = datetime.datetime.utcnow()
-        payload = {
-            'exp': exp_time,
-            'iat': iat_time,
-            'sub': self.user_db.user_id
-        }
-        refresh_payload = {
-            'iat': iat_time,
-            'sub': self.user_db.user_id
-        }
-        auth_token = jwt.encode(
-            payload,
-            app.config['SECRET_KEY'],
-            algorithm='HS512'
-        ).decode()
-        refresh_token = jwt.encode(
-            refresh_payload,
-            app.config['SECRET_KEY'],
-            algorithm='HS256'
-        ).decode()
-        self.user_db.update(set__auth_token=auth_token, set__refresh_token=refresh_token)
-        self.user_db.reload()
-        return auth_token, refresh_token, str(arrow.get(exp_time))
+    def generate_auth_token(self, device=None):
+        """opens a new session, other devices stay logged in"""
+        auth_token, refresh_token, exp_time, jti = issue_tokens(self.user_db.user_id)
+        SessionModel(
+            jti=jti,
+            refresh_hash=token_digest(refresh_token),
+            user_id=self.user_db.user_id,
+            device=device,
+            expire_at=session_expire_at()
+        ).save(force_insert=True)
+        self.jti = jti
+        return auth_token, refresh_token, exp_time
+
+def session_expire_at():
+    return datetime.datetime.utcnow() + app.config['SESSION_EXPIRE_DURATION']
+
+def issue_tokens(user_id):
+    exp_time = datetime.datetime.utcnow() + datetime.timedelta(days=0, hours=6)
+    iat_time = datetime.datetime.utcnow()
+    jti = uuid.uuid4().hex
+    payload = {
+        'exp': exp_time,
+        'iat': iat_time,
+        'sub': user_id,
+        'jti': jti
+    }
+    refresh_payload = {
+        'iat': iat_time,
+        'sub': user_id,
+        'jti': jti
+    }
+    auth_token = jwt.encode(
+        payload,
+        app.config['SECRET_KEY'],
+        algorithm='HS512'
+    ).decode()
+    refresh_token = jwt.encode(
+        refresh_payload,
+        app.config['SECRET_KEY'],
+        algorithm='HS256'
+    ).decode()
+    return auth_token, refresh_token, str(arrow.get(exp_time)), jti
 
 def check_auth(func):
     def new_func(*args, **kwargs):
         auth_token = request.headers.get('authorization')
         if auth_token:
             auth_token = auth_token.encode()
+            key = token_digest(auth_token)
+            identity = token_cache.get(key)
+            if identity is not None:
+                user_id, jti = identity
+                g.user = User(user_id=user_id, jti=jti, authenticated=True)
+                return func(*args, **kwargs)
+
             try:
-                user_id = jwt.decode(auth_token, app.config['SECRET_KEY'], algorithms='HS512')['sub']
+                payload = jwt.decode(auth_token, app.config['SECRET_KEY'], algorithms='HS512')
+                user_id = payload['sub']
+                jti = payload['jti']
             except jwt.ExpiredSignatureError:
                 raise InvalidUsage('Auth Token was expired. Try Again for refresh token.', status_code=401)
             except Exception:
                 raise InvalidUsage('Auth Token is invalid.', status_code=401)
-            try:
-                user_db = UserModel.objects.get(user_id=user_id)
-            except UserModel.DoesNotExist:
-                raise InvalidUsage('This user does not exist.', status_code=401)
 
-            if user_db.auth_token and auth_token == user_db.auth_token.encode():
-                g.user = User(user_db.email, authenticated=True)
+            session = SessionModel._get_collection().find_one(
+                {'jti': jti, 'expire_at': {'$gt': datetime.datetime.utcnow()}},
+                {'_id': 0, 'user_id': 1})
+            if session is not None and session['user_id'] == user_id:
+                # never serve a token from cache past its own expiry
+                token_cache.set(key, (user_id, jti), ttl=payload['exp'] - time.time())
+                g.user = User(user_id=user_id, jti=jti, authenticated=True)
                 return func(*args, **kwargs)
             else:
                 raise InvalidUsage('Auth Token is invalid. Try Again.', status_code=401)
@@ -138,24 +210,25 @@ def check_auth(func):
 
 
 def hash_pwd(pwd):
-    return bcrypt.hashpw(pwd.encode('utf-8'), bcrypt.gensalt()).decode()
-
-def signup(user_info, random_pw=False, validate_pw=True, kakao_id=None, facebook_id=None):
-    email = user_info.get('email').lower()
+    return password_pool.hash(pwd)
+
+def rehash_pwd_later(user_id, old_hash, pwd):
+    def save(new_hash):
+        # skip if the password was changed in the meantime
+        UserModel.objects(user_id=user_id, password=old_hash) \
+            .update(set__password=new_hash)
+    return password_pool.rehash_later(pwd, save)
+
+def validate_signup(user_info, random_pw=False, validate_pw=True):
+    """checks signup input, returns (user fields, plain password)"""
+    email = user_info.get('email')
     pwd = user_info.get('pwd')
-    name = user_info.get('name')
-    birthday = user_info.get('birthday')
-    gender = user_info.get('gender')
-
-    place = user_info.get('place')
-    space = user_info.get('space')
-    purpose = user_info.get('purpose')
-
-    prefer_scents = user_info.get('prefer_scents')
-
 
     if email is None:
         raise InvalidUsage("Email is required", status_code=400)
+    if not isinstance(email, str):
+        raise InvalidUsage("Email is not valid", status_code=400)
+    email = email.lower()
 
     try:
         validate_email(email, check_deliverability=False)
@@ -168,6 +241,12 @@ def signup(user_info, random_pw=False, validate_pw=True, kakao_id=None, facebook
             pwd = str(uuid.uuid4())
         else:
             raise InvalidUsage("Password is requied", status_code=400)
+    if not isinstance(pwd, str):
+        raise InvalidUsage("Password is not valid", status_code=400)
+
+    prefer_scents = user_info.get('prefer_scents')
+    if prefer_scents is not None and not isinstance(prefer_scents, list):
+        raise InvalidUsage("prefer_scents is not a list", status_code=400)
 
     if validate_pw:
         pattern = r"^(?=.*[A-Za-z])(?=.*\d)(?=.*[`\-=\\\[\];',\./~!@#$%^&*\(\)_\+|\{\}:\"<>\?])" \
@@ -175,31 +254,56 @@ def signup(user_info, random_pw=False, validate_pw=True, kakao_id=None, facebook
         if not re.match(pattern, pwd):
             raise InvalidUsage("Password is not secure one", status_code=400)
 
-    if UserModel.objects(Q(email=email)).first() is not None:
-        err = email + ' already exists.'
-        raise InvalidUsage(err, status_code=403)
+    fields = dict(
+        email=email,
+        name=user_info.get('name'),
+        birthday=user_info.get('birthday'),
+        gender=user_info.get('gender'),
+        place=user_info.get('place'),
+        space=user_info.get('space'),
+        purpose=user_info.get('purpose'),
+        prefer_scents=prefer_scents)
+    return fields, pwd
+
+def duplicate_fields(ex):
+    """fields of the unique index a NotUniqueError of UserModel ran into"""
+    # mongoengine raises it while handling pymongo's DuplicateKeyError
+    details = getattr(ex.__cause__ or ex.__context__, 'details', None) or {}
+    if 'keyPattern' in details:
+        return set(details['keyPattern'])
+    # servers before 4.2 only name the index, the duplicate value follows it
+    match = re.search(r'index: (?:\S+\$)?(\S+) dup key', details.get('errmsg', ''))
+    if match is None:
+        return set()
+    indexes = UserModel._get_collection().index_information()
+    return set(field for field, _ in indexes.get(match.group(1), {}).get('key', []))
 
-    UserModel(
+def signup(user_info, random_pw=False, validate_pw=True, kakao_id=None, facebook_id=None):
+    fields, pwd = validate_signup(user_info, random_pw, validate_pw)
+    email = fields['email']
+
+    user = UserModel(
         user_id=str(uuid.uuid4()),
         kakao_id=kakao_id,
         facebook_id=facebook_id,
-        email=email,
         password=hash_pwd(pwd),
-        name=name,
-        birthday=birthday,
-        gender=gender,
-        place=place,
-        space=space,
-        purpose=purpose,
-        prefer_scents=prefer_scents
-    ).save()
-
+        **fields
+    )
 
+    # the unique indexes decide duplicates, no check-then-insert race
     try:
-        user = UserModel.objects.get(email=email)
-    except UserModel.DoesNotExist:
-        err = email + ' signup failed. Try again.'
-        raise InvalidUsage(err, status_code=500)
+        user.save(force_insert=True)
+    except NotUniqueError as ex:
+        fields = duplicate_fields(ex)
+        if 'kakao_id' in fields:
+            raise InvalidUsage("Already existing kakao user", 403)
+        if 'facebook_id' in fields:
+            raise InvalidUsage("Already existing facebook user", 403)
+        err = email + ' already exists.'
+        raise InvalidUsage(err, status_code=403)
+
+    email_filter.add(email)
+    return user
 
 
 
@@ -209,7 +313,8 @@ signup_responses = [
     ApiResponse.error(400, "Email is required"),
     ApiResponse.error(400, "Password is not secure one"),
     ApiResponse.error(403, "abc1@abcmart.com already exists"),
-    ApiResponse.error(403, "Email is not valid")
+    ApiResponse.error(403, "Email is not valid"),
+    ApiResponse.error(503, "Server is busy. Try again.")
 ]
 
 response_example = dict(
@@ -222,6 +327,7 @@ response_example = dict(
     devices={'Device ID': 'Device Name'}
 )
 
+@cost_class('bcrypt', methods=['put'])
 class UserInfo(Resource):
     @spec('/auth/user_info', 'Get User Info',
         header_params=[*Swagger.Params.Authorization],
@@ -246,9 +352,8 @@ class UserInfo(Resource):
     def get(self):
         args = get_args()
         if args.get('user_id', None):
-            try:
-                user_db = UserModel.objects.get(user_id=args.get('user_id'))
-            except UserModel.doesNotExist:
+            user_db = find_user_record('public', user_id=args.get('user_id'))
+            if user_db is None:
                 raise InvalidUsage('User does not exist.', status_code=404)
 
             return dict(
@@ -257,7 +362,7 @@ class UserInfo(Resource):
                     picture=user_db.picture
                 ))
         else:
-            user = g.user.user_db
+            user = g.user.record('profile')
             return dict(user_info=user.marshall())
 
     @spec('/auth/user_info', 'Update User Info',
@@ -294,7 +399,7 @@ class UserInfo(Resource):
     @check_auth
     def put(self):
         args = get_args()
-        user = g.user.user_db
+        user = g.user.load('profile')
 
         if args.get('pwd', None):
             user.password = hash_pwd(args.get('pwd'))
@@ -312,6 +417,7 @@ class UserInfo(Resource):
         return dict(user_info=user.marshall())
 
 
+@cost_class('bcrypt')
 class Signup(Resource):
     @spec('/auth/signup', 'New User Signup',
         body_params=[
@@ -354,6 +460,7 @@ class Signup(Resource):
 
         return dict(result=True)
 
+@cost_class('bcrypt')
 class Login(Resource):
     @spec('/auth/login', 'User Login',
         body_params=[
@@ -363,6 +470,7 @@ class Login(Resource):
             ApiParam('pwd',
                 'user password', required=True,
                 constraints=[LengthConstraint(4)]),
+            ApiParam('device', 'client device name for the session'),
         ],
         responses=[
             ApiResponse(200, 'Login Succeed', token_example),
@@ -372,30 +480,39 @@ class Login(Resource):
             ApiResponse(400, 'User Login Fail because email/pwd invalid',
                 {'message': 'Password is invalid.'}
             ),
-            ApiResponse.error(406, 'Expired Temporary Password')
+            ApiResponse.error(406, 'Expired Temporary Password'),
+            ApiResponse.error(429, 'Too many requests. Try again later.'),
+            ApiResponse.error(503, 'Server is busy. Try again.')
         ]
     )
+    @rate_limit('login', 10, per=60)
     def post(self):
         args = get_args()
         email = args['email'].lower()
         pwd = args['pwd']
 
-        user = User(email, pwd=pwd)
+        user = User(email, pwd=pwd, fields='login')
 
         if not user.is_user():
             err = email + ' is not signed up user.'
             raise InvalidUsage(err, status_code=403)
 
-        is_tmp_pwd = user.check_tmp_pwd(pwd)
-        if not user.check_pwd(pwd) and not is_tmp_pwd:
-            err = 'Password is invalid.'
-            raise InvalidUsage(err, status_code=400)
+        # the real password settles most logins with a single bcrypt call
+        is_tmp_pwd = False
+        if not user.check_pwd(pwd):
+            is_tmp_pwd = user.check_tmp_pwd(pwd)
+            if not is_tmp_pwd:
+                err = 'Password is invalid.'
+                raise InvalidUsage(err, status_code=400)
         
         if is_tmp_pwd and user.is_expired_tmp_pwd():
             err = 'Expired Temporary Password'
             raise InvalidUsage(err, status_code=406)
 
-        auth_token, refresh_token, exp_time = user.generate_auth_token()
+        if not is_tmp_pwd and password_pool.needs_rehash(user.user_db.password):
+            rehash_pwd_later(user.user_db.user_id, user.user_db.password, pwd)
+
+        auth_token, refresh_token, exp_time = user.generate_auth_token(args.get('device'))
         user.authenticated = True
 
         result = {
@@ -423,11 +540,8 @@ class Logout(Resource):
     )
     @check_auth
     def post(self):
-        g.user.user_db.update(unset__auth_token=1)
-        if g.user.user_db.access_token:
-            g.user.user_db.update(unset__access_token=1)
-        g.user.user_db.reload()
-        if g.user.user_db.auth_token or g.user.user_db.access_token:
+        token_cache.pop(token_digest(request.headers.get('authorization')))
+        if not SessionModel.objects(jti=g.user.jti).delete():
             raise InvalidUsage('Token does not deleted. Try Again.', status_code=500)
         g.user.authenticated = False
 
@@ -455,28 +569,35 @@ class RefreshAuthToken(Resource):
             auth_token = auth_token.encode()
             refresh_token = refresh_token.encode()
             try:
-                user_id = jwt.decode(auth_token,
+                payload = jwt.decode(auth_token,
                                      app.config['SECRET_KEY'],
                                      algorithms='HS512',
                                      options=dict(verify_exp=False)
-                                     )['sub']
-            except jwt.InvalidTokenError:
+                                     )
+                user_id = payload['sub']
+                jti = payload['jti']
+            except (jwt.InvalidTokenError, KeyError):
                 raise InvalidUsage('Auth Token is invalid.', status_code=401)
 
-            try:
-                user_db = UserModel.objects.get(user_id=user_id)
-            except UserModel.DoesNotExist:
-                raise InvalidUsage('This user does not exist.', status_code=401)
-
-            if refresh_token == user_db.refresh_token.encode():
-                user = User(user_db.email, user_id=user_id)
-                auth_token, refresh_token, exp_time = user.generate_auth_token()
-                return {'auth_token': auth_token, 'refresh_token': refresh_token, 'exp_time': exp_time}
-            else:
+            # rotate both tokens only if the refresh token still matches
+            new_auth_token, new_refresh_token, exp_time, new_jti = issue_tokens(user_id)
+            session = SessionModel.objects(
+                jti=jti,
+                user_id=user_id,
+                refresh_hash=token_digest(refresh_token)).modify(
+                    new=True,
+                    set__jti=new_jti,
+                    set__refresh_hash=token_digest(new_refresh_token),
+                    set__expire_at=session_expire_at())
+            if session is None:
                 raise InvalidUsage('Refresh Token is invalid.', status_code=401)
+
+            token_cache.pop(token_digest(auth_token))
+            return {'auth_token': new_auth_token, 'refresh_token': new_refresh_token, 'exp_time': exp_time}
         else:
             raise InvalidUsage('Token is not found.', status_code=401)
 
+@cost_class('bcrypt')
 class ResetPassword(Resource):
     @spec(
         '/auth/reset_password',
@@ -487,12 +608,13 @@ class ResetPassword(Resource):
         responses=[
             ApiResponse(200, 'Email sent', dict(result=True)),
             ApiResponse.error(404, 'User not found'),
-            ApiResponse.error(500, 'Email Server Error')
+            ApiResponse.error(429, 'Too many requests. Try again later.')
         ]
     )
+    @rate_limit('reset_password', 3, per=600)
     def post(self):
         args = get_args()
-        user_model = UserModel.objects(email=args['email']).first()
+        user_model = load_user('reset', email=args['email'])
         if user_model is None:
             raise InvalidUsage('User not found', 404)
 
@@ -503,29 +625,21 @@ class ResetPassword(Resource):
             name=user_model.name,
             password=tmp_password)
 
-        try:
-            charset = 'UTF-8'
-            response = apitools.email_client.send_email(
-                Destination={
-                    'ToAddresses': [
-                        user_model.email
-                    ]
-                },
-                Message=dict(
-                    Subject=dict(
-                        Data="[아롬] 임시 비밀번호 발급",
-                        Charset='utf8'),
-                    Body=dict(Html=dict(Charset='utf8', Data=str(body)))
-                ),
-                Source=app.config['CONTACT_EMAIL'])
-        except Exception as ex:
-            raise InvalidUsage("Email Server Error: {}".format(ex), 500)
-
         user_model.tmp_password = hash_pwd(tmp_password)
         user_model.tmp_password_valid_period = datetime.datetime.now() + \
                 app.config['PASSWORD_RESET_EXPIRE_DURATION']
         user_model.save()
-        
+
+        # delivered by the outbox dispatcher, SES errors are retried there
+        # until the temporary password expires
+        outbox.enqueue(
+            to=[user_model.email],
+            subject="[아롬] 임시 비밀번호 발급",
+            html=body,
+            source=app.config['CONTACT_EMAIL'],
+            deadline=datetime.datetime.utcnow() +
+                app.config['PASSWORD_RESET_EXPIRE_DURATION'])
+
         return dict(result=True)
 
 class UserExists(Resource):
@@ -541,8 +655,13 @@ class UserExists(Resource):
     )
     def get(self):
         args = get_args()
-        user_model = UserModel.objects(email=args['email'].lower()).first()
+        email = args['email'].lower()
+        if not email_filter.might_contain(email):
+            return dict(exists=False)
+
+        user_model = find_user_record('exists', email=email)
         if user_model is None:
+            email_filter.record_false_positive()
             return dict(exists=False)
 
         return dict(exists=True)
@@ -0,0 +1,203 @@
+import datetime
+import hashlib
+import logging
+import math
+import threading
+import time
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """Fixed size bloom filter over strings, no false negatives."""
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def estimated_fp_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class EmailFilter(object):
+    """Bloom filter of every signed up email, kept in sync in the background.
+
+    Every sync_interval the users whose _id was generated since the last
+    sync, minus sync_overlap seconds, are scanned again. _ids come from
+    the clocks of other workers and lambda containers and are not
+    inserted in order, the overlap covers their skew and insert latency.
+    A full rebuild every rebuild_interval drops deleted users. Until a
+    build succeeds every email is a maybe and goes to the database, a
+    failed build is retried every sync_interval. A lazy filter is first
+    built when it is asked, so workers that never are skip the scan.
+    """
+    def __init__(self, collection_getter, capacity=1000000, error_rate=0.01,
+                 sync_interval=30, rebuild_interval=3600, sync_overlap=300,
+                 timer=time.monotonic, clock=datetime.datetime.utcnow, lazy=False):
+        self.collection_getter = collection_getter
+        self.lazy = lazy
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.sync_overlap = sync_overlap
+        self.timer = timer
+        self.clock = clock
+
+        self.negatives = 0
+        self.maybes = 0
+        self.false_positives = 0
+
+        self._filter = None
+        # utc wall clock the next sync scans from
+        self._sync_from = None
+        self._synced_at = 0
+        self._built_at = 0
+        self._build_started_at = None
+        self._pending = None
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def configure(self, capacity=None, error_rate=None,
+                  sync_interval=None, rebuild_interval=None, sync_overlap=None,
+                  lazy=None):
+        if lazy is not None:
+            self.lazy = lazy
+        if capacity is not None:
+            self.capacity = capacity
+        if error_rate is not None:
+            self.error_rate = error_rate
+        if sync_interval is not None:
+            self.sync_interval = sync_interval
+        if rebuild_interval is not None:
+            self.rebuild_interval = rebuild_interval
+        if sync_overlap is not None:
+            self.sync_overlap = sync_overlap
+
+    @staticmethod
+    def normalize(email):
+        return email.strip().lower()
+
+    def start(self):
+        self._run(self.rebuild)
+
+    def _run(self, target):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(
+                target=self._logged, args=(target,), daemon=True)
+            self._worker.start()
+
+    @staticmethod
+    def _logged(target):
+        try:
+            target()
+        except Exception:
+            logger.exception('email filter %s failed', target.__name__)
+
+    def _scan(self, bloom, query):
+        collection = self.collection_getter()
+        cursor = collection.find(query, {'email': 1}).batch_size(1000)
+        for doc in cursor:
+            email = self.normalize(doc.get('email') or '')
+            # overlapping syncs see the same users again, counted once
+            if email and email not in bloom:
+                bloom.add(email)
+
+    def _since(self, started):
+        return started - datetime.timedelta(seconds=self.sync_overlap)
+
+    def rebuild(self):
+        self._build_started_at = self.timer()
+        started = self.clock()
+        count = self.collection_getter().count()
+        bloom = BloomFilter(max(self.capacity, count * 2), self.error_rate)
+        # signups during the scan land in both filters
+        self._pending = bloom
+        try:
+            self._scan(bloom, {})
+            with self._lock:
+                self._filter = bloom
+                self._sync_from = self._since(started)
+                self._built_at = self._synced_at = self.timer()
+        finally:
+            self._pending = None
+
+    def sync(self):
+        bloom = self._filter
+        if bloom is None:
+            return
+        started = self.clock()
+        self._scan(bloom, {'_id': {'$gte': ObjectId.from_datetime(self._sync_from)}})
+        with self._lock:
+            self._sync_from = self._since(started)
+            self._synced_at = self.timer()
+
+    def maybe_refresh(self):
+        now = self.timer()
+        if self._filter is None:
+            if self._build_started_at is None:
+                if self.lazy:
+                    self._run(self.rebuild)
+            # the first build failed, answers come from mongo until one succeeds
+            elif now - self._build_started_at >= self.sync_interval:
+                self._run(self.rebuild)
+            return
+        if now - self._built_at >= self.rebuild_interval:
+            self._run(self.rebuild)
+        elif now - self._synced_at >= self.sync_interval:
+            self._run(self.sync)
+
+    def add(self, email):
+        email = self.normalize(email)
+        for bloom in (self._filter, self._pending):
+            if bloom is not None:
+                bloom.add(email)
+
+    def might_contain(self, email):
+        """False only for emails that are surely not signed up"""
+        self.maybe_refresh()
+        bloom = self._filter
+        if bloom is not None and self.normalize(email) not in bloom:
+            self.negatives += 1
+            return False
+        self.maybes += 1
+        return True
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def stats(self):
+        bloom = self._filter
+        # of the emails that are not signed up, how many were let through
+        absent = self.false_positives + self.negatives
+        return dict(
+            ready=bloom is not None,
+            count=bloom.count if bloom else 0,
+            capacity=bloom.capacity if bloom else 0,
+            estimated_fp_rate=bloom.estimated_fp_rate() if bloom else None,
+            observed_fp_rate=self.false_positives / absent if absent else 0.0,
+            negatives=self.negatives,
+            maybes=self.maybes,
+            false_positives=self.false_positives)
@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import deque
+from appname.error import InvalidUsage
+from appname import metrics
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def is_failure(ex):
+    """whether an exception says the dependency is unhealthy, not the request"""
+    if isinstance(ex, InvalidUsage):
+        return ex.status_code >= 500
+    # botocore ClientError, e.g. a missing thing shadow is a healthy 404
+    response = getattr(ex, 'response', None)
+    if isinstance(response, dict):
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+        return status >= 500 or status == 429
+    return True
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while a dependency is unhealthy.
+
+    Outcomes of the last `window` seconds are kept; a call slower than
+    slow_call counts as a failure. Once at least min_calls were made and
+    the failure rate reaches error_rate, the circuit opens and every call
+    gets 503 for open_for seconds. Then up to `probes` calls are let
+    through: if they all succeed the circuit closes, any failure opens it
+    again.
+    """
+    def __init__(self, name, window=30, min_calls=10, error_rate=0.5,
+                 slow_call=None, open_for=30, probes=3, timer=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.probes = probes
+        self.timer = timer
+
+        self.state = CLOSED
+        self.rejected = 0
+        self.opened = 0
+        self._calls = deque(maxlen=1000)
+        self._opened_at = 0
+        self._probing = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, window=None, min_calls=None, error_rate=None,
+                  slow_call=None, open_for=None, probes=None):
+        if window is not None:
+            self.window = window
+        if min_calls is not None:
+            self.min_calls = min_calls
+        if error_rate is not None:
+            self.error_rate = error_rate
+        if slow_call is not None:
+            self.slow_call = slow_call
+        if open_for is not None:
+            self.open_for = open_for
+        if probes is not None:
+            self.probes = probes
+
+    def reset(self):
+        with self._lock:
+            self.state = CLOSED
+            self._calls.clear()
+            self._probing = 0
+            self._probe_successes = 0
+
+    def _prune(self, now):
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def _open(self, now):
+        self.state = OPEN
+        self._opened_at = now
+        self._probing = 0
+        self._probe_successes = 0
+        self.opened += 1
+
+    def before(self):
+        """admits a call, raises 503 while the circuit is open"""
+        now = self.timer()
+        with self._lock:
+            if self.state == OPEN and now - self._opened_at >= self.open_for:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return
+            self.rejected += 1
+            retry_after = max(1, int(self._opened_at + self.open_for - now))
+        raise InvalidUsage(
+            '{} is unavailable. Try again later.'.format(self.name), 503,
+            headers={'Retry-After': str(retry_after)})
+
+    def after(self, started, failed):
+        now = self.timer()
+        failed = failed or (self.slow_call is not None and now - started > self.slow_call)
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self.state = CLOSED
+                        self._calls.clear()
+                return
+            if self.state == OPEN:
+                return
+
+            self._calls.append((now, failed, now - started))
+            self._prune(now)
+            failures = sum(1 for _, f, _ in self._calls if f)
+            if len(self._calls) >= self.min_calls and \
+                    failures >= self.error_rate * len(self._calls):
+                self._open(now)
+
+    def call(self, func, *args, **kwargs):
+        self.before()
+        started = self.timer()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as ex:
+            self.after(started, is_failure(ex))
+            raise
+        self.after(started, False)
+        return result
+
+    def stats(self):
+        with self._lock:
+            self._prune(self.timer())
+            calls = list(self._calls)
+        latencies = sorted(latency for _, _, latency in calls)
+        failures = sum(1 for _, failed, _ in calls if failed)
+        return dict(
+            state=self.state,
+            calls=len(calls),
+            failure_rate=failures / len(calls) if calls else 0.0,
+            p50_ms=latencies[len(latencies) // 2] * 1000 if latencies else None,
+            p99_ms=latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+            rejected=self.rejected,
+            opened=self.opened)
+
+
+class GuardedClient(object):
+    """Proxies a boto3 client, every method call goes through the breaker"""
+    def __init__(self, client, breaker):
+        self._client = client
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def guarded(*args, **kwargs):
+            return self._breaker.call(attr, *args, **kwargs)
+        guarded.__name__ = name
+        return guarded
+
+
+breakers = {}
+_settings = dict(defaults={}, overrides={})
+
+
+def _settings_for(name):
+    return dict(_settings['defaults'], **_settings['overrides'].get(name, {}))
+
+
+def get_breaker(name):
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(name, **_settings_for(name))
+    return breakers[name]
+
+
+def configure(overrides=None, **defaults):
+    """settings for every breaker, overrides maps a breaker name to its own"""
+    _settings['defaults'].update({k: v for k, v in defaults.items() if v is not None})
+    if overrides is not None:
+        _settings['overrides'] = overrides
+    for name, breaker in breakers.items():
+        breaker.configure(**_settings_for(name))
+
+
+def guard(client, name):
+    return GuardedClient(client, get_breaker(name))
+
+
+metrics.register('circuit_breakers', lambda: {
+    name: breaker.stats() for name, breaker in list(breakers.items())})
@@ -0,0 +1,274 @@
+import csv
+import json
+import math
+import os
+import time
+import uuid
+import boto3
+import click
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from flask import current_app as app
+from flask.cli import with_appcontext
+from botocore.exceptions import ClientError
+from pymongo.errors import BulkWriteError
+from mongoengine import ValidationError, Q
+from mongoengine.connection import get_db
+from appname.db import UserModel, ImageAttachmentModel
+from appname.error import InvalidUsage
+from appname.auth import validate_signup
+from appname.password import _hashpw, _checkpw
+from appname.outbox import outbox
+from appname.variants import variant_pipeline
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+@click.command('calibrate_bcrypt')
+@click.option('--min-cost', default=8, help='lowest bcrypt cost to measure')
+@click.option('--max-cost', default=14, help='highest bcrypt cost to measure')
+@click.option('--samples', default=20, help='verifications per cost')
+@click.option('--budget', type=float, default=None,
+              help='seconds per verification, defaults to PASSWORD_HASH_BUDGET')
+@with_appcontext
+def calibrate_bcrypt(min_cost, max_cost, samples, budget):
+    """Measure bcrypt time per cost on this machine."""
+    if budget is None:
+        budget = app.config['PASSWORD_HASH_BUDGET']
+
+    click.echo('{:>5} {:>10} {:>10} {:>10}'.format('cost', 'p50(ms)', 'p99(ms)', 'max(ms)'))
+    chosen = None
+    for cost in range(min_cost, max_cost + 1):
+        hashed = _hashpw('calibrate-password', cost)
+        timings = []
+        for _ in range(samples):
+            started = time.perf_counter()
+            _checkpw('calibrate-password', hashed)
+            timings.append(time.perf_counter() - started)
+
+        p99 = percentile(timings, 99)
+        click.echo('{:>5} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+            cost,
+            percentile(timings, 50) * 1000,
+            p99 * 1000,
+            max(timings) * 1000))
+
+        if p99 <= budget:
+            chosen = cost
+        else:
+            # every higher cost doubles the time
+            break
+
+    click.echo('current BCRYPT_ROUNDS: {}'.format(app.config['BCRYPT_ROUNDS']))
+    if chosen is None:
+        click.echo('no cost fits in {:.0f}ms'.format(budget * 1000))
+    else:
+        click.echo('recommended BCRYPT_ROUNDS: {} (p99 within {:.0f}ms)'.format(
+            chosen, budget * 1000))
+
+
+def read_records(stream, fmt, failures):
+    """yields (line number, record dict) without reading the whole file"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            record = {k: v for k, v in record.items() if v not in (None, '')}
+            if 'prefer_scents' in record:
+                record['prefer_scents'] = record['prefer_scents'].split(';')
+            yield reader.line_num, record
+    else:
+        for line_num, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except (ValueError, TypeError) as ex:
+                failures(line_num, None, 'invalid json: {}'.format(ex))
+                continue
+            if not isinstance(record, dict):
+                failures(line_num, None, 'record is not a json object')
+                continue
+            yield line_num, record
+
+
+def prepare_batch(records, validate_pw, failures):
+    """validates a batch like auth.signup, returns [(line number, fields, pwd)]"""
+    prepared = []
+    for line_num, record in records:
+        try:
+            fields, pwd = validate_signup(record, random_pw=False, validate_pw=validate_pw)
+        except InvalidUsage as ex:
+            failures(line_num, record.get('email'), ex.message)
+            continue
+        prepared.append((line_num, fields, pwd))
+    return prepared
+
+
+def insert_batch(prepared, hashes, failures):
+    """unordered insert_many, returns the number of inserted users"""
+    lines, docs = [], []
+    for (line_num, fields, _), hashed in zip(prepared, hashes):
+        user = UserModel(user_id=str(uuid.uuid4()), password=hashed, **fields)
+        try:
+            user.validate()
+        except ValidationError as ex:
+            failures(line_num, fields['email'], str(ex))
+            continue
+        lines.append((line_num, fields['email']))
+        docs.append(user.to_mongo())
+
+    if not docs:
+        return 0
+    try:
+        result = UserModel._get_collection().insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as ex:
+        for error in ex.details['writeErrors']:
+            line_num, email = lines[error['index']]
+            failures(line_num, email, error['errmsg'])
+        return ex.details['nInserted']
+
+
+@click.command('import_users')
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='defaults to the file extension')
+@click.option('--batch-size', default=1000, help='users per insert_many')
+@click.option('--workers', default=None, type=int, help='hashing processes, defaults to cpu count')
+@click.option('--validate-pw/--no-validate-pw', default=True,
+              help='apply the signup password policy')
+@click.option('--errors', type=click.File('w', encoding='utf-8'), default='-',
+              help='where per-record failures are written as json lines')
+@with_appcontext
+def import_users(source, fmt, batch_size, workers, validate_pw, errors):
+    """Bulk import users from a csv or jsonl file."""
+    if fmt is None:
+        fmt = 'csv' if source.name.endswith('.csv') else 'jsonl'
+    rounds = app.config['BCRYPT_ROUNDS']
+    workers = workers or os.cpu_count()
+    counts = dict(read=0, inserted=0, failed=0)
+    started = time.monotonic()
+
+    def failures(line_num, email, message):
+        counts['failed'] += 1
+        errors.write(json.dumps(dict(line=line_num, email=email, error=message)) + '\n')
+
+    def report():
+        elapsed = time.monotonic() - started
+        click.echo('read {read} inserted {inserted} failed {failed} '
+                   '({rate:.0f} users/sec)'.format(
+                       rate=counts['inserted'] / elapsed if elapsed else 0, **counts),
+                   err=True)
+
+    records = read_records(source, fmt, failures)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = None
+        while True:
+            batch = list(islice(records, batch_size))
+            counts['read'] += len(batch)
+            prepared = prepare_batch(batch, validate_pw, failures)
+            # hash the next batch in the pool while the previous one is inserted
+            hashes = executor.map(
+                _hashpw, [pwd for _, _, pwd in prepared], [rounds] * len(prepared),
+                chunksize=max(1, len(prepared) // (4 * workers)))
+            if pending is not None:
+                counts['inserted'] += insert_batch(pending[0], list(pending[1]), failures)
+                report()
+            if not batch:
+                break
+            pending = (prepared, hashes)
+
+    report()
+
+
+@click.command('dispatch_outbox')
+@click.option('--once', is_flag=True, help='send one batch and exit')
+@with_appcontext
+def dispatch_outbox(once):
+    """Send due outbox emails, for hosts without the dispatcher thread."""
+    while True:
+        claimed = outbox.dispatch()
+        click.echo('claimed {} {}'.format(claimed, outbox.stats()), err=True)
+        if once or claimed < outbox.batch_size:
+            break
+
+
+@click.command('generate_variants')
+@click.option('--all', 'regenerate', is_flag=True,
+              help='also attachments that already have variants')
+@with_appcontext
+def generate_variants(regenerate):
+    """Render image variants of uploaded attachments that miss them."""
+    query = ImageAttachmentModel.objects(status__ne='pending').only('id')
+    if not regenerate:
+        query = query.filter(Q(variants__exists=False) | Q(variants={}))
+    done = failed = 0
+    for img in query:
+        try:
+            variant_pipeline.generate(img.id)
+            done += 1
+        except Exception as ex:
+            failed += 1
+            click.echo('{}: {}'.format(img.id, ex), err=True)
+    click.echo('generated {} failed {}'.format(done, failed), err=True)
+
+
+@click.command('configure_attachment_bucket')
+@with_appcontext
+def configure_attachment_bucket():
+    """Expire unconfirmed direct uploads under the pending prefix."""
+    s3 = boto3.client('s3')
+    bucket = app.config['ATTACHMENT_S3_BUCKET']
+    try:
+        rules = s3.get_bucket_lifecycle_configuration(Bucket=bucket)['Rules']
+    except ClientError as ex:
+        if ex.response['Error']['Code'] != 'NoSuchLifecycleConfiguration':
+            raise
+        rules = []
+    # lifecycle days are whole, kept past the ATTACHMENT_PENDING_EXPIRES TTL
+    days = math.ceil(app.config['ATTACHMENT_PENDING_EXPIRES'] / 86400) + 1
+    rules = [rule for rule in rules if rule.get('ID') != 'expire-pending-uploads']
+    rules.append(dict(
+        ID='expire-pending-uploads',
+        Filter=dict(Prefix=app.config['ATTACHMENT_PENDING_PREFIX']),
+        Status='Enabled',
+        Expiration=dict(Days=days)))
+    s3.put_bucket_lifecycle_configuration(
+        Bucket=bucket, LifecycleConfiguration=dict(Rules=rules))
+    click.echo('pending uploads expire after {} days'.format(days), err=True)
+
+
+@click.command('migrate_user_indexes')
+@with_appcontext
+def migrate_user_indexes():
+    """Rebuild the social id indexes of users as unique, run before deploying.
+
+    Older deployments have a plain kakao_id_1 index; mongoengine cannot
+    create the unique one over it and every user save fails until it is
+    dropped. Refuses while duplicates would make the unique build fail.
+    """
+    # the raw collection, _get_collection() would create the indexes itself
+    collection = get_db()[UserModel._get_collection_name()]
+    duplicated = False
+    for field in ('kakao_id', 'facebook_id'):
+        for group in collection.aggregate([
+                {'$match': {field: {'$type': 'string'}}},
+                {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}}]):
+            duplicated = True
+            click.echo('{} {} is used by {} users'.format(
+                field, group['_id'], group['count']), err=True)
+    if duplicated:
+        raise click.ClickException('resolve the duplicates first')
+
+    for name, index in collection.index_information().items():
+        fields = [field for field, _ in index['key']]
+        if fields in (['kakao_id'], ['facebook_id']) and not index.get('unique'):
+            collection.drop_index(name)
+            click.echo('dropped {}'.format(name), err=True)
+    UserModel.ensure_indexes()
+    click.echo('user indexes are up to date', err=True)
@@ -18,17 +18,162 @@ class DefaultConfig(object):
     FACEBOOK_API_SERVER = "https://graph.facebook.com"
     FACEBOOK_APP_ID = "example_id"
     FACEBOOK_APP_SECRET = "example_code"
+    # outbound provider calls, see httpclient.py
+    HTTP_POOL_SIZE = 10
+    # seconds
+    HTTP_CONNECT_TIMEOUT = 2
+    HTTP_READ_TIMEOUT = 5
+    # extra attempts for idempotent calls, jittered from HTTP_RETRY_BACKOFF
+    HTTP_RETRIES = 2
+    HTTP_RETRY_BACKOFF = 0.1
+    # verified kakao/facebook tokens -> provider user id, see social.py
+    SOCIAL_TOKEN_CACHE_SIZE = 4096
+    # seconds, also capped by the expiry the provider reports
+    SOCIAL_TOKEN_CACHE_TTL = 300
+    # seconds a rejected token is answered without asking the provider
+    SOCIAL_TOKEN_NEGATIVE_TTL = 10
+    # circuit breakers of kakao, facebook, ses, s3 and iot, see breaker.py
+    # opens when BREAKER_ERROR_RATE of the calls in the last BREAKER_WINDOW
+    # seconds failed or took longer than BREAKER_SLOW_CALL, at least
+    # BREAKER_MIN_CALLS of them
+    BREAKER_WINDOW = 30
+    BREAKER_MIN_CALLS = 10
+    BREAKER_ERROR_RATE = 0.5
+    BREAKER_SLOW_CALL = 5
+    # seconds of failing fast before BREAKER_PROBES calls are let through
+    BREAKER_OPEN_FOR = 30
+    BREAKER_PROBES = 3
+    # name -> settings of one breaker, uploads are slow by nature
+    BREAKERS = dict(s3=dict(slow_call=30))
     # set aws service
     S3_URL = "https://s3.ap-northeast-2.amazonaws.com"
     ATTACHMENT_S3_BUCKET = 'example_bucketname'
+    # direct uploads: bytes per image, seconds the presigned post is valid
+    # and seconds an unconfirmed upload is kept
+    ATTACHMENT_MAX_SIZE = 10 * 1024 * 1024
+    ATTACHMENT_UPLOAD_EXPIRES = 600
+    ATTACHMENT_PENDING_EXPIRES = 86400
+    # unconfirmed direct uploads, see `flask configure_attachment_bucket`
+    ATTACHMENT_PENDING_PREFIX = 'pending/'
+    # ids accepted by one bulk delete request
+    ATTACHMENT_BATCH_DELETE_MAX = 5000
+    # whole request body, refused with 413 before it is read
+    MAX_CONTENT_LENGTH = ATTACHMENT_MAX_SIZE + 64 * 1024
+    # uploaded files above this many bytes are spooled to a temporary file
+    UPLOAD_SPOOL_THRESHOLD = 512 * 1024
+    # s3 uploads: files above the threshold go as multipart, parts are read
+    # from the upload stream while up to MAX_CONCURRENCY earlier parts are
+    # sent on threads. Without threads parts go one after another.
+    # measure with benchmarks/bench_s3_transfer.py
+    S3_TRANSFER_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024
+    S3_TRANSFER_MAX_CONCURRENCY = 4
+    S3_TRANSFER_USE_THREADS = True
+    # resized copies stored next to each uploaded image, see variants.py
+    IMAGE_VARIANTS_ENABLED = True
+    IMAGE_VARIANTS = dict(
+        thumbnail=dict(size=(200, 200), format='JPEG', quality=80),
+        medium=dict(size=(800, 800), format='JPEG', quality=85),
+        webp=dict(size=(1600, 1600), format='WEBP', quality=80))
+    # rendering processes, 0 renders on a background thread
+    IMAGE_VARIANT_WORKERS = 2
+    # False leaves them pending for the zappa schedule, see app.generate_variants_event
+    IMAGE_VARIANTS_BACKGROUND = True
+    # seconds a render may take in the pool before the variants count as failed
+    IMAGE_VARIANT_TIMEOUT = 60
+    # seconds a scheduled drain holds a pending attachment, and attachments per drain
+    IMAGE_VARIANT_LEASE = 300
+    IMAGE_VARIANTS_DRAIN_BATCH = 20
     CONTACT_EMAIL = 'example@example.com'
     AWS_SES_REGION = 'us-west-2'
 
     PASSWORD_RESET_EXPIRE_DURATION = timedelta(minutes=10)
+    # login session lifetime, renewed on every token refresh
+    SESSION_EXPIRE_DURATION = timedelta(days=30)
+
+    # verified auth token cache (per worker)
+    AUTH_TOKEN_CACHE_SIZE = 4096
+    AUTH_TOKEN_CACHE_TTL = 60
+    METRICS_ENABLED = True
+
+    # per client token buckets on expensive endpoints, see ratelimit.py
+    RATE_LIMIT_ENABLED = True
+    # memory (per worker) or mongo (shared by every worker)
+    RATE_LIMIT_BACKEND = 'memory'
+    # name -> (requests, seconds), overrides the limit declared on a resource
+    RATE_LIMITS = {}
+    # trusted proxies appending to X-Forwarded-For, zappa already sets REMOTE_ADDR
+    RATE_LIMIT_PROXY_COUNT = 0
+
+    # concurrent requests per cost class in one worker, see admission.py
+    # unlisted classes and untagged resources are never shed
+    ADMISSION_BUDGETS = dict(bcrypt=8, s3=8, iot=16, external=16)
+    ADMISSION_RETRY_AFTER = 1
+
+    # outgoing email, stored by the request and sent by a dispatcher thread
+    # ses, file (OUTBOX_FILE_DIR/<message_id>.eml) or smtp
+    OUTBOX_TRANSPORT = 'ses'
+    OUTBOX_FILE_DIR = 'outbox'
+    OUTBOX_SMTP_HOST = 'localhost'
+    OUTBOX_SMTP_PORT = 1025
+    OUTBOX_DISPATCHER_ENABLED = True
+    OUTBOX_BATCH_SIZE = 25
+    # concurrent sends, keep under the SES max send rate
+    OUTBOX_CONCURRENCY = 4
+    OUTBOX_MAX_ATTEMPTS = 8
+    # seconds, doubled on every failed attempt up to OUTBOX_BACKOFF_MAX
+    OUTBOX_BACKOFF_BASE = 5
+    OUTBOX_BACKOFF_MAX = 3600
+    OUTBOX_LEASE = 60
+    OUTBOX_POLL_INTERVAL = 5
+
+    # exceptionReport digests, one email per window through the outbox
+    # flusher thread, lambda flushes from the zappa schedule instead
+    EXCEPTION_REPORT_ENABLED = True
+    # memory (a digest per worker) or mongo (one digest shared by every worker)
+    EXCEPTION_REPORT_BACKEND = 'memory'
+    EXCEPTION_REPORT_WINDOW = 300
+    # distinct (path, message) kept per window, the rest are only counted
+    EXCEPTION_REPORT_MAX_FINGERPRINTS = 500
+    EXCEPTION_REPORT_TO = 'example_reciver@example.com'
+    EXCEPTION_REPORT_FROM = 'example_writer@example.com'
+
+    # bloom filter of signed up emails for /user/exists
+    EMAIL_FILTER_ENABLED = True
+    # built on the first /user/exists instead of at startup
+    EMAIL_FILTER_LAZY = False
+    EMAIL_FILTER_CAPACITY = 1000000
+    EMAIL_FILTER_ERROR_RATE = 0.01
+    EMAIL_FILTER_SYNC_INTERVAL = 30
+    # seconds every sync looks back, covers clock skew between workers
+    EMAIL_FILTER_SYNC_OVERLAP = 300
+    EMAIL_FILTER_REBUILD_INTERVAL = 3600
+
+    # bcrypt work, 0 workers runs inline (lambda has no multiprocessing)
+    PASSWORD_POOL_WORKERS = 0
+    PASSWORD_POOL_MAX_QUEUE = 32
+    PASSWORD_POOL_TIMEOUT = 10
+    # rehashes to a new BCRYPT_ROUNDS waiting after login, more are skipped
+    PASSWORD_REHASH_QUEUE = 8
+    # False rehashes before the login response
+    PASSWORD_REHASH_BACKGROUND = True
+    # bcrypt cost, pick one with `flask calibrate_bcrypt` inside the budget
+    BCRYPT_ROUNDS = 12
+    PASSWORD_HASH_BUDGET = 0.3
 
 class TestConfig(DefaultConfig):
     TESTING = True
     SECRET_KEY = os.urandom(32)
+    BCRYPT_ROUNDS = 4
+    RATE_LIMIT_ENABLED = False
+    # tests run outbox.dispatch() themselves
+    OUTBOX_DISPATCHER_ENABLED = False
+    EXCEPTION_REPORT_ENABLED = False
+    IMAGE_VARIANTS_ENABLED = False
+    # a full user scan per test process, tests build it themselves
+    EMAIL_FILTER_ENABLED = False
+    # tests reuse provider tokens with different mocked answers
+    SOCIAL_TOKEN_CACHE_TTL = 0
     MONGO_HOST = 'mongodb://exampleUrl'
 
 class CiConfig(TestConfig):
@@ -46,4 +191,23 @@ class DevServerConfig(DefaultConfig):
     MONGO_PORT = 27017
     MONGO_USERNAME = os.environ.get('MONGO_USERNAME', None)
     MONGO_PWD = os.environ.get('MONGO_PWD', None)
+    METRICS_ENABLED = 'METRICS_ENABLED' in os.environ
+    # every lambda container is its own worker
+    RATE_LIMIT_BACKEND = 'mongo'
+    # lambda bodies stay under api gateway limits, one stream is enough
+    S3_TRANSFER_USE_THREADS = False
+    # no multiprocessing on lambda, and threads are frozen after the
+    # response so variants are rendered by the zappa schedule and
+    # passwords rehashed before it
+    IMAGE_VARIANT_WORKERS = 0
+    IMAGE_VARIANTS_BACKGROUND = False
+    PASSWORD_REHASH_BACKGROUND = False
+    # every cold start would scan all users, most containers never need it
+    EMAIL_FILTER_LAZY = True
+    # sent by the zappa schedule, see app.dispatch_outbox_event
+    OUTBOX_DISPATCHER_ENABLED = False
+    # a container's memory is lost when it is recycled, digests are
+    # flushed by the same schedule
+    EXCEPTION_REPORT_ENABLED = False
+    EXCEPTION_REPORT_BACKEND = 'mongo'
 
@@ -1,18 +1,18 @@
 from mongoengine import Document, StringField, ListField
-from mongoengine import DictField, DateTimeField, IntField
+from mongoengine import DictField, DateTimeField, IntField, FloatField, Q
+from bson import ObjectId
 from flask import current_app as app
 
 import arrow
+import base64
 import datetime
 
 class UserModel(Document):
     user_id = StringField(required=True, unique=True)
     email = StringField(required=True, unique=True)
-    kakao_id = StringField()
-    facebook_id = StringField()
+    kakao_id = StringField(unique=True, sparse=True)
+    facebook_id = StringField(unique=True, sparse=True)
     password = StringField()
-    auth_token = StringField()
-    refresh_token = StringField()
     access_token = StringField()
 
     picture = StringField()
@@ -33,10 +33,11 @@ class UserModel(Document):
 
 
     meta = {
+            # old documents still carry auth_token/refresh_token
+            'strict': False,
             'indexes': [
                 'user_id',
-                'email',
-                'kakao_id'
+                'email'
             ]
         }
 
@@ -50,30 +51,273 @@ class UserModel(Document):
             devices=self.devices,
             birthday=str(arrow.get(self.birthday)))
 
+# field sets for partial user loads, pick the smallest one a handler reads
+USER_FIELDS = dict(
+    auth=('user_id', 'email'),
+    login=('user_id', 'email', 'password',
+           'tmp_password', 'tmp_password_valid_period'),
+    reset=('user_id', 'email', 'name',
+           'tmp_password', 'tmp_password_valid_period'),
+    profile=('user_id', 'email', 'name', 'gender',
+             'picture', 'devices', 'birthday'),
+    public=('user_id', 'name', 'picture'),
+    devices=('user_id', 'devices'),
+    exists=('user_id',)
+)
+
+def load_user(fields=None, **query):
+    """first UserModel matching query with only the named field set, or None"""
+    queryset = UserModel.objects(**query)
+    if fields is not None:
+        queryset = queryset.only(*USER_FIELDS[fields])
+    return queryset.first()
+
+class UserRecord(object):
+    """Read-only user built straight from a pymongo document.
+
+    Skips Document construction on paths that never write, writes still go
+    through UserModel.
+    """
+    __slots__ = tuple(name for name in UserModel._fields if name != 'id')
+
+    def __init__(self, doc):
+        for name in self.__slots__:
+            setattr(self, name, doc.get(name))
+        # match the defaults a Document would give
+        if self.devices is None:
+            self.devices = {}
+        if self.prefer_scents is None:
+            self.prefer_scents = []
+
+    marshall = UserModel.marshall
+
+def find_user_record(fields=None, **query):
+    """like load_user, but returns a UserRecord through raw pymongo"""
+    projection = None
+    if fields is not None:
+        projection = dict.fromkeys(USER_FIELDS[fields], 1)
+        projection['_id'] = 0
+    doc = UserModel._get_collection().find_one(query, projection)
+    if doc is None:
+        return None
+    return UserRecord(doc)
+
+class SessionModel(Document):
+    # one document per logged in device, tokens are only referenced by id
+    jti = StringField(required=True, unique=True)
+    refresh_hash = StringField(required=True)
+    user_id = StringField(required=True)
+    device = StringField()
+    # utc, removed by the TTL monitor once passed
+    expire_at = DateTimeField(required=True)
+    reg_date = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+            'indexes': [
+                'user_id',
+                {'fields': ['expire_at'], 'expireAfterSeconds': 0}
+            ]
+        }
+
+class OutboxModel(Document):
+    # rendered emails waiting for the dispatcher, see outbox.py
+    message_id = StringField(required=True, unique=True)
+    to = ListField(StringField(), required=True)
+    cc = ListField(StringField())
+    source = StringField(required=True)
+    subject = StringField(required=True)
+    html = StringField(required=True)
+    # pending -> sending (leased) -> sent, or failed after the last attempt
+    status = StringField(default='pending')
+    attempts = IntField(default=0)
+    last_error = StringField()
+    lease_id = StringField()
+    # utc
+    next_attempt_at = DateTimeField(default=datetime.datetime.utcnow)
+    lease_until = DateTimeField()
+    sent_at = DateTimeField()
+    # utc, not sent after it, e.g. a temporary password that has expired
+    deadline = DateTimeField()
+    # utc, finished messages and those past their deadline are removed by
+    # the TTL monitor once passed
+    expire_at = DateTimeField()
+    reg_date = DateTimeField(default=datetime.datetime.now)
+
+    meta = {
+            'indexes': [
+                ('status', 'next_attempt_at'),
+                ('status', 'lease_until'),
+                {'fields': ['expire_at'], 'expireAfterSeconds': 0}
+            ]
+        }
+
+class RateLimitModel(Document):
+    # written through pymongo by ratelimit.MongoBackend, _id is the bucket key
+    id = StringField(primary_key=True)
+    tokens = FloatField()
+    updated = FloatField()
+    expire_at = DateTimeField()
+
+    meta = {
+            'indexes': [
+                {'fields': ['expire_at'], 'expireAfterSeconds': 0}
+            ]
+        }
+
+class ExceptionCountModel(Document):
+    # written through pymongo by report.MongoCounts, one per fingerprint and window
+    window = IntField(required=True)
+    fingerprint = StringField(required=True)
+    path = StringField()
+    message = StringField()
+    count = IntField(default=0)
+    first_seen = FloatField()
+    last_seen = FloatField()
+    user_id = StringField()
+    path_params = DictField()
+    request_params = DictField()
+    # set by the flush that mails the window
+    claim = StringField()
+    # utc, windows no flush picked up are removed by the TTL monitor
+    expire_at = DateTimeField()
+
+    meta = {
+            'indexes': [
+                {'fields': ['window', 'fingerprint'], 'unique': True},
+                'claim',
+                {'fields': ['expire_at'], 'expireAfterSeconds': 0}
+            ]
+        }
+
 class ImageAttachmentModel(Document):
     user_id = StringField(required=True, index=True)
     extension = StringField(required=True, default="png")
     orignal_name = StringField(required=True)
+    # pending until the client confirms its presigned upload to s3
+    status = StringField(default='uploaded')
+    content_type = StringField()
+    # variant name -> extension of the resized copies, see variants.py
+    variants = DictField()
+    # utc, variants wait for the zappa schedule and can be claimed once passed
+    variants_pending = DateTimeField()
+    # sha256 of the content when it is stored once in an ImageBlobModel
+    blob = StringField()
+    # bulk delete about to remove the attachment, see AttachmentBatchDelete
+    delete_lease = StringField()
+    lease_until = DateTimeField()
+    # utc, unconfirmed uploads are removed by the TTL monitor once passed
+    expire_at = DateTimeField()
 
     reg_date = DateTimeField(default=datetime.datetime.now)
 
+    meta = {
+            'indexes': [
+                'blob',
+                {'fields': ['variants_pending'], 'sparse': True},
+                # list order, see attachment_page
+                ('user_id', '-reg_date', '-id'),
+                {'fields': ['expire_at'], 'expireAfterSeconds': 0}
+            ]
+        }
+
+    @property
+    def key_stem(self):
+        # shared content is keyed by its digest, the rest by attachment id
+        return self.blob or str(self.id)
+
     @property
     def s3filename(self):
-        return str(self.id) + "." + self.extension
+        return self.key_stem + "." + self.extension
 
     @property
-    def s3_url(self):
+    def pending_filename(self):
+        # direct uploads land here, expired by the bucket lifecycle rule
+        return app.config['ATTACHMENT_PENDING_PREFIX'] + self.s3filename
+
+    def variant_filename(self, name, extension=None):
+        return "{}_{}.{}".format(self.key_stem, name, extension or self.variants[name])
+
+    @staticmethod
+    def url_of(filename):
         s3_root = app.config['S3_URL']
         s3_bucket = "{}/{}".format(s3_root, app.config['ATTACHMENT_S3_BUCKET'])
-        return "{}/{}".format(s3_bucket, self.s3filename)
+        return "{}/{}".format(s3_bucket, filename)
+
+    @property
+    def s3_url(self):
+        return self.url_of(self.s3filename)
 
     def marshall(self):
         return dict(
             id=str(self.id),
             original_name=self.orignal_name,
             url=self.s3_url,
+            variants={name: self.url_of(self.variant_filename(name))
+                      for name in self.variants},
+            status=self.status,
             reg_date=str(arrow.get(self.reg_date)))
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_cursor(img):
+    """opaque position right after img in the attachment list"""
+    # mongo keeps milliseconds, finer precision would never compare equal
+    millis = (img.reg_date - EPOCH) // datetime.timedelta(milliseconds=1)
+    token = '{}:{}'.format(millis, img.id).encode()
+    return base64.urlsafe_b64encode(token).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """(reg_date, id) of a cursor, ValueError when it is malformed"""
+    try:
+        token = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        millis, last_id = token.decode().split(':')
+        return EPOCH + datetime.timedelta(milliseconds=int(millis)), ObjectId(last_id)
+    except Exception:
+        raise ValueError('invalid cursor: {}'.format(cursor))
+
+def listed_attachments(user_id):
+    # unconfirmed presigned uploads are not listed
+    return ImageAttachmentModel.objects(user_id=user_id, status__ne='pending')
+
+def attachment_page(user_id, limit, offset=0, cursor=None):
+    """Attachments of a page and the cursor of the next one.
+
+    Without a cursor offset skips documents one by one in natural order,
+    as old clients have always paged. With a cursor, empty for the first
+    page, attachments are newest first and the page starts right after it
+    by seeking the (user_id, -reg_date, -_id) index, so it costs the same
+    at any depth.
+    """
+    query = listed_attachments(user_id)
+    if cursor is None:
+        return list(query[offset:offset + limit]), None
+    query = query.order_by('-reg_date', '-id')
+    if cursor:
+        reg_date, last_id = decode_cursor(cursor)
+        query = query.filter(Q(reg_date__lt=reg_date) |
+                             Q(reg_date=reg_date, id__lt=last_id))
+    page = list(query[:limit + 1])
+    next_cursor = None
+    if limit and len(page) > limit:
+        next_cursor = encode_cursor(page[limit - 1])
+    return page[:limit], next_cursor
+
+class ImageBlobModel(Document):
+    """Uploaded content stored once on s3 and shared by attachments.
+
+    ref_count is the number of attachments referencing it. uploading until
+    the first reference has put the object, deleting while the last
+    reference removes it and broken when that failed part way, so the next
+    upload of the content puts it again.
+    """
+    digest = StringField(required=True, unique=True)
+    extension = StringField(required=True)
+    status = StringField(default='uploading')
+    ref_count = IntField(default=0)
+    variants = DictField()
+
+    reg_date = DateTimeField(default=datetime.datetime.now)
+
 class StaticDataModel(Document):
     title = StringField(required=True)
     details = StringField(required=True)
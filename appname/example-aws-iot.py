@@ -1,5 +1,6 @@
 import uuid
 import datetime
+import re
 import time
 from flask import current_app as app
 from boto3 import client
@@ -7,19 +8,41 @@ from flask import json, g
 from flask_restful import Resource
 from mongoengine.queryset.visitor import Q
 from appname.db import UserModel
-from appname.error import InvalidUsage, exceptionReport
+from appname.error import InvalidUsage
+from appname.report import exceptionReport
+from appname.admission import cost_class
+from appname.breaker import guard
 from appname.auth import check_auth
 from appname.apitools import get_args, get_path, get_path_args, spec,\
         ApiParam, ApiResponse, Swagger
 import random
-iot_client = client('iot-data', region_name='ap-northeast-2')
+iot_client = guard(client('iot-data', region_name='ap-northeast-2'), 'iot')
 
 sharing_code_words = []
+# mongo reads '.' in a key as a path and '$' as an operator
+INVALID_DEVICE_ID = re.compile(r'[.$\x00]')
+
+def validate_device_id(device_id):
+    """raises 400 before any iot call for an id UserModel.devices cannot key"""
+    if not device_id or INVALID_DEVICE_ID.search(device_id):
+        raise InvalidUsage('Invalid Device ID', 400)
+
+def set_device(user_id, device_id, name):
+    """Stores one entry of UserModel.devices.
+
+    Written raw, mongoengine would split a thing name containing '__'
+    into a path.
+    """
+    validate_device_id(device_id)
+    UserModel.objects(user_id=user_id).update(
+        __raw__={'$set': {'devices.' + device_id: name}})
+
 def check_device(func):
     @check_auth
     def new_func(*args, **kwargs):
         device_id = kwargs['device_id']
-        user_id = g.user.user_db.user_id
+        validate_device_id(device_id)
+        user_id = g.user.user_id
         res = iot_client.get_thing_shadow(thingName=device_id)
         payload = json.loads(res['payload'].read())
         state = payload['state']['reported']
@@ -36,11 +59,10 @@ def check_device(func):
             iot_client.update_thing_shadow(thingName=device_id, payload=payload)
 
 
-        try:
-            user_db = UserModel.objects.get(user_id=user_id)
-        except UserModel.DoesNotExist:
+        user_db = g.user.record('devices')
+        if user_db is None:
             raise InvalidUsage('This user is not found.', status_code=401)
-        
+
 
         if user_id == owner_id and device_id in user_db.devices: #original user 
             return func(*args, **kwargs)
@@ -72,6 +94,7 @@ shadow_example = {
 
 }
 
+@cost_class('iot')
 class DeviceRegister(Resource):
     @spec(
         '/devices/<string:device_id>/register',
@@ -80,15 +103,17 @@ class DeviceRegister(Resource):
         path_params=[ApiParam('device_id', 'Device ID')],
         responses=[
             ApiResponse(200, 'Register Device Succeed', shadow_example),
+            ApiResponse.error(400, 'Invalid Device ID'),
             ApiResponse(401, 'Unauthenticated Device',
                 dict(message='This user is not owner of this device.')),
             ApiResponse.error(406, 'Expired Temporary Code'),
-            ApiResponse.error(409, "Already Registered Device")
+            ApiResponse.error(409, "Already Registered Device"),
+            ApiResponse.error(503, "iot is unavailable. Try again later.")
     ])
     @check_auth
     def post(self, device_id):
-        
-        user_db = g.user.user_db
+        validate_device_id(device_id)
+        user_db = g.user.load('devices')
         user_id = user_db.user_id
         res = iot_client.get_thing_shadow(thingName=device_id)
         payload = json.loads(res['payload'].read())
@@ -97,21 +122,24 @@ class DeviceRegister(Resource):
         desired = state.get('desired', {})
 
         if device_id in user_db.devices:
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message='Already Registered Device')
             raise InvalidUsage('Already Registered Device', 409)
 
 
         if user_id == reported['owner_id']: 
-            user_db.update(**{'set__devices__'+ device_id: device_id})
+            set_device(user_id, device_id, device_id)
             user_db.reload()
 
             return state
         else:
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message='This user is not owner of this device.')
             raise InvalidUsage('This user is not owner of this device.', status_code=401)
 
     
 
+@cost_class('iot')
 class DeviceState(Resource):
     @spec(
         '/devices/<string:device_id>/state',
@@ -120,8 +148,10 @@ class DeviceState(Resource):
         path_params=[ApiParam('device_id', 'Device ID')],
         responses=[
             ApiResponse(200, 'Register Device Succeed', shadow_example),
+            ApiResponse.error(400, 'Invalid Device ID'),
             ApiResponse(401, 'Unauthenticated Device',
-                dict(message='This user is not owner of this device.'))
+                dict(message='This user is not owner of this device.')),
+            ApiResponse.error(503, "iot is unavailable. Try again later.")
         ]
     )
     @check_device
@@ -139,7 +169,7 @@ class DeviceState(Resource):
         payload = json.loads(res['payload'].read())
 
         state = payload['state']
-        state['name'] = g.user.user_db.devices[device_id]
+        state['name'] = g.user.record('devices').devices[device_id]
 
         return state
 
@@ -158,8 +188,10 @@ class DeviceState(Resource):
         ],
         responses=[
             ApiResponse(200, 'Register Device Succeed', shadow_example),
+            ApiResponse.error(400, 'Invalid Device ID'),
             ApiResponse(401, 'Unauthenticated Device',
-                dict(message='This user is not owner of this device.'))
+                dict(message='This user is not owner of this device.')),
+            ApiResponse.error(503, "iot is unavailable. Try again later.")
         ]
     )
     @check_device
@@ -168,10 +200,11 @@ class DeviceState(Resource):
         desired = args['state']
         desired['timestamp'] = int(time.time() * 1000)
 
+        devices = g.user.record('devices').devices
         if 'name' in desired:
             name = desired.pop('name')
-            g.user.user_db.devices[device_id] = name
-            g.user.user_db.save()
+            set_device(g.user.user_id, device_id, name)
+            devices[device_id] = name
 
         payload = json.dumps({
             'state': {
@@ -182,7 +215,7 @@ class DeviceState(Resource):
         res = iot_client.get_thing_shadow(thingName=device_id)
         data = json.loads(res['payload'].read())
         state = data['state']
-        state['name'] = g.user.user_db.devices[device_id]
+        state['name'] = devices[device_id]
 
         return state
 
@@ -1,30 +1,164 @@
+import datetime
+import uuid
 from functional import seq
 from flask import g
 from flask_restful import Resource
 from appname.apitools import Swagger, spec, ApiResponse, ApiParam, \
     get_args, get_path, get_path_args
-from appname.db import ImageAttachmentModel
+from appname.db import ImageAttachmentModel, ImageBlobModel, attachment_page, \
+    listed_attachments
 from appname.auth import check_auth
-from appname.error import InvalidUsage, exceptionReport
+from appname.error import InvalidUsage
+from appname.report import exceptionReport
+from appname.admission import cost_class
+from appname.breaker import guard
+from appname.upload import sniff_image, content_digest, IMAGE_EXTENSIONS
+from appname.variants import variant_pipeline
 import boto3
 from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from bson import ObjectId
+from mongoengine import NotUniqueError, Q
 from flask import current_app as app
 
-s3 = boto3.client('s3')
+s3 = guard(boto3.client('s3'), 's3')
+# keys per DeleteObjects call, the s3 maximum
+S3_DELETE_BATCH = 1000
+# seconds a bulk delete holds the attachments it is removing
+DELETE_LEASE = 60
+variant_pipeline.configure(client=s3)
+
+
+def transfer_config(config):
+    """S3 transfer settings of this environment, see S3_TRANSFER_* in config"""
+    return TransferConfig(
+        multipart_threshold=config['S3_TRANSFER_MULTIPART_THRESHOLD'],
+        multipart_chunksize=config['S3_TRANSFER_CHUNK_SIZE'],
+        max_concurrency=config['S3_TRANSFER_MAX_CONCURRENCY'],
+        use_threads=config['S3_TRANSFER_USE_THREADS'])
+
+
+def reference_blob(digest, extension):
+    """Counts one more reference to the content with this digest.
+
+    Returns its ImageBlobModel, None while the content is being deleted,
+    in which case the upload is stored under its own key.
+    """
+    query = ImageBlobModel.objects(digest=digest)
+    update = dict(upsert=True, new=True, inc__ref_count=1,
+                  set_on_insert__extension=extension,
+                  set_on_insert__status='uploading')
+    try:
+        blob = query.modify(**update)
+    except NotUniqueError:
+        # inserted by a concurrent upload of the same content
+        blob = query.modify(**update)
+    if blob.status == 'deleting':
+        ImageBlobModel.objects(digest=digest).update(dec__ref_count=1)
+        return None
+    return blob
+
+
+def discard_upload(image_model):
+    """removes an attachment whose upload failed"""
+    image_model.delete()
+    if image_model.blob:
+        ImageBlobModel.objects(digest=image_model.blob).update(dec__ref_count=1)
+        # unless another upload of it is running the next one starts over
+        ImageBlobModel.objects(digest=image_model.blob, status='uploading',
+                               ref_count__lte=0).delete()
+
+
+def release_blob(img, references=1):
+    """Drops the references of img and attachments sharing its content.
+
+    Returns the s3 keys nothing references anymore, variants first, empty
+    while other attachments share the content. The last reference marks
+    the blob deleting so no upload starts referencing it meanwhile.
+    """
+    if not img.blob:
+        return [img.variant_filename(name) for name in img.variants] + [img.s3filename]
+    blob = ImageBlobModel.objects(digest=img.blob).modify(
+        new=True, dec__ref_count=references)
+    if blob is None or blob.ref_count > 0:
+        return []
+    blob = ImageBlobModel.objects(digest=img.blob, ref_count__lte=0).modify(
+        new=True, set__status='deleting')
+    if blob is None:
+        # referenced again by a concurrent upload
+        return []
+    variants = dict(blob.variants, **img.variants)
+    return [img.variant_filename(name, extension)
+            for name, extension in variants.items()] + [img.s3filename]
+
+
+def unleased(now=None):
+    """attachments no bulk delete currently holds"""
+    return Q(delete_lease=None) | Q(lease_until__lte=now or datetime.datetime.utcnow())
+
+
+def restore_attachments(imgs):
+    """puts back attachments removed before their s3 objects failed to delete"""
+    docs = []
+    for img in imgs:
+        img.delete_lease = None
+        img.lease_until = None
+        docs.append(img.to_mongo())
+    ImageAttachmentModel._get_collection().insert_many(docs)
+
+
+def restore_blob(img, references=1):
+    """Undoes release_blob when deleting the s3 objects failed.
+
+    Some of the objects may be gone already, the blob is left broken so
+    the next upload of the content puts it again instead of referencing it.
+    """
+    if img.blob:
+        ImageBlobModel.objects(digest=img.blob).update(
+            inc__ref_count=references, set__status='broken', set__variants={})
+
+
+def forget_blob(img):
+    """drops the blob record once its s3 objects are deleted"""
+    if img.blob:
+        ImageBlobModel.objects(digest=img.blob, status='deleting').delete()
 
 attachment_example = dict(
     original_name="example.png",
     url="http://example.png",
+    status='uploaded',
     reg_date='2018-01-04T14:08:29.520207+09:00'
 )
 
+upload_example = dict(
+    attachment=dict(attachment_example, status='pending'),
+    upload=dict(
+        url='https://example_bucketname.s3.amazonaws.com/',
+        fields={
+            'key': 'pending/5a4dbd3d1d41c8a3c4b0c5d1.png',
+            'Content-Type': 'image/png',
+            'policy': 'eyJleHBpcmF0aW9uIjog...',
+            'x-amz-signature': '...'
+        }),
+    max_size=10485760
+)
+
+@cost_class('s3', methods=['post'])
 class AttachmentList(Resource):
     @spec('/attachments', 'Get My Attachment List',
         header_params=Swagger.Params.Authorization,
-        query_params=Swagger.Params.Page,
+        query_params=[
+            *Swagger.Params.Page,
+            ApiParam('cursor', 'Empty for the first page, then next_cursor of the '
+                               'previous one. Pages newest first and ignores offset; '
+                               'without it pages by offset in insertion order')
+        ],
         responses=[
-            ApiResponse(200, "Succeed",
-                dict(attachments=[attachment_example], limit=20, total_size=100))
+            ApiResponse(200, "Succeed, total_size by offset, next_cursor by cursor "
+                             "and null on the last page",
+                dict(attachments=[attachment_example], limit=20, total_size=100,
+                     next_cursor='MTUxNTA3NDkwOTUyMDo1YTRkYmQzZDFkNDFjOGEzYzRiMGM1ZDE')),
+            ApiResponse.error(400, "Invalid cursor")
         ]
     )
     @check_auth
@@ -32,16 +166,23 @@ class AttachmentList(Resource):
         args = get_args()
         offset = args['offset']
         limit = args['limit']
+        cursor = args.get('cursor')
 
-        user_id = g.user.user_db.user_id
-        query = ImageAttachmentModel.objects(user_id=user_id)
-
-        attachments = query[offset:offset+limit]
+        user_id = g.user.user_id
+        try:
+            attachments, next_cursor = attachment_page(user_id, limit, offset, cursor)
+        except ValueError:
+            raise InvalidUsage("Invalid cursor", 400)
 
-        return dict(
+        result = dict(
             attachments=seq(attachments).map(lambda x: x.marshall()).list(),
-            limit=limit,
-            total_size=len(query))
+            limit=limit)
+        if cursor is None:
+            result['total_size'] = listed_attachments(user_id).count()
+        else:
+            # counting grows with the list, cursor clients page until next_cursor is null
+            result['next_cursor'] = next_cursor
+        return result
 
     @spec('/attachments', 'Post Image Attachment',
         header_params=Swagger.Params.Authorization,
@@ -52,43 +193,164 @@ class AttachmentList(Resource):
         responses=[
             ApiResponse(200, "Succeed", attachment_example),
             ApiResponse.error(400, "Invalid Image Type"),
-            ApiResponse.error(500, "s3 upload error. try again")
+            ApiResponse.error(413, "Image is too large"),
+            ApiResponse.error(500, "s3 upload error. try again"),
+            ApiResponse.error(503, "s3 is unavailable. Try again later.")
         ]
     )
     @check_auth
     def post(self):
         args = get_args()
         image = args['image']
-        if not image.content_type.startswith('image'):
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+        # the declared content type is not trusted
+        image_type = sniff_image(image.stream)
+        if image_type is None:
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="Invalid Image Type")
             raise InvalidUsage("Invalid Image Type", 400)
+        content_type, extension = image_type
 
-        extension = image.filename.split('.')[-1]
+        # hashed while the upload was spooled
+        digest = content_digest(image.stream)
+        blob = reference_blob(digest, extension)
 
         image_model = ImageAttachmentModel(
-                user_id=g.user.user_db.user_id,
-                extension=extension,
-                orignal_name=image.filename)
+                user_id=g.user.user_id,
+                extension=blob.extension if blob else extension,
+                orignal_name=image.filename,
+                blob=digest if blob else None,
+                variants=blob.variants if blob else {})
         image_model.save()
+        if blob is not None and blob.status == 'stored':
+            # the same content is already on s3
+            return image_model.marshall()
 
         key = image_model.s3filename 
-        upload_config = TransferConfig(use_threads=False)
+        upload_config = transfer_config(app.config)
 
         try:
             result = s3.upload_fileobj(
-                    image, app.config['ATTACHMENT_S3_BUCKET'], key,
+                    image.stream, app.config['ATTACHMENT_S3_BUCKET'], key,
                     ExtraArgs={
                         "ACL": "public-read",
-                        "ContentType": image.content_type
+                        "ContentType": content_type
                     },
                     Config=upload_config)
+        except InvalidUsage:
+            # s3 circuit is open
+            discard_upload(image_model)
+            raise
         except:
-            image_model.delete()
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+            discard_upload(image_model)
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="s3 upload error. try again")
             raise InvalidUsage("s3 upload error. try again", 500)
 
+        if blob is not None:
+            ImageBlobModel.objects(
+                digest=digest, status__in=['uploading', 'broken']).update(
+                    set__status='stored')
+        if app.config['IMAGE_VARIANTS_ENABLED']:
+            variant_pipeline.submit(image_model.id)
         return image_model.marshall()
 
+class AttachmentUpload(Resource):
+    @spec('/attachments/uploads', 'Start Direct Image Upload to S3',
+        header_params=Swagger.Params.Authorization,
+        body_params=[
+            ApiParam('filename', 'original file name', required=True),
+            ApiParam('content_type', 'image mime type', required=True)
+        ],
+        responses=[
+            ApiResponse(200, "POST the image to upload.url with upload.fields, "
+                        "then confirm", upload_example),
+            ApiResponse.error(400, "Invalid Image Type")
+        ]
+    )
+    @check_auth
+    def post(self):
+        args = get_args()
+        content_type = args['content_type']
+        # the policy pins the content type, the file name is not trusted
+        extension = IMAGE_EXTENSIONS.get(content_type)
+        if extension is None:
+            raise InvalidUsage("Invalid Image Type", 400)
+
+        image_model = ImageAttachmentModel(
+                user_id=g.user.user_id,
+                extension=extension,
+                orignal_name=args['filename'],
+                status='pending',
+                content_type=content_type,
+                expire_at=datetime.datetime.utcnow() + datetime.timedelta(
+                    seconds=app.config['ATTACHMENT_PENDING_EXPIRES']))
+        image_model.save()
+
+        # signed locally, the image goes from the client straight to s3 as
+        # a private object under the pending prefix until it is confirmed
+        upload = s3.generate_presigned_post(
+            app.config['ATTACHMENT_S3_BUCKET'], image_model.pending_filename,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, app.config['ATTACHMENT_MAX_SIZE']]
+            ],
+            ExpiresIn=app.config['ATTACHMENT_UPLOAD_EXPIRES'])
+
+        return dict(
+            attachment=image_model.marshall(),
+            upload=upload,
+            max_size=app.config['ATTACHMENT_MAX_SIZE'])
+
+@cost_class('s3')
+class AttachmentConfirm(Resource):
+    @spec('/attachments/<string:attachment_id>/confirm',
+        "Confirm Direct Image Upload",
+        header_params=Swagger.Params.Authorization,
+        responses=[
+            ApiResponse(200, "Succeed", attachment_example),
+            ApiResponse.error(404, "Image Not Found"),
+            ApiResponse.error(403, "Image Uploaded by another user"),
+            ApiResponse.error(409, "Image is not uploaded yet"),
+            ApiResponse.error(503, "s3 is unavailable. Try again later.")
+        ]
+    )
+    @check_auth
+    def post(self, attachment_id):
+        img = ImageAttachmentModel.objects.with_id(attachment_id)
+        if img is None:
+            raise InvalidUsage("Image Not Found", 404)
+        if img.user_id != g.user.user_id:
+            raise InvalidUsage("Image Uploaded by another user", 403)
+        if img.status != 'pending':
+            return img.marshall()
+
+        bucket = app.config['ATTACHMENT_S3_BUCKET']
+        try:
+            s3.copy_object(
+                Bucket=bucket,
+                Key=img.s3filename,
+                CopySource=dict(Bucket=bucket, Key=img.pending_filename),
+                ACL='public-read')
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise InvalidUsage("Image is not uploaded yet", 409)
+            raise InvalidUsage("s3 upload error. try again", 500)
+        try:
+            s3.delete_object(Bucket=bucket, Key=img.pending_filename)
+        except:
+            # left to the lifecycle rule of the pending prefix
+            pass
+
+        if not img.modify(dict(status='pending'), set__status='uploaded',
+                          unset__expire_at=True):
+            # confirmed concurrently
+            img.reload()
+        elif app.config['IMAGE_VARIANTS_ENABLED']:
+            variant_pipeline.submit(img.id)
+        return img.marshall()
+
+@cost_class('s3')
 class Attachment(Resource):
     @spec(
         '/attachments/<string:attachment_id>',
@@ -98,29 +360,150 @@ class Attachment(Resource):
             ApiResponse(200, "Succeed", dict(result=True)),
             ApiResponse.error(404, "Image Not Found"),
             ApiResponse.error(403, "Image Uploaded by another user"),
-            ApiResponse.error(500, "s3 delete error. try again")
+            ApiResponse.error(500, "s3 delete error. try again"),
+            ApiResponse.error(503, "s3 is unavailable. Try again later.")
         ]
     )
     @check_auth
     def delete(self, attachment_id):
         img = ImageAttachmentModel.objects.with_id(attachment_id)
         if img is None:
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="Image Not Found")
             raise InvalidUsage("Image Not Found", 404)
 
-        if img.user_id != g.user.user_db.user_id:
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+        if img.user_id != g.user.user_id:
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="Image Uploaded by another user")
             raise InvalidUsage("Image Uploaded by another user", 403)
+        # only the request that removed the record drops its reference,
+        # a retried or concurrent delete would release the content twice
+        if ImageAttachmentModel.objects(Q(id=img.id) & unleased()).delete() != 1:
+            raise InvalidUsage("Image Not Found", 404)
+
+        # shared content stays on s3 until its last attachment is deleted
+        keys = release_blob(img)
         try:
-            s3.delete_object(
-                Bucket=app.config['ATTACHMENT_S3_BUCKET'],
-                Key=img.s3filename)
+            for key in keys:
+                s3.delete_object(
+                    Bucket=app.config['ATTACHMENT_S3_BUCKET'],
+                    Key=key)
+        except InvalidUsage:
+            restore_blob(img)
+            restore_attachments([img])
+            raise
         except:
-            exceptionReport(g.user.user_db , get_path(), get_path_args(), get_args())
+            restore_blob(img)
+            restore_attachments([img])
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="s3 delete error. try again")
             raise InvalidUsage("s3 delete error. try again", 500)
 
-        img.delete()
+        forget_blob(img)
         return dict(result=True)
-        
 
 
+def delete_keys(keys, attempts=2):
+    """Deletes s3 objects with DeleteObjects, returns the keys not deleted.
+
+    DeleteObjects fails per key, later attempts send only the failed keys.
+    """
+    failed = set()
+    for start in range(0, len(keys), S3_DELETE_BATCH):
+        batch = keys[start:start + S3_DELETE_BATCH]
+        try:
+            result = s3.delete_objects(
+                Bucket=app.config['ATTACHMENT_S3_BUCKET'],
+                Delete=dict(Objects=[dict(Key=key) for key in batch], Quiet=True))
+        except Exception:
+            # includes the open s3 circuit
+            failed.update(batch)
+            continue
+        failed.update(error['Key'] for error in result.get('Errors', []))
+    if failed and attempts > 1:
+        return delete_keys(sorted(failed), attempts - 1)
+    return failed
+
+@cost_class('s3')
+class AttachmentBatchDelete(Resource):
+    @spec('/attachments/delete', 'Delete Image Attachments',
+        header_params=Swagger.Params.Authorization,
+        body_params=[
+            ApiParam('ids', 'attachment ids', required=True,
+                type='array',
+                item=ApiParam("item", "item", type="string"))
+        ],
+        responses=[
+            ApiResponse(200, "result of every id: deleted, not_found, invalid, "
+                        "forbidden, busy (being deleted by another request) or error",
+                        dict(results=[
+                            dict(id='5a4dbd3d1d41c8a3c4b0c5d1', result='deleted')])),
+            ApiResponse.error(400, "Too many ids"),
+            ApiResponse.error(400, "Invalid ids")
+        ]
+    )
+    @check_auth
+    def post(self):
+        ids = get_args()['ids']
+        if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            raise InvalidUsage("Invalid ids", 400)
+        ids = list(dict.fromkeys(ids))
+        if len(ids) > app.config['ATTACHMENT_BATCH_DELETE_MAX']:
+            raise InvalidUsage("Too many ids", 400)
+
+        valid_ids = [i for i in ids if ObjectId.is_valid(i)]
+        lease = str(uuid.uuid4())
+        now = datetime.datetime.utcnow()
+        # leased so a concurrent delete of the same ids does not also
+        # release their content
+        ImageAttachmentModel.objects(
+            Q(id__in=valid_ids, user_id=g.user.user_id) & unleased(now)).update(
+                set__delete_lease=lease,
+                set__lease_until=now + datetime.timedelta(seconds=DELETE_LEASE))
+
+        results = dict.fromkeys(ids, 'not_found')
+        results.update((i, 'invalid') for i in ids if not ObjectId.is_valid(i))
+        owned = []
+        # ownership of every id in one $in query
+        for img in ImageAttachmentModel.objects(id__in=valid_ids):
+            if img.user_id != g.user.user_id:
+                results[str(img.id)] = 'forbidden'
+            elif img.delete_lease == lease:
+                owned.append(img)
+            else:
+                # leased by a concurrent delete of the same id
+                results[str(img.id)] = 'busy'
+        ImageAttachmentModel.objects(delete_lease=lease).delete()
+
+        # attachments sharing content release their blob together
+        groups = {}
+        for img in owned:
+            groups.setdefault(img.key_stem, []).append(img)
+        keys = {}
+        for stem, imgs in groups.items():
+            for key in release_blob(imgs[0], len(imgs)):
+                keys[key] = stem
+
+        failed = {keys[key] for key in delete_keys(list(keys))}
+        if failed:
+            exceptionReport(g.user.user_id, get_path(), get_path_args(), get_args(),
+                            message="s3 delete error. try again")
+
+        deleted = []
+        restored = []
+        for stem, imgs in groups.items():
+            if stem in failed:
+                restore_blob(imgs[0], len(imgs))
+                restored.extend(imgs)
+                results.update((str(img.id), 'error') for img in imgs)
+            else:
+                deleted.extend(imgs)
+                results.update((str(img.id), 'deleted') for img in imgs)
+
+        if restored:
+            restore_attachments(restored)
+        blobs = [img.blob for img in deleted if img.blob]
+        if blobs:
+            ImageBlobModel.objects(digest__in=blobs, status='deleting').delete()
+
+        return dict(results=[dict(id=i, result=results[i]) for i in ids])
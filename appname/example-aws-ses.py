@@ -3,7 +3,8 @@ from flask import current_app as app
 from flask_restful import Resource
 from functional import seq
 from appname.error import InvalidUsage
-from appname.db import StaticDataModel, UserModel
+from appname.outbox import outbox
+from appname.db import StaticDataModel, UserModel, load_user
 from appname.apitools import spec, Swagger, ApiResponse,\
     get_args, ApiParam, EnumConstraint, LengthConstraint
 import appname.apitools as apitools
@@ -51,8 +52,7 @@ class Contact(Resource):
                     constraints=[EnumConstraint(['Auth', 'Device', 'Etc'])])
           ],
         responses=[
-            ApiResponse(200, 'Succeed', dict(result=True)),
-            ApiResponse.error(500, 'Email Server Error')
+            ApiResponse(200, 'Succeed', dict(result=True))
         ]
     )
     def post(self):
@@ -62,40 +62,22 @@ class Contact(Resource):
         details = args['details']
         
 
-        try:
-            user = UserModel.objects.get(email=email)
-        except UserModel.DoesNotExist:
-            user = None
+        user = load_user('public', email=email)
 
-        try:
-            if user:
-                name = user.name
-            else:
-                name = ''
+        if user:
+            name = user.name
+        else:
+            name = ''
 
-            template = render_template(
-                'mail.template.html',
-                name=name,
-                details=Markup(details))
-            charset = 'UTF-8'
-            response = apitools.email_client.send_email(
-                Destination={
-                    'ToAddresses': [
-                        app.config['CONTACT_EMAIL']
-                    ],
-                    'CcAddresses': [
-                        email,
-                    ],
-                },
-                Message=dict(
-                    Subject=dict(
-                        Data=title,
-                        Charset='utf8'),
-                    Body=dict(Html=dict(Charset='utf8', Data=template))
-                ),
-                Source=app.config['CONTACT_EMAIL'])
-        except Exception as ex:
-            print(ex)
-            raise InvalidUsage("Email Server Error: {}".format(ex), 500)
+        template = render_template(
+            'mail.template.html',
+            name=name,
+            details=Markup(details))
+        outbox.enqueue(
+            to=[app.config['CONTACT_EMAIL']],
+            cc=[email],
+            subject=title,
+            html=template,
+            source=app.config['CONTACT_EMAIL'])
 
         return dict(result=True)
@@ -1,13 +1,18 @@
-import requests
+import time
 from flask_restful import Resource
 from flask import current_app as app
 from appname.error import InvalidUsage
-from appname.db import UserModel
+from appname.db import UserModel, load_user
+from appname.ratelimit import rate_limit
+from appname.admission import cost_class
+from appname.httpclient import http_client
+from appname.social import verified_tokens
 from appname.auth import User, signup, signup_responses
 from appname.apitools import get_args, spec, ApiParam, \
     ApiResponse, EnumConstraint, Swagger
 
 
+@cost_class('external')
 class FacebookLogin(Resource):
     @spec('/facebook/login', 'Facebook User Login',
         body_params=[
@@ -29,20 +34,21 @@ class FacebookLogin(Resource):
             ApiResponse(403,
                         'Authorization Failed (from facebook server)',
                         {'message': 'Authorization Failed'}),
+            ApiResponse.error(429, 'Too many requests. Try again later.'),
+            ApiResponse.error(502, 'facebook server is not responding. Try again.'),
+            ApiResponse.error(503, 'facebook is unavailable. Try again later.'),
         ]
     )
+    @rate_limit('facebook_login', 10, per=60)
     def post(self):
         args = get_args()
         fbauth_token = args['facebook_auth_token']
 
-        resp = FacebookApi.debug_token(fbauth_token)
-        if 'error' in resp or not resp['data']['is_valid'] or \
-                resp['data']['app_id'] != app.config['FACEBOOK_APP_ID']:
-            raise InvalidUsage("Authroization Failed", 403)
-        facebook_id = str(resp['data']['user_id'])
-        try:
-            user_model = UserModel.objects.get(facebook_id=facebook_id)
-        except UserModel.DoesNotExist:
+        facebook_id = verified_tokens.user_id(
+            'facebook', fbauth_token,
+            lambda token: FacebookApi.verified_id(FacebookApi.debug_token(token)))
+        user_model = load_user('auth', facebook_id=facebook_id)
+        if user_model is None:
             raise InvalidUsage("User Not Found", 404)
 
         user = User()
@@ -58,6 +64,7 @@ class FacebookLogin(Resource):
         }
 
 
+@cost_class('external')
 class FacebookSignup(Resource):
     @spec('/facebook/signup', 'New User Signup With Facebook',
         body_params=[
@@ -90,6 +97,8 @@ class FacebookSignup(Resource):
             }),
             ApiResponse.error(403, 'Authorization Failed (from facebook server)'),
             ApiResponse.error(403, 'Already existing facebook user'),
+            ApiResponse.error(502, 'facebook server is not responding. Try again.'),
+            ApiResponse.error(503, 'facebook is unavailable. Try again later.'),
             *signup_responses,
         ]
     )
@@ -97,14 +106,9 @@ class FacebookSignup(Resource):
         args = get_args()
         fbauth_token = args['facebook_auth_token']
 
-        token_resp = FacebookApi.debug_token(fbauth_token)
-        if 'error' in token_resp or not token_resp['data']['is_valid'] or \
-                token_resp['data']['app_id'] != app.config['FACEBOOK_APP_ID']:
-            raise InvalidUsage("Authroization Failed", 403)
-        facebook_id = str(token_resp['data']['user_id'])
-
-        if UserModel.objects(facebook_id=facebook_id).first() is not None:
-            raise InvalidUsage("Already existing facebook user", 403)
+        facebook_id = verified_tokens.user_id(
+            'facebook', fbauth_token,
+            lambda token: FacebookApi.verified_id(FacebookApi.debug_token(token)))
 
         signup(args, random_pw=True, validate_pw=False, facebook_id=facebook_id)
 
@@ -112,15 +116,31 @@ class FacebookSignup(Resource):
 
 
 class FacebookApi(object):
+    @classmethod
+    def verified_id(cls, resp):
+        """(facebook id, expires_in) of a debug_token response"""
+        if 'error' in resp:
+            # the request itself failed, the token may still be valid
+            raise InvalidUsage("Authorization Failed", 403)
+        data = resp['data']
+        if not data['is_valid'] or data['app_id'] != app.config['FACEBOOK_APP_ID']:
+            return None, None
+        # 0 for tokens that do not expire
+        expires_at = data.get('expires_at')
+        return str(data['user_id']), expires_at - time.time() if expires_at else None
+
+    @classmethod
+    def app_token(cls):
+        # graph api accepts "app_id|app_secret" as the app access token,
+        # the same value /oauth/access_token would return
+        return '{}|{}'.format(
+            app.config['FACEBOOK_APP_ID'], app.config['FACEBOOK_APP_SECRET'])
+
     @classmethod
     def debug_token(cls, fbauth_token):
         server = app.config['FACEBOOK_API_SERVER']
-        app_token_url = "{}/oauth/access_token?client_id={}" \
-                        "&client_secret={}&grant_type=client_credentials"\
-            .format(server, app.config['FACEBOOK_APP_ID'], app.config['FACEBOOK_APP_SECRET'])
-        app_token_json = requests.get(app_token_url).json()
-        app_token = app_token_json["access_token"]
-        url = "{}/debug_token/?input_token={}&access_token={}".format(
-            server, fbauth_token, app_token)
-        resp = requests.get(url).json()
+        app_token = cls.app_token()
+        url = "{}/debug_token/".format(server)
+        resp = http_client.get('facebook', url, params=dict(
+            input_token=fbauth_token, access_token=app_token)).json()
         return resp
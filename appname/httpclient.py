@@ -0,0 +1,148 @@
+import random
+import threading
+import time
+from collections import defaultdict, deque
+import requests
+from requests.adapters import HTTPAdapter
+from appname.error import InvalidUsage
+from appname.breaker import get_breaker
+from appname import metrics
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class ProviderStats(object):
+    def __init__(self, samples=1024):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=samples)
+
+    def snapshot(self):
+        latencies = list(self.latencies)
+        return dict(
+            requests=self.requests,
+            retries=self.retries,
+            errors=self.errors,
+            p50_ms=percentile(latencies, 50) * 1000 if latencies else None,
+            p99_ms=percentile(latencies, 99) * 1000 if latencies else None)
+
+
+class HttpClient(object):
+    """One keep-alive session for every outbound provider call.
+
+    Connections are pooled per host, at most pool_size each kept alive,
+    so a login reuses the TLS connection of the previous one. Calls beyond
+    that open a connection that is closed afterwards instead of waiting,
+    with no timeout, for a pooled one. Idempotent calls are
+    retried on connection errors, timeouts and 5xx/429 with full jitter
+    backoff. Latency is recorded per provider and per attempt. Each
+    provider has a circuit breaker that sees one outcome per call.
+    """
+    def __init__(self, pool_size=10, connect_timeout=2, read_timeout=5,
+                 retries=2, backoff=0.1, timer=time.perf_counter):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.timer = timer
+        self.providers = defaultdict(ProviderStats)
+        self._session = None
+        self._lock = threading.Lock()
+
+    def configure(self, pool_size=None, connect_timeout=None, read_timeout=None,
+                  retries=None, backoff=None):
+        if pool_size is not None and pool_size != self.pool_size:
+            self.pool_size = pool_size
+            self.close()
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if read_timeout is not None:
+            self.read_timeout = read_timeout
+        if retries is not None:
+            self.retries = retries
+        if backoff is not None:
+            self.backoff = backoff
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size,
+                                      pool_block=False)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def request(self, provider, method, url, idempotent=None, **kwargs):
+        """Returns the response.
+
+        Raises InvalidUsage 502 when the provider is unreachable and 503
+        while its circuit is open.
+        """
+        breaker = get_breaker(provider)
+        breaker.before()
+        started = breaker.timer()
+        try:
+            resp = self._request(provider, method, url, idempotent, **kwargs)
+        except InvalidUsage:
+            breaker.after(started, True)
+            raise
+        breaker.after(started, resp.status_code >= 500)
+        return resp
+
+    def _request(self, provider, method, url, idempotent, **kwargs):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        stats = self.providers[provider]
+        session = self._get_session()
+        attempts = self.retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            if attempt:
+                stats.retries += 1
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            stats.requests += 1
+            started = self.timer()
+            try:
+                resp = session.request(method, url, **kwargs)
+            except requests.RequestException as ex:
+                stats.latencies.append(self.timer() - started)
+                stats.errors += 1
+                if attempt + 1 < attempts:
+                    continue
+                raise InvalidUsage(
+                    '{} server is not responding. Try again.'.format(provider), 502)
+            stats.latencies.append(self.timer() - started)
+            if resp.status_code in RETRY_STATUS:
+                stats.errors += 1
+                if attempt + 1 < attempts:
+                    resp.close()
+                    continue
+            return resp
+
+    def get(self, provider, url, **kwargs):
+        return self.request(provider, 'GET', url, **kwargs)
+
+    def stats(self):
+        return {name: stats.snapshot() for name, stats in list(self.providers.items())}
+
+
+http_client = HttpClient()
+metrics.register('http_client', http_client.stats)
@@ -1,12 +1,16 @@
-import requests
 from flask_restful import Resource
 from flask import current_app as app
 from appname.error import InvalidUsage
-from appname.db import UserModel
+from appname.db import UserModel, load_user
+from appname.ratelimit import rate_limit
+from appname.admission import cost_class
+from appname.httpclient import http_client
+from appname.social import verified_tokens
 from appname.auth import User, signup, signup_responses
 from appname.apitools import get_args, spec, ApiParam, \
     ApiResponse, EnumConstraint, Swagger
 
+@cost_class('external')
 class KakaoLogin(Resource):
     @spec('/kakao/login', 'Kakao User Login',
             body_params=[
@@ -28,19 +32,21 @@ class KakaoLogin(Resource):
                 ApiResponse(403,
                     'Authorization Failed (from kakao server)',
                     { 'message': 'Authorization Failed' }),
+                ApiResponse.error(429, 'Too many requests. Try again later.'),
+                ApiResponse.error(502, 'kakao server is not responding. Try again.'),
+                ApiResponse.error(503, 'kakao is unavailable. Try again later.'),
             ]
         )
+    @rate_limit('kakao_login', 10, per=60)
     def post(self):
         args = get_args()
         kauth_token = args['kakao_auth_token']
 
-        resp = KakaoApi.access_token_info(kauth_token)
-        if 'code' in resp:
-            raise InvalidUsage("Authroization Failed", 403)
-        kakao_id = str(resp['id'])
-        try:
-            user_model = UserModel.objects.get(kakao_id=kakao_id)
-        except UserModel.DoesNotExist:
+        kakao_id = verified_tokens.user_id(
+            'kakao', kauth_token,
+            lambda token: KakaoApi.verified_id(KakaoApi.access_token_info(token)))
+        user_model = load_user('auth', kakao_id=kakao_id)
+        if user_model is None:
             raise InvalidUsage("User Not Found", 404)
 
         user = User()
@@ -55,6 +61,7 @@ class KakaoLogin(Resource):
             'exp_time': exp_time
         }
 
+@cost_class('external')
 class KakaoSignup(Resource):
     @spec('/kakao/signup', 'New User Signup With Kakao',
         body_params=[
@@ -89,6 +96,8 @@ class KakaoSignup(Resource):
             }),
             ApiResponse.error(403, 'Authorization Failed (from kakao server)'),
             ApiResponse.error(403, 'Already existing kakao user'),
+            ApiResponse.error(502, 'kakao server is not responding. Try again.'),
+            ApiResponse.error(503, 'kakao is unavailable. Try again later.'),
             *signup_responses,
         ]
     )
@@ -96,19 +105,9 @@ class KakaoSignup(Resource):
         args = get_args()
         kauth_token = args['kakao_auth_token']
 
-        resp = KakaoApi.user_info(kauth_token)
-
-        if 'code' in resp:
-            raise InvalidUsage("Authorization Failed", 403)
-
-        kakao_id = str(resp['id'])
-        properties = resp['properties']
-        profile_image = properties['profile_image']
-        nickname = properties['nickname']
-        thumbnail_image = properties['thumbnail_image']
-
-        if UserModel.objects(kakao_id=kakao_id).first() is not None:
-            raise InvalidUsage("Already existing kakao user", 403)
+        kakao_id = verified_tokens.user_id(
+            'kakao', kauth_token,
+            lambda token: KakaoApi.verified_id(KakaoApi.user_info(token)))
 
         signup(args, random_pw=True, validate_pw=False, kakao_id=kakao_id)
 
@@ -117,6 +116,16 @@ class KakaoSignup(Resource):
 
 
 class KakaoApi(object):
+    @classmethod
+    def verified_id(cls, resp):
+        """(kakao id, expires_in) of a token info or user info response"""
+        if 'code' in resp:
+            # -401 is an expired or revoked token, other codes may pass on retry
+            if resp['code'] == -401:
+                return None, None
+            raise InvalidUsage("Authorization Failed", 403)
+        return str(resp['id']), resp.get('expires_in')
+
     @classmethod
     def access_token_info(cls, kauth_token):
         server = app.config['KAKAO_API_SERVER']
@@ -125,7 +134,7 @@ class KakaoApi(object):
                 "Authorization": "Bearer {}".format(kauth_token)
             }
 
-        resp = requests.get(url, headers=headers).json()
+        resp = http_client.get('kakao', url, headers=headers).json()
         return resp
 
     @classmethod
@@ -136,6 +145,6 @@ class KakaoApi(object):
                 "Authorization": "Bearer {}".format(kauth_token)
             }
 
-        resp = requests.get(url, headers=headers).json()
+        resp = http_client.get('kakao', url, headers=headers).json()
         return resp
 
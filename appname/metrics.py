@@ -0,0 +1,32 @@
+from flask import current_app as app
+from flask_restful import Resource
+from appname.error import InvalidUsage
+from appname.apitools import spec, ApiResponse
+
+_gauges = {}
+
+def register(name, func):
+    """register a callable returning a json-serializable snapshot"""
+    _gauges[name] = func
+
+def collect():
+    return {name: func() for name, func in _gauges.items()}
+
+
+metrics_example = dict(
+    auth_token_cache=dict(hits=120, misses=4, hit_rate=0.967,
+                          size=4, maxsize=4096, ttl=60)
+)
+
+class Metrics(Resource):
+    @spec('/metrics', 'Get In-process Metrics of This Worker',
+        responses=[
+            ApiResponse(200, 'Succeed', dict(metrics=metrics_example)),
+            ApiResponse.error(404, 'Metrics disabled')
+        ]
+    )
+    def get(self):
+        if not app.config.get('METRICS_ENABLED'):
+            raise InvalidUsage('Metrics disabled', 404)
+
+        return dict(metrics=collect())
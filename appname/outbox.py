@@ -0,0 +1,252 @@
+import datetime
+import logging
+import os
+import random
+import smtplib
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from mongoengine import NotUniqueError, Q
+from appname.db import OutboxModel
+from appname.breaker import get_breaker
+from appname import metrics
+import appname.apitools as apitools
+
+logger = logging.getLogger(__name__)
+
+
+def build_mime(message):
+    mime = EmailMessage()
+    mime['Message-ID'] = '<{}@outbox>'.format(message.message_id)
+    mime['From'] = message.source
+    mime['To'] = ', '.join(message.to)
+    if message.cc:
+        mime['Cc'] = ', '.join(message.cc)
+    mime['Subject'] = message.subject
+    mime.set_content(message.html, subtype='html')
+    return mime
+
+
+class SesTransport(object):
+    def send(self, message):
+        # an open circuit fails the attempt right away, it is retried later
+        get_breaker('ses').call(
+            apitools.email_client.send_email,
+            Destination={
+                'ToAddresses': list(message.to),
+                'CcAddresses': list(message.cc),
+            },
+            Message=dict(
+                Subject=dict(
+                    Data=message.subject,
+                    Charset='utf8'),
+                Body=dict(Html=dict(Charset='utf8', Data=message.html))
+            ),
+            Source=message.source)
+
+
+class FileTransport(object):
+    """Writes <message_id>.eml into directory, a redelivery overwrites it."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def send(self, message):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.eml'.format(message.message_id))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(bytes(build_mime(message)))
+        os.replace(path + '.tmp', path)
+
+
+class SmtpTransport(object):
+    def __init__(self, host='localhost', port=25, username=None, password=None,
+                 timeout=10):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+
+    def send(self, message):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(build_mime(message))
+
+
+def make_transport(config):
+    name = config['OUTBOX_TRANSPORT']
+    if name == 'file':
+        return FileTransport(config['OUTBOX_FILE_DIR'])
+    if name == 'smtp':
+        return SmtpTransport(
+            config['OUTBOX_SMTP_HOST'], config['OUTBOX_SMTP_PORT'],
+            config.get('OUTBOX_SMTP_USERNAME'), config.get('OUTBOX_SMTP_PASSWORD'))
+    return SesTransport()
+
+
+class Outbox(object):
+    """Emails stored in mongo by the request and delivered in the background.
+
+    The dispatcher claims up to batch_size due messages, each with a lease,
+    and sends them on `concurrency` threads. A failed send is retried with
+    exponential backoff until max_attempts or its deadline. A message is
+    marked sent only by the holder of its lease, and a worker dying mid
+    send leaves the lease to expire, so delivery is at least once and
+    never concurrent. The body is dropped once the message is finished.
+    """
+    def __init__(self, transport=None, batch_size=25, concurrency=4,
+                 max_attempts=8, backoff_base=5, backoff_max=3600, lease=60,
+                 poll_interval=5, keep_sent=datetime.timedelta(days=7)):
+        self.transport = transport or SesTransport()
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.keep_sent = keep_sent
+
+        self.counters = dict(enqueued=0, sent=0, retried=0, failed=0)
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def configure(self, transport=None, batch_size=None, concurrency=None,
+                  max_attempts=None, backoff_base=None, backoff_max=None,
+                  lease=None, poll_interval=None):
+        if transport is not None:
+            self.transport = transport
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if max_attempts is not None:
+            self.max_attempts = max_attempts
+        if backoff_base is not None:
+            self.backoff_base = backoff_base
+        if backoff_max is not None:
+            self.backoff_max = backoff_max
+        if lease is not None:
+            self.lease = lease
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+
+    def enqueue(self, to, subject, html, source, cc=None, key=None, deadline=None):
+        """Stores a rendered email, returns its message_id.
+
+        Enqueueing the same key twice stores a single message. A message
+        with a deadline (utc) is never sent after it and is removed then.
+        """
+        message_id = key or str(uuid.uuid4())
+        try:
+            OutboxModel(
+                message_id=message_id,
+                to=list(to),
+                cc=list(cc or []),
+                source=source,
+                subject=subject,
+                html=str(html),
+                deadline=deadline,
+                expire_at=deadline).save(force_insert=True)
+            self.counters['enqueued'] += 1
+        except NotUniqueError:
+            pass
+        self._wakeup.set()
+        return message_id
+
+    def backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def claim(self, now):
+        """leases one due message, None when there is nothing to send"""
+        lease_id = str(uuid.uuid4())
+        return OutboxModel.objects(
+            (Q(status='pending', next_attempt_at__lte=now) |
+             Q(status='sending', lease_until__lte=now)) &
+            (Q(deadline=None) | Q(deadline__gt=now))
+        ).order_by('next_attempt_at').modify(
+            new=True,
+            set__status='sending',
+            set__lease_id=lease_id,
+            set__lease_until=now + datetime.timedelta(seconds=self.lease))
+
+    def give_up(self, owned, attempts, error):
+        now = datetime.datetime.utcnow()
+        owned.update(
+            set__status='failed', set__attempts=attempts,
+            set__last_error=error, unset__lease_id=True,
+            set__expire_at=now + self.keep_sent, unset__html=True)
+        self.counters['failed'] += 1
+
+    def deliver(self, message):
+        owned = OutboxModel.objects(id=message.id, lease_id=message.lease_id)
+        if message.deadline and message.deadline <= datetime.datetime.utcnow():
+            self.give_up(owned, message.attempts, 'deadline passed')
+            return False
+        try:
+            self.transport.send(message)
+        except Exception as ex:
+            attempts = message.attempts + 1
+            next_attempt_at = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=self.backoff(attempts))
+            if attempts >= self.max_attempts or \
+                    (message.deadline and next_attempt_at >= message.deadline):
+                self.give_up(owned, attempts, str(ex))
+            else:
+                owned.update(
+                    set__status='pending', set__attempts=attempts,
+                    set__last_error=str(ex), unset__lease_id=True,
+                    set__next_attempt_at=next_attempt_at)
+                self.counters['retried'] += 1
+            return False
+
+        now = datetime.datetime.utcnow()
+        # the body may hold secrets, only the envelope is kept
+        owned.update(
+            set__status='sent', set__attempts=message.attempts + 1,
+            set__sent_at=now, set__expire_at=now + self.keep_sent,
+            unset__lease_id=True, unset__last_error=True, unset__html=True)
+        self.counters['sent'] += 1
+        return True
+
+    def dispatch(self):
+        """sends one batch of due messages, returns how many were claimed"""
+        now = datetime.datetime.utcnow()
+        batch = []
+        while len(batch) < self.batch_size:
+            message = self.claim(now)
+            if message is None:
+                break
+            batch.append(message)
+        if batch:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                list(executor.map(self.deliver, batch))
+        return len(batch)
+
+    def start(self):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._loop, daemon=True)
+            self._worker.start()
+
+    def _loop(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                if self.dispatch() == self.batch_size:
+                    continue
+            except Exception:
+                logger.exception('outbox dispatch failed')
+            self._wakeup.wait(self.poll_interval)
+
+    def stats(self):
+        return dict(self.counters)
+
+
+outbox = Outbox()
+metrics.register('outbox', outbox.stats)
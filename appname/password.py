@@ -0,0 +1,164 @@
+import bcrypt
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from appname.error import InvalidUsage
+
+logger = logging.getLogger(__name__)
+
+def _hashpw(pwd, rounds=12):
+    return bcrypt.hashpw(pwd.encode('utf-8'), bcrypt.gensalt(rounds)).decode()
+
+def _checkpw(pwd, hashed):
+    return bcrypt.checkpw(pwd.encode('utf-8'), hashed.encode('utf-8'))
+
+def hash_cost(hashed):
+    """cost factor of a modular crypt bcrypt hash, e.g. $2b$12$..."""
+    try:
+        return int(hashed.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordPool(object):
+    """Runs bcrypt work off the request thread.
+
+    With workers == 0 the work runs inline (lambda has no /dev/shm for
+    multiprocessing), but the queue bound still applies, so a worker never
+    has more than max_queue bcrypt calls in flight. Rehashes after login
+    wait on one background thread, at most rehash_queue of them; with
+    background off, for lambda which freezes threads once the response is
+    sent, they run before the response instead.
+    """
+    def __init__(self, workers=0, max_queue=32, timeout=10, rounds=12,
+                 rehash_queue=8, background=True):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rounds = rounds
+        self.rehash_queue = rehash_queue
+        self.background = background
+        self.rejected = 0
+        self.rehashed = 0
+        self.rehash_skipped = 0
+        self.rehash_failed = 0
+        self._executor = None
+        self._background = ThreadPoolExecutor(max_workers=1)
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._rehash_slots = threading.BoundedSemaphore(rehash_queue)
+        self._lock = threading.Lock()
+
+    def configure(self, workers=None, max_queue=None, timeout=None, rounds=None,
+                  rehash_queue=None, background=None):
+        self.shutdown()
+        if rounds is not None:
+            self.rounds = rounds
+        if rehash_queue is not None:
+            self.rehash_queue = rehash_queue
+            self._rehash_slots = threading.BoundedSemaphore(rehash_queue)
+        if background is not None:
+            self.background = background
+        if workers is not None:
+            self.workers = workers
+        if max_queue is not None:
+            self.max_queue = max_queue
+            self._slots = threading.BoundedSemaphore(max_queue)
+        if timeout is not None:
+            self.timeout = timeout
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _get_executor(self):
+        # created on first use so forking happens after the app is set up
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def run(self, func, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            self.rejected += 1
+            raise InvalidUsage('Server is busy. Try again.', 503)
+
+        if self.workers <= 0:
+            try:
+                return func(*args)
+            finally:
+                slots.release()
+
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            slots.release()
+            raise
+        # the slot is held until the worker is really done, even on timeout
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise InvalidUsage('Server is busy. Try again.', 503)
+
+    def hash(self, pwd):
+        return self.run(_hashpw, pwd, self.rounds)
+
+    def check(self, pwd, hashed):
+        return self.run(_checkpw, pwd, hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_cost(hashed) != self.rounds
+
+    def rehash_later(self, pwd, save):
+        """hash pwd at the target cost off the request path, then save(new_hash)
+
+        Returns the Future of the rehash, None when it ran inline or was
+        skipped because rehash_queue are already waiting.
+        """
+        def work():
+            try:
+                save(self.hash(pwd))
+                self.rehashed += 1
+            except InvalidUsage:
+                # pool is busy, the next login will try again
+                self.rehash_skipped += 1
+            except Exception:
+                self.rehash_failed += 1
+                logger.exception('password rehash failed')
+
+        if not self.background:
+            work()
+            return None
+        slots = self._rehash_slots
+        if not slots.acquire(blocking=False):
+            # the next login will try again
+            self.rehash_skipped += 1
+            return None
+        def queued():
+            try:
+                work()
+            finally:
+                slots.release()
+        try:
+            return self._background.submit(queued)
+        except Exception:
+            slots.release()
+            raise
+
+    def stats(self):
+        return dict(
+            workers=self.workers,
+            max_queue=self.max_queue,
+            rounds=self.rounds,
+            rejected=self.rejected,
+            rehashed=self.rehashed,
+            rehash_skipped=self.rehash_skipped,
+            rehash_failed=self.rehash_failed)
+
+
+password_pool = PasswordPool()
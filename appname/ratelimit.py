@@ -0,0 +1,129 @@
+import datetime
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+from flask import current_app as app
+from pymongo.errors import DuplicateKeyError
+from appname.db import RateLimitModel
+from appname.error import InvalidUsage
+from appname import metrics
+
+
+def refill(tokens, updated, now, rate, burst):
+    """token bucket state after `now - updated` seconds of refilling"""
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryBackend(object):
+    """Per worker buckets, bounded by dropping the least recently used."""
+    def __init__(self, max_keys=100000, timer=time.monotonic):
+        self.max_keys = max_keys
+        self.timer = timer
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """returns seconds to wait, 0 when a token was taken"""
+        now = self.timer()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = refill(tokens, updated, now, rate, burst)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class MongoBackend(object):
+    """Buckets shared by every worker, updated with compare-and-set.
+
+    Bucket documents expire through a TTL index once they would be full
+    again. When the compare-and-set keeps losing, the request is let
+    through rather than failing the endpoint.
+    """
+    def __init__(self, retries=3, timer=time.time):
+        self.retries = retries
+        self.timer = timer
+
+    def take(self, key, rate, burst):
+        collection = RateLimitModel._get_collection()
+        for _ in range(self.retries):
+            now = self.timer()
+            doc = collection.find_one({'_id': key})
+            if doc is None:
+                tokens, updated = burst, now
+            else:
+                tokens, updated = doc['tokens'], doc['updated']
+            tokens = refill(tokens, updated, now, rate, burst)
+
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if wait:
+                return wait
+
+            tokens -= 1
+            state = {
+                'tokens': tokens,
+                'updated': now,
+                'expire_at': datetime.datetime.utcfromtimestamp(now + (burst - tokens) / rate)
+            }
+            if doc is None:
+                try:
+                    collection.insert_one(dict(state, _id=key))
+                    return 0
+                except DuplicateKeyError:
+                    continue
+            result = collection.update_one(
+                {'_id': key, 'updated': doc['updated']}, {'$set': state})
+            if result.matched_count:
+                return 0
+        return 0
+
+
+backends = dict(memory=MemoryBackend(), mongo=MongoBackend())
+counters = dict(allowed=0, throttled=0)
+metrics.register('rate_limit', lambda: dict(counters))
+
+
+def client_key():
+    """client address, skipping RATE_LIMIT_PROXY_COUNT trusted proxies"""
+    proxies = app.config.get('RATE_LIMIT_PROXY_COUNT', 0)
+    route = request.access_route
+    if proxies and len(route) >= proxies:
+        return route[-proxies]
+    return request.remote_addr
+
+
+def rate_limit(name, rate, per=60, burst=None, key=client_key):
+    """Token bucket limit of `rate` requests per `per` seconds for each client.
+
+    RATE_LIMITS[name] = (rate, per) in app.config overrides the declared
+    limit. Throttled requests get 429 with Retry-After before the
+    decorated function runs.
+    """
+    def decorator(func):
+        def new_func(*args, **kwargs):
+            if app.config.get('RATE_LIMIT_ENABLED'):
+                limit, seconds = app.config.get('RATE_LIMITS', {}).get(name, (rate, per))
+                backend = backends[app.config.get('RATE_LIMIT_BACKEND', 'memory')]
+                wait = backend.take(
+                    '{}:{}'.format(name, key()), limit / seconds, burst or limit)
+                if wait:
+                    counters['throttled'] += 1
+                    raise InvalidUsage(
+                        'Too many requests. Try again later.', 429,
+                        headers={'Retry-After': str(int(math.ceil(wait)))})
+                counters['allowed'] += 1
+            return func(*args, **kwargs)
+
+        new_func._original = func
+        new_func.__name__ = func.__name__
+        return new_func
+    return decorator
@@ -0,0 +1,232 @@
+import datetime
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from flask import render_template
+from appname.db import ExceptionCountModel
+from appname import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(path, message):
+    return hashlib.sha1(repr((path, message)).encode()).hexdigest()
+
+
+def by_count(errors):
+    return sorted(errors, key=lambda e: e['count'], reverse=True)
+
+
+class MemoryCounts(object):
+    """Per worker counts of the current window, bounded by max_fingerprints."""
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self._errors = {}
+        self._dropped = 0
+        self._window_start = timer()
+        self._lock = threading.Lock()
+
+    def add(self, path, message, sample, now, window, max_fingerprints):
+        """False when the fingerprint did not fit in the window"""
+        key = (path, message)
+        with self._lock:
+            entry = self._errors.get(key)
+            if entry is not None:
+                entry['count'] += 1
+                entry['last_seen'] = now
+            elif len(self._errors) < max_fingerprints:
+                self._errors[key] = dict(
+                    sample, path=path, message=message, count=1,
+                    first_seen=now, last_seen=now)
+            else:
+                self._dropped += 1
+                return False
+        return True
+
+    def take(self, now, window, max_fingerprints, force=False):
+        """[(window start, errors by count, dropped)], empty until the window passed"""
+        with self._lock:
+            if not force and now - self._window_start < window:
+                return []
+            errors, dropped = self._errors, self._dropped
+            started = self._window_start
+            self._errors, self._dropped = {}, 0
+            self._window_start = now
+        return [(started, by_count(errors.values()), dropped)]
+
+    def pending(self):
+        with self._lock:
+            return sum(e['count'] for e in self._errors.values()), len(self._errors)
+
+
+class MongoCounts(object):
+    """Counts shared by every worker, one document per fingerprint and window.
+
+    Windows are aligned to multiples of the window length so every worker
+    adds to the same documents. A flush claims the windows that have ended
+    before reading them, so concurrent flushes never mail one twice.
+    """
+    def add(self, path, message, sample, now, window, max_fingerprints):
+        started = int(now // window * window)
+        ExceptionCountModel._get_collection().update_one(
+            {'window': started, 'fingerprint': fingerprint(path, message)},
+            {'$inc': {'count': 1},
+             '$max': {'last_seen': now},
+             '$setOnInsert': dict(
+                 sample, path=path, message=message, first_seen=now, claim=None,
+                 expire_at=datetime.datetime.utcfromtimestamp(started + window)
+                 + datetime.timedelta(days=1))},
+            upsert=True)
+        return True
+
+    def take(self, now, window, max_fingerprints, force=False):
+        collection = ExceptionCountModel._get_collection()
+        ended = int(now // window * window) + (window if force else 0)
+        claim = uuid.uuid4().hex
+        collection.update_many({'window': {'$lt': ended}, 'claim': None},
+                               {'$set': {'claim': claim}})
+        windows = {}
+        for doc in collection.find({'claim': claim}, {'_id': 0, 'claim': 0, 'expire_at': 0}):
+            windows.setdefault(doc.pop('window'), []).append(doc)
+        collection.delete_many({'claim': claim})
+
+        taken = []
+        for started, errors in sorted(windows.items()):
+            errors = by_count(errors)
+            dropped = sum(e['count'] for e in errors[max_fingerprints:])
+            taken.append((started, errors[:max_fingerprints], dropped))
+        return taken
+
+    def pending(self):
+        return ExceptionCountModel.objects(claim=None).sum('count'), \
+            ExceptionCountModel.objects(claim=None).count()
+
+
+class ExceptionReporter(object):
+    """Counts reported errors and mails one digest per window.
+
+    Errors are fingerprinted by path and message. Within a window every
+    fingerprint keeps a count and the first occurrence as a sample, so an
+    error burst becomes one line of the next digest. With the memory
+    backend reporting only takes a lock and every worker mails its own
+    digest; with mongo every worker adds to one digest per window.
+    Rendering and queueing digests happen on a background thread, or on
+    the zappa schedule where threads are frozen between requests.
+    """
+    def __init__(self, window=300, max_fingerprints=500, timer=time.time,
+                 backend='memory'):
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.timer = timer
+        self.app = None
+        self.to = None
+        self.source = None
+        self.backend = backend
+
+        self.counters = dict(reported=0, dropped=0, lost=0, digests=0)
+        self.backends = dict(memory=MemoryCounts(timer), mongo=MongoCounts())
+        self._wakeup = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def configure(self, app=None, to=None, source=None, window=None,
+                  max_fingerprints=None, backend=None):
+        if app is not None:
+            self.app = app
+        if to is not None:
+            self.to = to
+        if source is not None:
+            self.source = source
+        if window is not None:
+            self.window = window
+        if max_fingerprints is not None:
+            self.max_fingerprints = max_fingerprints
+        if backend is not None:
+            self.backend = backend
+
+    @property
+    def counts(self):
+        return self.backends[self.backend]
+
+    def report(self, path, message, user_id=None, path_params=None,
+               request_params=None):
+        sample = dict(user_id=user_id, path_params=path_params,
+                      request_params=request_params)
+        self.counters['reported'] += 1
+        try:
+            if not self.counts.add(path, message, sample, self.timer(),
+                                   self.window, self.max_fingerprints):
+                self.counters['dropped'] += 1
+        except Exception:
+            # reporting never fails the request it comes from
+            self.counters['lost'] += 1
+            logger.exception('exception report lost')
+
+    def take(self, due=False):
+        """[(window start, errors by count, dropped)] of the windows taken
+
+        Without due the current window is taken as well and a new one starts.
+        """
+        return self.counts.take(self.timer(), self.window, self.max_fingerprints,
+                                force=not due)
+
+    def flush(self, due=False):
+        """queues a digest per window, False when nothing happened"""
+        queued = False
+        for started, errors, dropped in self.take(due):
+            if errors or dropped:
+                self._enqueue(started, errors, dropped)
+                queued = True
+        return queued
+
+    def _enqueue(self, started, errors, dropped):
+        from appname.outbox import outbox
+        with self.app.app_context():
+            html = render_template(
+                'exception_digest_mail.template.html',
+                window_start=datetime.datetime.utcfromtimestamp(started),
+                window=self.window,
+                errors=errors,
+                total=sum(e['count'] for e in errors),
+                dropped=dropped)
+        outbox.enqueue(
+            to=[self.to],
+            subject='서버에 예외 발생 ({}건)'.format(sum(e['count'] for e in errors) + dropped),
+            html=html,
+            source=self.source)
+        self.counters['digests'] += 1
+
+    def start(self):
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._loop, daemon=True)
+            self._worker.start()
+
+    def _loop(self):
+        while not self._wakeup.wait(self.window):
+            try:
+                self.flush(due=True)
+            except Exception:
+                logger.exception('exception digest flush failed')
+
+    def stats(self):
+        pending, fingerprints = self.counts.pending()
+        return dict(self.counters, backend=self.backend, pending=pending,
+                    fingerprints=fingerprints)
+
+
+reporter = ExceptionReporter()
+metrics.register('exception_report', reporter.stats)
+
+
+def exceptionReport(user_id, path, pathParam, requestParam=None, message=None):
+    """records an error for the next digest, never blocks on the network"""
+    if requestParam is not None:
+        requestParam = {key: value if isinstance(value, (str, int, float, bool, type(None)))
+                        else repr(value)
+                        for key, value in requestParam.items()}
+    reporter.report(path, message, user_id=user_id, path_params=pathParam,
+                    request_params=requestParam)
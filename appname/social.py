@@ -0,0 +1,51 @@
+from appname.cache import TTLCache
+from appname.error import InvalidUsage
+from appname import metrics
+from appname.auth import token_digest
+
+
+class VerifiedTokens(object):
+    """Provider user ids of recently verified social tokens.
+
+    Keyed by provider and a digest of the token, so raw tokens are never
+    kept. A valid token lives until the provider reported expiry or the
+    cache ttl, whichever comes first. A definite failure (revoked, expired,
+    issued for another app) is remembered for negative_ttl so a client
+    replaying it does not reach the provider again.
+    """
+    def __init__(self, maxsize=4096, ttl=300, negative_ttl=10):
+        self.cache = TTLCache(maxsize, ttl)
+        self.negative_ttl = negative_ttl
+
+    def configure(self, maxsize=None, ttl=None, negative_ttl=None):
+        self.cache.configure(maxsize=maxsize, ttl=ttl)
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+
+    def user_id(self, provider, token, verify):
+        """Verified provider user id, 403 for a rejected token.
+
+        verify(token) returns (user_id, expires_in) for a valid token and
+        (None, None) for a definite failure. Anything else it raises is not
+        cached.
+        """
+        key = '{}:{}'.format(provider, token_digest(token))
+        user_id = self.cache.get(key)
+        if user_id is None:
+            user_id, expires_in = verify(token)
+            if user_id is None:
+                user_id = ''
+                self.cache.set(key, user_id, self.negative_ttl)
+            else:
+                self.cache.set(key, user_id, expires_in)
+
+        if not user_id:
+            raise InvalidUsage("Authorization Failed", 403)
+        return user_id
+
+    def stats(self):
+        return dict(self.cache.stats(), negative_ttl=self.negative_ttl)
+
+
+verified_tokens = VerifiedTokens()
+metrics.register('social_token_cache', verified_tokens.stats)
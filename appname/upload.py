@@ -0,0 +1,70 @@
+import hashlib
+from tempfile import SpooledTemporaryFile
+from flask import Request
+from flask import current_app as app
+
+# leading bytes -> (content type, extension)
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', ('image/png', 'png')),
+    (b'\xff\xd8\xff', ('image/jpeg', 'jpg')),
+    (b'GIF87a', ('image/gif', 'gif')),
+    (b'GIF89a', ('image/gif', 'gif')),
+    (b'BM', ('image/bmp', 'bmp')),
+]
+# content type -> extension of every type sniff_image recognizes
+IMAGE_EXTENSIONS = dict(image_type for _, image_type in IMAGE_SIGNATURES)
+IMAGE_EXTENSIONS['image/webp'] = 'webp'
+
+
+def sniff_image(stream):
+    """(content type, extension) from the first bytes, None if not an image"""
+    position = stream.tell()
+    head = stream.read(16)
+    stream.seek(position)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp', 'webp'
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_type
+    return None
+
+
+class HashingSpooledFile(SpooledTemporaryFile):
+    """SpooledTemporaryFile computing the sha256 of what is written to it"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._sha256.update(data)
+        return super().write(data)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+def content_digest(stream, chunk_size=64 * 1024):
+    """sha256 hex digest of a whole stream, free when it was hashed while spooled"""
+    if isinstance(stream, HashingSpooledFile):
+        return stream.sha256
+    position = stream.tell()
+    stream.seek(0)
+    sha256 = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        sha256.update(chunk)
+    stream.seek(position)
+    return sha256.hexdigest()
+
+
+class SpooledRequest(Request):
+    """Spools uploaded files to disk past UPLOAD_SPOOL_THRESHOLD bytes.
+
+    werkzeug parses multipart bodies in small chunks into this stream, so
+    memory per upload stays at the threshold whatever the file size. The
+    content is hashed on the way in for deduplication. Bodies over
+    MAX_CONTENT_LENGTH are refused with 413 before parsing.
+    """
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingSpooledFile(max_size=app.config['UPLOAD_SPOOL_THRESHOLD'])
@@ -0,0 +1,190 @@
+import datetime
+import io
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from PIL import Image
+from appname.db import ImageAttachmentModel, ImageBlobModel
+from appname.report import reporter
+from appname import metrics
+
+# PIL format -> (content type, extension)
+FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+    'WEBP': ('image/webp', 'webp'),
+}
+
+
+def render_variants(data, specs):
+    """Resized copies of an encoded image.
+
+    specs maps a variant name to dict(size=(width, height), format, quality);
+    the image is fit inside size keeping its aspect ratio and never enlarged.
+    Returns {name: (bytes, content type, extension)}. Runs in a worker
+    process, so it only takes and returns picklable values.
+    """
+    rendered = {}
+    for name, spec in specs.items():
+        img = Image.open(io.BytesIO(data))
+        # jpeg can decode at 1/2, 1/4 or 1/8 scale, much cheaper for thumbnails
+        img.draft('RGB', tuple(spec['size']))
+        img.thumbnail(tuple(spec['size']), Image.LANCZOS)
+        fmt = spec.get('format', 'JPEG')
+        if fmt == 'JPEG' and img.mode != 'RGB':
+            img = img.convert('RGB')
+        elif img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+
+        out = io.BytesIO()
+        img.save(out, fmt, quality=spec.get('quality', 85))
+        content_type, extension = FORMATS[fmt]
+        rendered[name] = (out.getvalue(), content_type, extension)
+    return rendered
+
+
+class VariantPipeline(object):
+    """Generates the configured variants of uploaded images in the background.
+
+    submit() only queues the attachment id. A coordinator thread downloads
+    the original, renders every variant in a process pool (in the thread
+    with 0 workers), uploads them next to the original and records them on
+    the attachment. With background off, for lambda which freezes threads
+    once the response is sent, submit() only marks the attachment pending
+    and drain() generates the marked ones from the zappa schedule.
+    """
+    def __init__(self, specs=None, workers=0, client=None, bucket=None,
+                 background=True, timeout=60, lease=300):
+        self.specs = specs or {}
+        self.workers = workers
+        self.client = client
+        self.bucket = bucket
+        self.background = background
+        self.timeout = timeout
+        self.lease = lease
+        self.counters = dict(submitted=0, deferred=0, generated=0, failed=0,
+                             timed_out=0, orphaned=0)
+        self._executor = None
+        self._background = ThreadPoolExecutor(max_workers=2)
+        self._lock = threading.Lock()
+
+    def configure(self, specs=None, workers=None, client=None, bucket=None,
+                  background=None, timeout=None, lease=None):
+        if background is not None:
+            self.background = background
+        if timeout is not None:
+            self.timeout = timeout
+        if lease is not None:
+            self.lease = lease
+        if specs is not None:
+            self.specs = specs
+        if workers is not None and workers != self.workers:
+            self.shutdown()
+            self.workers = workers
+        if client is not None:
+            self.client = client
+        if bucket is not None:
+            self.bucket = bucket
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def _render(self, data):
+        if not self.workers:
+            return render_variants(data, self.specs)
+        with self._lock:
+            # created on first use so forking happens after the app is set up
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+        future = executor.submit(render_variants, data, self.specs)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self.counters['timed_out'] += 1
+            raise
+
+    def generate(self, attachment_id):
+        """renders, uploads and records every variant of one attachment"""
+        img = ImageAttachmentModel.objects.with_id(attachment_id)
+        if img is None or not self.specs:
+            return None
+
+        obj = self.client.get_object(Bucket=self.bucket, Key=img.s3filename)
+        rendered = self._render(obj['Body'].read())
+
+        variants = {}
+        for name, (data, content_type, extension) in rendered.items():
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=img.variant_filename(name, extension),
+                Body=data,
+                ACL='public-read',
+                ContentType=content_type)
+            variants[name] = extension
+
+        if img.blob:
+            # shared by every attachment of the same content
+            ImageBlobModel.objects(digest=img.blob).update(set__variants=variants)
+            ImageAttachmentModel.objects(blob=img.blob).update(set__variants=variants)
+            alive = ImageBlobModel.objects(digest=img.blob, status__ne='deleting').count()
+        else:
+            ImageAttachmentModel.objects(id=img.id).update(set__variants=variants)
+            alive = ImageAttachmentModel.objects(id=img.id).count()
+        if not alive:
+            # deleted while rendering, nothing else would remove these
+            for name, extension in variants.items():
+                self.client.delete_object(
+                    Bucket=self.bucket, Key=img.variant_filename(name, extension))
+            self.counters['orphaned'] += 1
+            return None
+        self.counters['generated'] += 1
+        return variants
+
+    def _generate(self, attachment_id):
+        try:
+            return self.generate(attachment_id)
+        except Exception as ex:
+            self.counters['failed'] += 1
+            # the original stays usable, `flask generate_variants` retries
+            reporter.report('variants', str(ex), path_params=dict(id=attachment_id))
+
+    def submit(self, attachment_id):
+        """Future of the variants, None when they were left for drain()"""
+        self.counters['submitted'] += 1
+        if self.background:
+            return self._background.submit(self._generate, str(attachment_id))
+        ImageAttachmentModel.objects(id=attachment_id).update(
+            set__variants_pending=datetime.datetime.utcnow())
+        self.counters['deferred'] += 1
+        return None
+
+    def drain(self, limit=None):
+        """Generates the variants submit() left pending, returns how many.
+
+        Every attachment is leased while it renders; one whose drain died
+        is claimed again once the lease passed. A failed one is not
+        retried, `flask generate_variants` picks it up.
+        """
+        drained = 0
+        while limit is None or drained < limit:
+            now = datetime.datetime.utcnow()
+            img = ImageAttachmentModel.objects(variants_pending__lte=now).modify(
+                set__variants_pending=now + datetime.timedelta(seconds=self.lease))
+            if img is None:
+                break
+            self._generate(str(img.id))
+            ImageAttachmentModel.objects(id=img.id).update(unset__variants_pending=True)
+            drained += 1
+        return drained
+
+    def stats(self):
+        return dict(self.counters, workers=self.workers, background=self.background,
+                    timeout=self.timeout, variants=sorted(self.specs))
+
+
+variant_pipeline = VariantPipeline()
+metrics.register('image_variants', variant_pipeline.stats)
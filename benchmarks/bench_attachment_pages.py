@@ -0,0 +1,72 @@
+"""Offset vs cursor pages of the attachment list at growing depth.
+
+    MONGO_HOST=mongodb://localhost python -m benchmarks.bench_attachment_pages
+
+Seeds one user with --attachments attachments and times attachment_page
+at each depth, once skipping with offset and once seeking from the cursor
+of the previous page. Cursor pages should cost the same at any depth.
+"""
+import argparse
+import datetime
+import os
+import time
+import uuid
+
+from mongoengine import connect
+
+from appname.db import ImageAttachmentModel, attachment_page, encode_cursor, \
+    listed_attachments
+
+
+def seed(count):
+    user_id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    ImageAttachmentModel._get_collection().insert_many([
+        dict(user_id=user_id,
+             extension='png',
+             orignal_name='bench{}.png'.format(i),
+             status='uploaded',
+             reg_date=now - datetime.timedelta(seconds=i))
+        for i in range(count)])
+    return user_id
+
+
+def bench(user_id, limit, offset, cursor, loops):
+    started = time.perf_counter()
+    for _ in range(loops):
+        attachment_page(user_id, limit, offset, cursor)
+    return (time.perf_counter() - started) / loops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--attachments', type=int, default=100000)
+    parser.add_argument('--depths', default='0,100,1000,10000,90000')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--loops', type=int, default=50)
+    args = parser.parse_args()
+
+    connect('bench_attachment_pages',
+            host=os.environ.get('MONGO_HOST', 'mongodb://localhost'))
+    ImageAttachmentModel.ensure_indexes()
+    user_id = seed(args.attachments)
+
+    try:
+        print('{:>8} {:>12} {:>12}'.format('depth', 'offset ms', 'cursor ms'))
+        for depth in [int(d) for d in args.depths.split(',')]:
+            cursor = None
+            if depth:
+                # the cursor a client holds after paging down to depth
+                previous = listed_attachments(user_id).order_by(
+                    '-reg_date', '-id')[depth - 1]
+                cursor = encode_cursor(previous)
+            print('{:>8} {:>12.2f} {:>12.2f}'.format(
+                depth,
+                bench(user_id, args.limit, depth, None, args.loops) * 1000,
+                bench(user_id, args.limit, 0, cursor or '', args.loops) * 1000))
+    finally:
+        ImageAttachmentModel.objects(user_id=user_id).delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Image variant rendering throughput against process pool size.
+
+    python -m benchmarks.bench_image_variants --images 40 --workers 0,1,2,4
+
+Renders the IMAGE_VARIANTS of DefaultConfig for synthetic photos of a few
+sizes, the same work VariantPipeline does per upload minus the S3 calls.
+0 workers renders inline, like the lambda setting.
+"""
+import argparse
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from appname.config import DefaultConfig
+from appname.variants import render_variants
+
+
+def photo(width, height, fmt):
+    # noise compresses like a photo, a flat color would flatter the encoder
+    img = Image.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    out = io.BytesIO()
+    img.save(out, fmt, quality=90)
+    return out.getvalue()
+
+
+def run(images, specs, workers):
+    started = time.perf_counter()
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(render_variants, images, [specs] * len(images)))
+    else:
+        for data in images:
+            render_variants(data, specs)
+    return len(images) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--workers', default='0,1,2,4')
+    parser.add_argument('--sizes', default='1024x768,3024x4032',
+                        help='source image sizes, WIDTHxHEIGHT')
+    parser.add_argument('--format', default='JPEG', help='source format')
+    args = parser.parse_args()
+
+    specs = DefaultConfig.IMAGE_VARIANTS
+    print('variants: {}'.format(', '.join(sorted(specs))))
+    print('{:>12} {:>8} {:>12}'.format('source', 'workers', 'images/sec'))
+    for size in args.sizes.split(','):
+        width, height = [int(v) for v in size.split('x')]
+        images = [photo(width, height, args.format)] * args.images
+        for workers in [int(w) for w in args.workers.split(',')]:
+            print('{:>12} {:>8} {:>12.1f}'.format(size, workers, run(images, specs, workers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Logins/sec against password pool size.
+
+    python -m benchmarks.bench_password_pool --clients 16 --seconds 5
+
+Each client thread plays a request thread doing one bcrypt check per
+login, like Login.post with a correct password.
+"""
+import argparse
+import os
+import threading
+import time
+
+from appname.error import InvalidUsage
+from appname.password import PasswordPool, _hashpw
+
+
+def run(pool, hashed, clients, seconds):
+    done = [0]
+    rejected = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            try:
+                pool.check('abcdefg', hashed)
+                with lock:
+                    done[0] += 1
+            except InvalidUsage:
+                with lock:
+                    rejected[0] += 1
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return done[0] / seconds, rejected[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--max-queue', type=int, default=32)
+    parser.add_argument('--sizes', default='0,1,2,4,8')
+    args = parser.parse_args()
+
+    hashed = _hashpw('abcdefg')
+    print('cpus: {}, clients: {}'.format(os.cpu_count(), args.clients))
+    print('{:>8} {:>12} {:>10}'.format('workers', 'logins/sec', 'rejected'))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        pool = PasswordPool(workers=size, max_queue=args.max_queue)
+        # warm up the worker processes before measuring
+        pool.check('abcdefg', hashed)
+        rate, rejected = run(pool, hashed, args.clients, args.seconds)
+        pool.shutdown()
+        print('{:>8} {:>12.1f} {:>10}'.format(size, rate, rejected))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Overhead the rate limiter adds to requests that are not throttled.
+
+    MONGO_HOST=mongodb://localhost python -m benchmarks.bench_ratelimit
+
+Times the full rate_limit decorator around a no-op view inside a request
+context, for each backend, with a bucket that never runs dry. The
+target is well under 1ms per request.
+"""
+import argparse
+import os
+import time
+
+from flask import Flask
+from mongoengine import connect
+
+from appname.ratelimit import rate_limit
+
+
+def bench(app, backend, loops):
+    app.config['RATE_LIMIT_BACKEND'] = backend
+
+    @rate_limit('bench', 10 ** 9, per=1)
+    def view():
+        return None
+
+    def baseline():
+        return None
+
+    timings = {}
+    for name, func in (('none', baseline), (backend, view)):
+        with app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            func()
+            started = time.perf_counter()
+            for _ in range(loops):
+                func()
+            timings[name] = (time.perf_counter() - started) / loops
+    return timings[backend] - timings['none']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loops', type=int, default=20000)
+    parser.add_argument('--backends', default='memory,mongo')
+    args = parser.parse_args()
+
+    connect('bench_ratelimit',
+            host=os.environ.get('MONGO_HOST', 'mongodb://localhost'))
+    app = Flask(__name__)
+    app.config['RATE_LIMIT_ENABLED'] = True
+
+    print('{:>8} {:>14}'.format('backend', 'overhead(us)'))
+    for backend in args.backends.split(','):
+        loops = args.loops if backend == 'memory' else args.loops // 10
+        print('{:>8} {:>14.1f}'.format(backend, bench(app, backend, loops) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""S3 upload throughput across file sizes and transfer settings.
+
+    S3_ENDPOINT_URL=http://localhost:9000 AWS_ACCESS_KEY_ID=minioadmin \\
+    AWS_SECRET_ACCESS_KEY=minioadmin python -m benchmarks.bench_s3_transfer
+
+Runs against any S3 compatible stand-in (minio, `moto_server s3`), never
+against the real attachment bucket. Every file is uploaded the way
+AttachmentList.post does it, from a spooled temporary file with
+upload_fileobj, once inline and once per --concurrency value.
+"""
+import argparse
+import os
+import time
+from tempfile import SpooledTemporaryFile
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+
+def spooled(size):
+    stream = SpooledTemporaryFile(max_size=512 * 1024)
+    chunk = os.urandom(MB)
+    for offset in range(0, size, MB):
+        stream.write(chunk[:min(MB, size - offset)])
+    stream.seek(0)
+    return stream
+
+
+def upload(s3, bucket, stream, config, repeats):
+    best = None
+    for i in range(repeats):
+        stream.seek(0)
+        started = time.perf_counter()
+        s3.upload_fileobj(stream, bucket, 'bench/{}'.format(i), Config=config)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint-url', default=os.environ.get('S3_ENDPOINT_URL'))
+    parser.add_argument('--bucket', default='bench-s3-transfer')
+    parser.add_argument('--sizes', default='1,8,32,128', help='file sizes in MB')
+    parser.add_argument('--concurrency', default='1,4,8')
+    parser.add_argument('--chunk-size', type=int, default=8, help='part size in MB')
+    parser.add_argument('--threshold', type=int, default=8, help='multipart threshold in MB')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    if not args.endpoint_url:
+        parser.error('--endpoint-url or S3_ENDPOINT_URL of an S3 compatible stand-in is required')
+
+    s3 = boto3.client('s3', endpoint_url=args.endpoint_url, region_name='us-east-1')
+    try:
+        s3.create_bucket(Bucket=args.bucket)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    modes = [('inline', dict(use_threads=False))] + [
+        ('threads={}'.format(c), dict(use_threads=True, max_concurrency=int(c)))
+        for c in args.concurrency.split(',')]
+
+    print('{:>8} {:>12} {:>10} {:>10}'.format('size(MB)', 'mode', 'sec', 'MB/s'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        stream = spooled(size * MB)
+        for name, settings in modes:
+            config = TransferConfig(
+                multipart_threshold=args.threshold * MB,
+                multipart_chunksize=args.chunk_size * MB,
+                **settings)
+            elapsed = upload(s3, args.bucket, stream, config, args.repeats)
+            print('{:>8} {:>12} {:>10.2f} {:>10.1f}'.format(
+                size, name, elapsed, size / elapsed))
+        stream.close()
+
+
+if __name__ == '__main__':
+    main()
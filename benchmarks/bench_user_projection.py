@@ -0,0 +1,79 @@
+"""Full vs projected UserModel loads.
+
+    MONGO_HOST=mongodb://localhost python -m benchmarks.bench_user_projection
+
+Loads one user with a realistic number of devices and prefer_scents,
+once per field set in appname.db.USER_FIELDS, and reports time per load
+and bytes on the wire.
+"""
+import argparse
+import os
+import time
+import uuid
+
+import bson
+from mongoengine import connect
+
+from appname.db import UserModel, USER_FIELDS, load_user
+
+
+def seed(devices, scents):
+    user_id = str(uuid.uuid4())
+    UserModel(
+        user_id=user_id,
+        email='{}@bench.example.com'.format(user_id),
+        password='$2b$12$' + 'x' * 53,
+        name='bench user',
+        gender='female',
+        picture='https://example.com/' + 'p' * 80,
+        devices={'device-{}'.format(i): 'living room {}'.format(i) for i in range(devices)},
+        prefer_scents=['scent-{}'.format(i) for i in range(scents)],
+        place='home',
+        space='living room',
+        purpose='relax'
+    ).save()
+    return user_id
+
+
+def wire_size(user_id, fields):
+    projection = None
+    if fields is not None:
+        projection = {name: 1 for name in USER_FIELDS[fields]}
+    doc = UserModel._get_collection().find_one({'user_id': user_id}, projection)
+    return len(bson.BSON.encode(doc))
+
+
+def bench(user_id, fields, loops):
+    started = time.perf_counter()
+    for _ in range(loops):
+        load_user(fields, user_id=user_id)
+    return (time.perf_counter() - started) / loops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--loops', type=int, default=2000)
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--scents', type=int, default=30)
+    args = parser.parse_args()
+
+    connect('bench_user_projection',
+            host=os.environ.get('MONGO_HOST', 'mongodb://localhost'))
+    user_id = seed(args.devices, args.scents)
+
+    try:
+        baseline = bench(user_id, None, args.loops)
+        print('{:>8} {:>10} {:>8} {:>8}'.format('fields', 'us/load', 'bytes', 'speedup'))
+        for fields in [None] + sorted(USER_FIELDS):
+            per_load = baseline if fields is None else bench(user_id, fields, args.loops)
+            print('{:>8} {:>10.1f} {:>8} {:>7.2f}x'.format(
+                fields or 'full',
+                per_load * 1e6,
+                wire_size(user_id, fields),
+                baseline / per_load))
+    finally:
+        UserModel.objects(user_id=user_id).delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""UserModel Documents vs slotted UserRecords on the read path.
+
+    MONGO_HOST=mongodb://localhost python -m benchmarks.bench_user_record
+
+Seeds --users users, then builds every one of them through mongoengine
+and through raw pymongo + UserRecord. Reports objects/sec and the
+retained memory per object.
+"""
+import argparse
+import os
+import time
+import tracemalloc
+import uuid
+
+from mongoengine import connect
+
+from appname.db import UserModel, UserRecord, USER_FIELDS
+
+
+def seed(users):
+    batch = str(uuid.uuid4())
+    UserModel.objects.insert([
+        UserModel(
+            user_id='{}-{}'.format(batch, i),
+            email='{}-{}@bench.example.com'.format(batch, i),
+            name='bench user {}'.format(i),
+            gender='female',
+            picture='https://example.com/p/{}'.format(i),
+            devices={'device-{}'.format(d): 'room {}'.format(d) for d in range(5)},
+            prefer_scents=['lemon', 'lavender'])
+        for i in range(users)
+    ], load_bulk=False)
+    return batch
+
+
+def documents(batch, fields):
+    return list(UserModel.objects(user_id__startswith=batch).only(*fields))
+
+
+def records(batch, fields):
+    projection = dict.fromkeys(fields, 1)
+    projection['_id'] = 0
+    cursor = UserModel._get_collection().find(
+        {'user_id': {'$regex': '^' + batch}}, projection)
+    return [UserRecord(doc) for doc in cursor]
+
+
+def measure(load, batch, fields):
+    started = time.perf_counter()
+    result = load(batch, fields)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = load(batch, fields)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # marshall output must stay the same whichever path built the object
+    assert [x.marshall() for x in kept[:10]] == [x.marshall() for x in result[:10]]
+    return len(result) / elapsed, (after - before) / len(kept)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--fields', default='profile', choices=sorted(USER_FIELDS))
+    args = parser.parse_args()
+
+    connect('bench_user_record',
+            host=os.environ.get('MONGO_HOST', 'mongodb://localhost'))
+    batch = seed(args.users)
+    fields = USER_FIELDS[args.fields]
+
+    try:
+        print('{:>10} {:>12} {:>14}'.format('path', 'objects/sec', 'bytes/object'))
+        for name, load in (('document', documents), ('record', records)):
+            rate, size = measure(load, batch, fields)
+            print('{:>10} {:>12.0f} {:>14.0f}'.format(name, rate, size))
+    finally:
+        UserModel.objects(user_id__startswith=batch).delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,16 @@ from tests.kakao import KakaoTest
 from tests.facebook import FacebookTest
 from tests.example-aws-s3 import S3Test
 from tests.example-aws-ses import SesTest
+from tests.commands import ImportUsersTest, MigrateUserIndexesTest
+from tests.bloom import BloomFilterTest, EmailFilterTest
+from tests.ratelimit import RateLimitTest
+from tests.admission import AdmissionTest
+from tests.outbox import OutboxTest
+from tests.report import ExceptionReportTest
+from tests.httpclient import HttpClientTest
+from tests.social import VerifiedTokensTest
+from tests.breaker import CircuitBreakerTest
+from tests.variants import VariantTest
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,40 @@
+from tests.common import BaseTest
+from deepscent.db import UserModel
+from deepscent.admission import Admission, admission
+
+class AdmissionTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.budgets = admission.budgets
+
+    def tearDown(self):
+        admission.configure(budgets=self.budgets)
+        try:
+            UserModel.objects.get(email='abc1@abcmart.com').delete()
+        except UserModel.DoesNotExist:
+            pass
+
+    def test_budget(self):
+        control = Admission(budgets=dict(heavy=2))
+        self.assertTrue(control.enter('heavy'))
+        self.assertTrue(control.enter('heavy'))
+        self.assertFalse(control.enter('heavy'))
+        self.assertTrue(control.enter('cheap'))
+
+        control.leave('heavy')
+        self.assertTrue(control.enter('heavy'))
+        self.assertEqual(control.stats()['heavy']['rejected'], 1)
+        self.assertEqual(control.stats()['heavy']['in_flight'], 2)
+
+    def test_heavy_class_shed(self):
+        rv = self.client.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+        admission.configure(budgets=dict(bcrypt=0))
+        rv = self.client.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], str(admission.retry_after))
+
+        rv = self.client.get('/user/exists', data=dict(email='abc1@abcmart.com'))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(admission.in_flight['bcrypt'], 0)
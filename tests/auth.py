@@ -1,12 +1,18 @@
+import threading
 from unittest.mock import patch
 from tests.common import BaseTest
-from deepscent.db import UserModel, drop_all_collection
+from deepscent.db import UserModel, SessionModel, OutboxModel, drop_all_collection, \
+    load_user, find_user_record
+from deepscent.auth import token_cache, password_pool, email_filter
+from deepscent.outbox import outbox
+from deepscent.password import PasswordPool
 from flask import json
-from datetime import datetime
+from datetime import datetime, timedelta
 
 class AuthTest(BaseTest):
     def setUp(self):
         super().setUp()
+        OutboxModel.objects.delete()
         try:
             UserModel.objects.get(email='abc1@abcmart.com').delete()
             UserModel.objects.get(email='abc2@abcmart.com').delete()
@@ -25,6 +31,20 @@ class AuthTest(BaseTest):
         rv2 = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='1234567'))
         self.assertEqual(rv2.status_code, 403)
 
+    def test_signup_single_insert(self):
+        rv = self.app.post('/auth/signup', data=dict(email='abc2@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+        with self.count_commands() as commands:
+            rv = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(commands, ['insert'])
+
+        with self.count_commands() as commands:
+            rv = self.app.post('/auth/signup', data=dict(email='ABC1@abcmart.com', pwd='1234567'))
+            self.assertEqual(rv.status_code, 403)
+        self.assertEqual(commands, ['insert'])
+
     def test_signup_fail2(self):
         rv1 = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd=''))
         self.assertEqual(rv1.status_code, 400)
@@ -50,6 +70,21 @@ class AuthTest(BaseTest):
         rv = self.app.post('/auth/login', data=dict(email='abc2@abcmart.com', pwd='abcdefg'))
         self.assertEqual(rv.status_code, 403)
 
+    def test_login_password_pool_saturated(self):
+        rv_prev = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev.status_code, 200)
+
+        max_queue = password_pool.max_queue
+        password_pool.configure(max_queue=0)
+        try:
+            rv = self.app.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+            self.assertEqual(rv.status_code, 503)
+        finally:
+            password_pool.configure(max_queue=max_queue)
+
+        rv = self.app.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
     def test_logout(self):
         rv_prev1 = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
         self.assertEqual(rv_prev1.status_code, 200)
@@ -66,6 +101,109 @@ class AuthTest(BaseTest):
                                 headers={'Authorization': '{}'.format(auth_token)})
         self.assertEqual(rv_next.status_code, 401)
 
+    def test_token_cache(self):
+        rv_prev1 = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev1.status_code, 200)
+
+        rv_prev2 = self.app.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev2.status_code, 200)
+
+        token_cache.clear()
+        headers = {'Authorization': '{}'.format(json.loads(rv_prev2.data)['auth_token'])}
+        rv = self.app.get('/auth/tokenvalidate', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(token_cache.misses, 1)
+
+        with patch('deepscent.auth.UserModel.objects') as mock:
+            rv = self.app.get('/auth/tokenvalidate', headers=headers)
+            self.assertEqual(rv.status_code, 200)
+            self.assertFalse(mock.called)
+        self.assertEqual(token_cache.hits, 1)
+
+        rv = self.app.post('/auth/logout', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.app.get('/auth/tokenvalidate', headers=headers)
+        self.assertEqual(rv.status_code, 401)
+
+    def test_multi_session(self):
+        rv_prev = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev.status_code, 200)
+
+        rv1 = self.app.post('/auth/login', data=dict(
+            email='abc1@abcmart.com', pwd='abcdefg', device='phone'))
+        self.assertEqual(rv1.status_code, 200)
+        rv2 = self.app.post('/auth/login', data=dict(
+            email='abc1@abcmart.com', pwd='abcdefg', device='tablet'))
+        self.assertEqual(rv2.status_code, 200)
+
+        user_id = UserModel.objects.get(email='abc1@abcmart.com').user_id
+        self.assertEqual(SessionModel.objects(user_id=user_id).count(), 2)
+
+        headers1 = {'Authorization': rv1.json['auth_token']}
+        headers2 = {'Authorization': rv2.json['auth_token']}
+        self.assertEqual(self.app.get('/auth/tokenvalidate', headers=headers1).status_code, 200)
+        self.assertEqual(self.app.get('/auth/tokenvalidate', headers=headers2).status_code, 200)
+
+        rv = self.app.post('/auth/logout', headers=headers1)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.app.get('/auth/tokenvalidate', headers=headers1).status_code, 401)
+        self.assertEqual(self.app.get('/auth/tokenvalidate', headers=headers2).status_code, 200)
+        self.assertEqual(SessionModel.objects(user_id=user_id).count(), 1)
+
+    def test_token_endpoints_mongo_commands(self):
+        email = 'abc1@abcmart.com'
+        rv = self.app.post('/auth/signup', data=dict(email=email, pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+        token_cache.clear()
+
+        with self.count_commands() as commands:
+            rv = self.app.post('/auth/login', data=dict(email=email, pwd='abcdefg'))
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(commands, ['find', 'insert'])
+
+        with self.count_commands() as commands:
+            rv = self.app.post('/auth/refresh_token',
+                               headers={'Authorization': rv.json['auth_token']},
+                               data=dict(refresh_token=rv.json['refresh_token']))
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(commands, ['findAndModify'])
+
+        with self.count_commands() as commands:
+            rv = self.app.post('/auth/logout',
+                               headers={'Authorization': rv.json['auth_token']})
+            self.assertEqual(rv.status_code, 200)
+        # session lookup in check_auth + one write
+        self.assertEqual(commands, ['find', 'delete'])
+
+    def test_login_loads_login_fields_only(self):
+        rv = self.app.post('/auth/signup', data=dict(
+            email='abc1@abcmart.com', pwd='abcdefg', name='TestAuthor',
+            prefer_scents=['lemon', 'lavender']))
+        self.assertEqual(rv.status_code, 200)
+
+        with patch('deepscent.auth.load_user', wraps=load_user) as mock:
+            rv = self.app.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+            self.assertEqual(rv.status_code, 200)
+            mock.assert_called_once_with('login', email='abc1@abcmart.com')
+
+        user = load_user('login', email='abc1@abcmart.com')
+        self.assertIsNotNone(user.password)
+        self.assertIsNone(user.name)
+        self.assertEqual(user.prefer_scents, [])
+
+    def test_user_record_marshall(self):
+        rv = self.app.post('/auth/signup', data=dict(
+            email='abc1@abcmart.com', pwd='abcdefg', name='TestAuthor',
+            gender='female', birthday='1990-01-01T00:00:00'))
+        self.assertEqual(rv.status_code, 200)
+
+        document = load_user('profile', email='abc1@abcmart.com')
+        record = find_user_record('profile', email='abc1@abcmart.com')
+        self.assertEqual(record.marshall(), document.marshall())
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertIsNone(find_user_record('exists', email='abc2@abcmart.com'))
+
     def test_user_info(self):
         rv_prev1 = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
         self.assertEqual(rv_prev1.status_code, 200)
@@ -192,9 +330,20 @@ class AuthTest(BaseTest):
         self.assertEqual(rv.status_code, 200)
 
         with patch('deepscent.apitools.email_client.send_email') as mock:
-            mock.side_effect = Exception()
+            mock.side_effect = Exception('ses is down')
             rv = self.app.post('/auth/reset_password', data=dict(email=email))
-            self.assertEqual(rv.status_code, 500)
+            # the request does not wait for SES, the dispatcher retries later
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(outbox.dispatch(), 1)
+
+        message = OutboxModel.objects.get(to=email)
+        self.assertEqual(message.status, 'pending')
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(message.last_error, 'ses is down')
+        self.assertGreater(message.next_attempt_at, datetime.utcnow())
+        # removed with the temporary password it carries
+        self.assertEqual(message.expire_at, message.deadline)
+        self.assertLess(message.deadline, datetime.utcnow() + timedelta(minutes=11))
 
     def test_reset_password_succeed(self):
         email = 'abc1@abcmart.com'
@@ -206,6 +355,8 @@ class AuthTest(BaseTest):
             mock.return_value = None
             rv = self.app.post('/auth/reset_password', data=dict(email=email))
             self.assertEqual(rv.status_code, 200)
+            self.assertEqual(outbox.dispatch(), 1)
+            self.assertEqual(mock.call_args[1]['Destination']['ToAddresses'], [email])
 
             user = UserModel.objects(email=email).get()
             self.assertIsNotNone(user.tmp_password)
@@ -223,3 +374,72 @@ class AuthTest(BaseTest):
         rv = self.app.get('/user/exists', data=dict(email="abc1@abcmart.com"))
         self.assertEqual(rv.json['exists'], False)
 
+    def test_login_rehash_password(self):
+        email = 'abc1@abcmart.com'
+        rv = self.app.post('/auth/signup', data=dict(email=email, pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+        old_hash = UserModel.objects.get(email=email).password
+
+        rounds = password_pool.rounds
+        password_pool.configure(rounds=rounds + 1)
+        try:
+            rv = self.app.post('/auth/login', data=dict(email=email, pwd='abcdefg'))
+            self.assertEqual(rv.status_code, 200)
+            # background rehash runs on a single thread, wait for it
+            password_pool._background.submit(lambda: None).result(timeout=10)
+        finally:
+            password_pool.configure(rounds=rounds)
+
+        new_hash = UserModel.objects.get(email=email).password
+        self.assertNotEqual(old_hash, new_hash)
+        self.assertTrue(new_hash.startswith('$2b${:02d}$'.format(rounds + 1)))
+
+        rv = self.app.post('/auth/login', data=dict(email=email, pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+    def test_rehash_queue_bounded(self):
+        pool = PasswordPool(rounds=4, rehash_queue=1)
+        started, release = threading.Event(), threading.Event()
+        saved = []
+
+        def save_when_released(new_hash):
+            started.set()
+            release.wait(10)
+            saved.append(new_hash)
+
+        first = pool.rehash_later('abcdefg', save_when_released)
+        self.assertTrue(started.wait(10))
+        # the queue is full, skipped rather than holding another password
+        self.assertIsNone(pool.rehash_later('abcdefg', saved.append))
+        release.set()
+        first.result(timeout=10)
+        self.assertEqual(len(saved), 1)
+        self.assertEqual(pool.stats()['rehash_skipped'], 1)
+
+        def broken_save(new_hash):
+            raise RuntimeError('mongo is down')
+        with self.assertLogs(level='ERROR'):
+            pool.rehash_later('abcdefg', broken_save).result(timeout=10)
+        self.assertEqual(pool.stats()['rehash_failed'], 1)
+
+    def test_rehash_inline(self):
+        pool = PasswordPool(rounds=4, background=False)
+        saved = []
+        # lambda freezes threads after the response, nothing is left queued
+        self.assertIsNone(pool.rehash_later('abcdefg', saved.append))
+        self.assertTrue(saved[0].startswith('$2b$04$'))
+
+    def test_user_exists_filter(self):
+        email_filter.rebuild()
+
+        with self.count_commands() as commands:
+            rv = self.app.get('/user/exists', data=dict(email="abc1@abcmart.com"))
+            self.assertEqual(rv.json['exists'], False)
+        self.assertEqual(commands, [])
+
+        rv = self.app.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.app.get('/user/exists', data=dict(email="ABC1@abcmart.com"))
+        self.assertEqual(rv.json['exists'], True)
+        self.assertIsNotNone(email_filter.stats()['estimated_fp_rate'])
@@ -0,0 +1,96 @@
+import datetime
+import unittest
+from bson import ObjectId
+from deepscent.bloom import BloomFilter, EmailFilter
+
+
+class FakeUsers(object):
+    """collection stand-in returning every user whatever the query"""
+    def __init__(self):
+        self.docs = []
+        self.queries = []
+        self.broken = False
+
+    def count(self):
+        if self.broken:
+            raise Exception('mongo is down')
+        return len(self.docs)
+
+    def find(self, query, projection):
+        self.queries.append(query)
+        return self
+
+    def batch_size(self, size):
+        return list(self.docs)
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        emails = ['user{}@abcmart.com'.format(i) for i in range(1000)]
+        for email in emails:
+            bloom.add(email)
+
+        self.assertTrue(all(email in bloom for email in emails))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add('user{}@abcmart.com'.format(i))
+
+        misses = sum('other{}@abcmart.com'.format(i) in bloom for i in range(10000))
+        self.assertLess(misses / 10000, 0.03)
+        self.assertAlmostEqual(bloom.estimated_fp_rate(), 0.01, delta=0.005)
+
+
+class EmailFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.users = FakeUsers()
+        self.now = 100.0
+        self.wall = datetime.datetime(2018, 1, 4, 14, 0)
+        self.filter = EmailFilter(lambda: self.users, capacity=100,
+                                  sync_interval=30, sync_overlap=300,
+                                  timer=lambda: self.now, clock=lambda: self.wall)
+
+    def test_sync_rescans_trailing_window(self):
+        self.users.docs = [dict(_id=ObjectId(), email='a@abcmart.com')]
+        self.filter.rebuild()
+        self.users.docs.append(dict(_id=ObjectId(), email='B@abcmart.com'))
+
+        self.wall += datetime.timedelta(seconds=30)
+        self.filter.sync()
+        since = self.users.queries[-1]['_id']['$gte'].generation_time.replace(tzinfo=None)
+        self.assertEqual(since, datetime.datetime(2018, 1, 4, 13, 55))
+        self.assertTrue(self.filter.might_contain('b@abcmart.com'))
+
+        self.filter.sync()
+        since = self.users.queries[-1]['_id']['$gte'].generation_time.replace(tzinfo=None)
+        self.assertEqual(since, datetime.datetime(2018, 1, 4, 13, 55, 30))
+        # users seen again are not counted again
+        self.assertEqual(self.filter.stats()['count'], 2)
+
+    def test_failed_build_is_retried(self):
+        self.users.broken = True
+        with self.assertRaises(Exception):
+            self.filter.rebuild()
+        self.assertTrue(self.filter.might_contain('a@abcmart.com'))
+
+        self.users.broken = False
+        self.users.docs = [dict(_id=ObjectId(), email='a@abcmart.com')]
+        self.now += 30
+        self.filter.maybe_refresh()
+        self.filter._worker.join()
+        self.assertTrue(self.filter.stats()['ready'])
+        self.assertFalse(self.filter.might_contain('c@abcmart.com'))
+
+    def test_lazy_build_on_first_use(self):
+        self.users.docs = [dict(_id=ObjectId(), email='a@abcmart.com')]
+        # not lazy, nothing is built until start()
+        self.assertTrue(self.filter.might_contain('c@abcmart.com'))
+        self.assertIsNone(self.filter._worker)
+
+        self.filter.configure(lazy=True)
+        self.assertTrue(self.filter.might_contain('c@abcmart.com'))
+        self.filter._worker.join()
+        self.assertFalse(self.filter.might_contain('c@abcmart.com'))
+        self.assertTrue(self.filter.might_contain('a@abcmart.com'))
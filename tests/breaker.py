@@ -0,0 +1,116 @@
+from tests.common import BaseTest, StubServer
+from deepscent.error import InvalidUsage
+from deepscent.breaker import CircuitBreaker, GuardedClient, OPEN, CLOSED, HALF_OPEN
+from deepscent.httpclient import HttpClient
+from deepscent import breaker as breaker_module
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class ClientError(Exception):
+    def __init__(self, status):
+        self.response = dict(ResponseMetadata=dict(HTTPStatusCode=status))
+
+
+class StandInClient(object):
+    """boto3 client stand-in whose calls fail or take `latency` clock seconds"""
+    region = 'ap-northeast-2'
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.error = None
+        self.latency = 0
+        self.calls = 0
+
+    def get_thing_shadow(self, thingName):
+        self.calls += 1
+        self.clock.now += self.latency
+        if self.error is not None:
+            raise self.error
+        return dict(thingName=thingName)
+
+
+class CircuitBreakerTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.breaker = CircuitBreaker('iot', window=30, min_calls=4, error_rate=0.5,
+                                      slow_call=2, open_for=10, probes=2, timer=self.clock)
+        self.stand_in = StandInClient(self.clock)
+        self.client = GuardedClient(self.stand_in, self.breaker)
+
+    def fail(self, times, error=None):
+        self.stand_in.error = error or Exception('connection reset')
+        for _ in range(times):
+            with self.assertRaises(Exception):
+                self.client.get_thing_shadow(thingName='dev1')
+        self.stand_in.error = None
+
+    def test_open_fails_fast(self):
+        self.assertEqual(self.client.region, 'ap-northeast-2')
+        self.client.get_thing_shadow(thingName='dev1')
+        self.client.get_thing_shadow(thingName='dev1')
+        self.fail(2)
+        self.assertEqual(self.breaker.state, OPEN)
+
+        calls = self.stand_in.calls
+        with self.assertRaises(InvalidUsage) as ctx:
+            self.client.get_thing_shadow(thingName='dev1')
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertEqual(ctx.exception.headers['Retry-After'], '10')
+        self.assertEqual(self.stand_in.calls, calls)
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+
+    def test_half_open_probes(self):
+        self.fail(4)
+        self.clock.now += 10
+
+        self.client.get_thing_shadow(thingName='dev1')
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.client.get_thing_shadow(thingName='dev1')
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        self.fail(4)
+        self.clock.now += 10
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats()['opened'], 3)
+
+    def test_slow_calls_and_client_errors(self):
+        # a missing shadow is the caller's problem, not the dependency's
+        self.fail(4, ClientError(404))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+        self.stand_in.latency = 3
+        for _ in range(4):
+            self.client.get_thing_shadow(thingName='dev1')
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_window_forgets_old_failures(self):
+        self.fail(3)
+        self.clock.now += 31
+        self.client.get_thing_shadow(thingName='dev1')
+        self.fail(1)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_http_provider(self):
+        server = StubServer({'/user/me': [(500, {})]})
+        http = HttpClient(retries=0)
+        breaker_module.breakers['stub'] = CircuitBreaker('stub', min_calls=3, open_for=60)
+        try:
+            for _ in range(3):
+                self.assertEqual(http.get('stub', server.url + '/user/me').status_code, 500)
+            with self.assertRaises(InvalidUsage) as ctx:
+                http.get('stub', server.url + '/user/me')
+            self.assertEqual(ctx.exception.status_code, 503)
+            self.assertEqual(len(server.requests), 3)
+        finally:
+            del breaker_module.breakers['stub']
+            http.close()
+            server.stop()
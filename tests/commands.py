@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+from tests.common import BaseTest
+from deepscent.app import app
+from deepscent.db import UserModel
+from deepscent.commands import import_users, migrate_user_indexes
+
+class ImportUsersTest(BaseTest):
+    emails = ['import1@abcmart.com', 'import2@abcmart.com', 'import3@abcmart.com']
+
+    def setUp(self):
+        super().setUp()
+        UserModel.objects(email__in=self.emails).delete()
+
+    def tearDown(self):
+        UserModel.objects(email__in=self.emails).delete()
+
+    def run_import(self, lines, suffix, *args):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as f:
+            f.write('\n'.join(lines) + '\n')
+        try:
+            return CliRunner().invoke(
+                import_users, [f.name, '--workers', '1', '--batch-size', '2', *args],
+                obj=ScriptInfo(create_app=lambda info: app))
+        finally:
+            os.remove(f.name)
+
+    def test_import_jsonl(self):
+        rv = self.run_import([
+            json.dumps(dict(email='Import1@abcmart.com', pwd='abcdefg', name='one')),
+            json.dumps(dict(email='not-an-email', pwd='abcdefg')),
+            json.dumps(dict(email='import2@abcmart.com', pwd='abcdefg')),
+            json.dumps(dict(email='import1@abcmart.com', pwd='abcdefg')),
+            json.dumps(dict(email='import3@abcmart.com', pwd='abcdefg',
+                            prefer_scents=['lemon'])),
+        ], '.jsonl', '--no-validate-pw')
+        self.assertEqual(rv.exit_code, 0, rv.output)
+
+        failures = [json.loads(line) for line in rv.output.splitlines()
+                    if line.startswith('{')]
+        self.assertEqual([x['line'] for x in failures], [2, 4])
+        self.assertEqual(UserModel.objects(email__in=self.emails).count(), 3)
+
+        rv = self.client.post('/auth/login', data=dict(email='import1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+    def test_import_jsonl_malformed_lines(self):
+        rv = self.run_import([
+            json.dumps(dict(email='import1@abcmart.com', pwd='abcdefg')),
+            '{"email": "import2@abcmart.com",',
+            json.dumps(['import2@abcmart.com', 'abcdefg']),
+            json.dumps(dict(email='import3@abcmart.com', pwd='abcdefg')),
+        ], '.jsonl', '--no-validate-pw')
+        self.assertEqual(rv.exit_code, 0, rv.output)
+
+        failures = [json.loads(line) for line in rv.output.splitlines()
+                    if line.startswith('{')]
+        self.assertEqual([x['line'] for x in failures], [2, 3])
+        self.assertEqual(UserModel.objects(email__in=self.emails).count(), 2)
+
+    def test_import_jsonl_wrong_types(self):
+        rv = self.run_import([
+            json.dumps(dict(email=123, pwd='abcdefg')),
+            json.dumps(dict(email='import1@abcmart.com', pwd=1234567)),
+            json.dumps(dict(email='import2@abcmart.com', pwd='abcdefg', prefer_scents='lemon')),
+            json.dumps(dict(email='import3@abcmart.com', pwd='abcdefg')),
+        ], '.jsonl', '--no-validate-pw')
+        self.assertEqual(rv.exit_code, 0, rv.output)
+
+        failures = [json.loads(line) for line in rv.output.splitlines()
+                    if line.startswith('{')]
+        self.assertEqual([x['line'] for x in failures], [1, 2, 3])
+        self.assertEqual(UserModel.objects(email__in=self.emails).count(), 1)
+
+    def test_import_csv(self):
+        rv = self.run_import([
+            'email,pwd,name,prefer_scents',
+            'import1@abcmart.com,abcdefg,one,lemon;lavender',
+            'import2@abcmart.com,,two,',
+        ], '.csv', '--no-validate-pw')
+        self.assertEqual(rv.exit_code, 0, rv.output)
+
+        user = UserModel.objects.get(email='import1@abcmart.com')
+        self.assertEqual(user.prefer_scents, ['lemon', 'lavender'])
+        self.assertIsNone(UserModel.objects(email='import2@abcmart.com').first())
+
+
+class MigrateUserIndexesTest(BaseTest):
+    def test_rebuilds_plain_kakao_index(self):
+        collection = UserModel._get_collection()
+        collection.drop_index('kakao_id_1')
+        # as created by deployments before kakao_id became unique
+        collection.create_index('kakao_id', name='kakao_id_1')
+
+        rv = CliRunner().invoke(migrate_user_indexes,
+                                obj=ScriptInfo(create_app=lambda info: app))
+        self.assertEqual(rv.exit_code, 0, rv.output)
+        index = collection.index_information()['kakao_id_1']
+        self.assertTrue(index['unique'])
+        self.assertTrue(index['sparse'])
@@ -1,5 +1,31 @@
 import unittest
 import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from pymongo import monitoring
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+# must be registered before the app opens its mongo connection
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
 from appname.app import app
 from flask.testing import  FlaskClient
 from flask import Response as BaseResponse
@@ -23,9 +49,18 @@ app.test_client_class = TestClient
 class BaseTest(unittest.TestCase):
     def setUp(self):
         app.testing = True
+        app.config['RATE_LIMIT_ENABLED'] = False
         self.app = app.test_client()
         self.client = self.app
 
+    @contextmanager
+    def count_commands(self):
+        """collects the names of mongo commands issued inside the block"""
+        commands = []
+        start = len(command_counter.commands)
+        yield commands
+        commands.extend(command_counter.commands[start:])
+
     def signup_login(self, email):
         pw = 'asdfsaf'
         rv = self.client.post('/auth/signup',
@@ -36,3 +71,57 @@ class BaseTest(unittest.TestCase):
 
         return rv.json
 
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local keep-alive http server standing in for a provider api.
+
+    routes maps a path to a list of (status, json body) answered in turn,
+    the last one repeating. Requests are recorded as (path, query) and the
+    client ports seen tell how many connections were opened.
+    """
+    daemon_threads = True
+
+    def __init__(self, routes):
+        self.routes = {path: list(answers) for path, answers in routes.items()}
+        self.requests = []
+        self.ports = set()
+        self.delay = 0
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append((url.path, parse_qs(url.query)))
+        self.server.ports.add(self.client_address[1])
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        answers = self.server.routes.get(url.path, [(404, {})])
+        status, body = answers.pop(0) if len(answers) > 1 else answers[0]
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        # drain the body so the connection can be kept alive
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
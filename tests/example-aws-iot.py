@@ -295,3 +295,42 @@ class DeviceTest(BaseTest):
                                headers={'Authorization': '{}'.format(auth_token)})
             self.assertEqual(rv.status_code, 401)
 
+
+    def test_device_rename_raw_key(self):
+        rv_prev1 = self.app.post('/auth/signup', data=dict(email='abc7@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev1.status_code, 200)
+
+        rv_prev2 = self.app.post('/auth/login', data=dict(email='abc7@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv_prev2.status_code, 200)
+
+        auth_token = json.loads(rv_prev2.data)['auth_token']
+        device_id = 'arom__kitchen'
+
+        user = UserModel.objects.get(email='abc7@abcmart.com')
+        state['reported']['owner_id'] = user.user_id
+
+        with patch('deepscent.device.iot_client', MockIotClient(state)):
+            rv_prev3 = self.app.post('/devices/' + device_id + '/register',
+                                     headers={'Authorization': '{}'.format(auth_token)})
+            self.assertEqual(rv_prev3.status_code, 200)
+            rv = self.app.post('/devices/' + device_id + '/state',
+                               data=dict(state=json.dumps(dict(name='Kitchen'))),
+                               headers={'Authorization': '{}'.format(auth_token)})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(json.loads(rv.data)['name'], 'Kitchen')
+
+            user.reload()
+            self.assertEqual(user.devices, {device_id: 'Kitchen'})
+
+        with patch('deepscent.device.iot_client') as iot:
+            rv = self.app.post('/devices/arom.kitchen/register',
+                               headers={'Authorization': '{}'.format(auth_token)})
+            self.assertEqual(rv.status_code, 400)
+            rv = self.app.post('/devices/arom$kitchen/state',
+                               data=dict(state=json.dumps(dict(name='Kitchen'))),
+                               headers={'Authorization': '{}'.format(auth_token)})
+            self.assertEqual(rv.status_code, 400)
+            # rejected before iot is asked about the thing
+            self.assertEqual(iot.mock_calls, [])
+
+        user.delete()
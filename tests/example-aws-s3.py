@@ -1,7 +1,13 @@
 from tests.common import BaseTest
+from deepscent.app import app
+from deepscent import attachment
 from unittest.mock import Mock, patch
-from deepscent.db import ImageAttachmentModel, drop_all_collection, UserModel
-from io import StringIO
+from deepscent.db import ImageAttachmentModel, ImageBlobModel, drop_all_collection, UserModel
+from io import BytesIO
+import datetime
+import hashlib
+
+PNG_HEADER = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR'
 
 class AttachmentTest(BaseTest):
     def setUp(self):
@@ -11,18 +17,19 @@ class AttachmentTest(BaseTest):
             UserModel.objects.get(email='abc2@abcmart.com').delete()
         except UserModel.DoesNotExist:
             pass
+        ImageBlobModel.drop_collection()
 
         email = 'abc1@abcmart.com'
         token = self.signup_login(email)
         self.auth = token['auth_token']
         self.headers = {'Authorization': '{}'.format(self.auth)}
 
-    def upload_image(self, image_name):
+    def upload_image(self, image_name, content=PNG_HEADER, headers=None):
         rv = self.client.post(
             '/attachments',
-            headers=self.headers,
+            headers=headers or self.headers,
             data = {
-                'image': (StringIO(''), image_name)
+                'image': (BytesIO(content), image_name)
             }
         )
         return rv
@@ -57,14 +64,77 @@ class AttachmentTest(BaseTest):
         self.assertEqual(rv2.json['total_size'], 30)
         self.assertEqual(rv.json['attachments'][5:], rv2.json['attachments'][:5])
 
+    def test_attachment_list_cursor(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            for i in range(0, 25):
+                rv = self.upload_image("test%i.png" % i)
+                self.assertEqual(rv.status_code, 200)
+
+        rv = self.client.get('/attachments?limit=25', headers=self.headers)
+        uploaded = [a['id'] for a in rv.json['attachments']]
+        self.assertNotIn('next_cursor', rv.json)
+
+        ids = []
+        url = '/attachments?limit=10&cursor='
+        while True:
+            rv = self.client.get(url, headers=self.headers)
+            self.assertEqual(200, rv.status_code)
+            # the cursor mode does not count
+            self.assertNotIn('total_size', rv.json)
+            ids.extend(a['id'] for a in rv.json['attachments'])
+            if rv.json['next_cursor'] is None:
+                break
+            self.assertEqual(len(rv.json['attachments']), 10)
+            url = '/attachments?limit=10&cursor=' + rv.json['next_cursor']
+
+        # newest first by cursor, insertion order by offset as before
+        self.assertEqual(ids, uploaded[::-1])
+        rv = self.client.get('/attachments?limit=10&offset=10', headers=self.headers)
+        self.assertEqual([a['id'] for a in rv.json['attachments']], uploaded[10:20])
+        self.assertEqual(rv.json['total_size'], 25)
+
+    def test_attachment_list_invalid_cursor(self):
+        rv = self.client.get('/attachments?cursor=nonsense', headers=self.headers)
+        self.assertEqual(400, rv.status_code)
+
 
     def test_attachment_upload_invalid_file_type(self):
         with patch('deepscent.attachment.s3.upload_fileobj') as mock:
             mock.side_effect = None
-            rv = self.upload_image("test.txt")
+            rv = self.upload_image("test.txt", b'plain text')
 
             self.assertEqual(rv.status_code, 400)
 
+    def test_attachment_upload_sniffs_type(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            mock.return_value = None
+            # a png named and declared as jpg is stored as png
+            rv = self.client.post('/attachments', headers=self.headers, data={
+                'image': (BytesIO(PNG_HEADER), 'photo.jpg', 'image/jpeg')})
+            self.assertEqual(rv.status_code, 200)
+            self.assertTrue(rv.json['url'].endswith('.png'))
+            self.assertEqual(mock.call_args[1]['ExtraArgs']['ContentType'], 'image/png')
+
+            rv = self.client.post('/attachments', headers=self.headers, data={
+                'image': (BytesIO(b'<html>'), 'fake.png', 'image/png')})
+            self.assertEqual(rv.status_code, 400)
+
+    def test_attachment_upload_transfer_config(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            rv = self.upload_image('test.png')
+            self.assertEqual(rv.status_code, 200)
+            config = mock.call_args[1]['Config']
+            self.assertEqual(config.multipart_chunksize, app.config['S3_TRANSFER_CHUNK_SIZE'])
+            self.assertEqual(config.max_concurrency, app.config['S3_TRANSFER_MAX_CONCURRENCY'])
+            self.assertEqual(config.use_threads, app.config['S3_TRANSFER_USE_THREADS'])
+
+    def test_attachment_upload_too_large(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            content = PNG_HEADER + b'\x00' * app.config['MAX_CONTENT_LENGTH']
+            rv = self.upload_image('large.png', content)
+            self.assertEqual(rv.status_code, 413)
+            mock.assert_not_called()
+
     def test_attachment_upload_aws_exception(self):
         with patch('deepscent.attachment.s3.upload_fileobj') as mock:
             mock.side_effect = Exception()
@@ -123,3 +193,221 @@ class AttachmentTest(BaseTest):
             self.assertEqual(200, rv.status_code)
 
 
+
+    def start_upload(self, filename='direct.png', content_type='image/png'):
+        with patch('deepscent.attachment.s3.generate_presigned_post') as mock:
+            mock.return_value = dict(url='https://bucket.s3.amazonaws.com/', fields={})
+            rv = self.client.post('/attachments/uploads', headers=self.headers,
+                                  data=dict(filename=filename, content_type=content_type))
+            if rv.status_code == 200:
+                conditions = mock.call_args[1]['Conditions']
+                self.assertIn({'Content-Type': content_type}, conditions)
+                self.assertEqual(conditions[-1][0], 'content-length-range')
+                self.assertTrue(mock.call_args[0][1].startswith('pending/'))
+        return rv
+
+    def test_direct_upload(self):
+        rv = self.start_upload()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['attachment']['status'], 'pending')
+        attachment_id = rv.json['attachment']['id']
+
+        rv = self.client.get('/attachments', headers=self.headers)
+        self.assertEqual(rv.json['total_size'], 0)
+
+        with patch('deepscent.attachment.s3.copy_object') as mock, \
+                patch('deepscent.attachment.s3.delete_object') as delete_mock:
+            rv = self.client.post('/attachments/{}/confirm'.format(attachment_id),
+                                  headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.json['status'], 'uploaded')
+            # published from the pending prefix, which is then cleared
+            pending_key = mock.call_args[1]['CopySource']['Key']
+            self.assertEqual(pending_key, 'pending/' + mock.call_args[1]['Key'])
+            self.assertEqual(mock.call_args[1]['ACL'], 'public-read')
+            self.assertEqual(delete_mock.call_args[1]['Key'], pending_key)
+
+        img = ImageAttachmentModel.objects.with_id(attachment_id)
+        self.assertIsNone(img.expire_at)
+        rv = self.client.get('/attachments', headers=self.headers)
+        self.assertEqual(rv.json['total_size'], 1)
+
+    def test_direct_upload_not_uploaded(self):
+        from botocore.exceptions import ClientError
+        attachment_id = self.start_upload().json['attachment']['id']
+
+        with patch('deepscent.attachment.s3.copy_object') as mock:
+            mock.side_effect = ClientError(
+                dict(Error=dict(Code='NoSuchKey', Message='Not Found')), 'CopyObject')
+            rv = self.client.post('/attachments/{}/confirm'.format(attachment_id),
+                                  headers=self.headers)
+            self.assertEqual(rv.status_code, 409)
+
+    def test_direct_upload_invalid_type(self):
+        rv = self.start_upload('test.txt', 'text/plain')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.start_upload('test.svg', 'image/svg+xml')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_direct_upload_extension_from_content_type(self):
+        rv = self.start_upload('photo.html', 'image/jpeg')
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.json['attachment']['url'].endswith('.jpg'))
+
+    def test_attachment_upload_dedup(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            rv1 = self.upload_image('first.png')
+            rv2 = self.upload_image('second.png')
+            self.assertEqual(rv1.status_code, 200)
+            self.assertEqual(rv2.status_code, 200)
+            self.assertEqual(mock.call_count, 1)
+
+            rv3 = self.upload_image('other.png', PNG_HEADER + b'other')
+            self.assertEqual(mock.call_count, 2)
+
+        self.assertNotEqual(rv1.json['id'], rv2.json['id'])
+        self.assertEqual(rv1.json['url'], rv2.json['url'])
+        self.assertNotEqual(rv1.json['url'], rv3.json['url'])
+        self.assertEqual(rv2.json['original_name'], 'second.png')
+        self.assertEqual(ImageBlobModel.objects.get(
+            digest=hashlib.sha256(PNG_HEADER).hexdigest()).ref_count, 2)
+
+    def test_attachment_delete_shared(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            first = self.upload_image('first.png').json
+            second = self.upload_image('second.png').json
+
+        with patch('deepscent.attachment.s3.delete_object') as mock:
+            rv = self.client.delete('/attachments/' + first['id'], headers=self.headers)
+            self.assertEqual(200, rv.status_code)
+            mock.assert_not_called()
+
+            # a retried delete does not release the content a second time
+            rv = self.client.delete('/attachments/' + first['id'], headers=self.headers)
+            self.assertEqual(404, rv.status_code)
+            self.assertEqual(ImageBlobModel.objects.get().ref_count, 1)
+
+            rv = self.client.delete('/attachments/' + second['id'], headers=self.headers)
+            self.assertEqual(200, rv.status_code)
+            mock.assert_called_once()
+            self.assertTrue(second['url'].endswith(mock.call_args[1]['Key']))
+        self.assertEqual(ImageBlobModel.objects.count(), 0)
+
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            self.upload_image('again.png')
+            mock.assert_called_once()
+
+    def test_attachment_upload_aws_exception_not_referenced(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            mock.side_effect = Exception()
+            rv = self.upload_image('test.png')
+            self.assertEqual(rv.status_code, 500)
+            self.assertEqual(ImageBlobModel.objects.count(), 0)
+
+            mock.side_effect = None
+            rv = self.upload_image('test.png')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(mock.call_count, 2)
+
+    def test_hashing_spooled_file(self):
+        from deepscent.upload import HashingSpooledFile, content_digest
+        content = PNG_HEADER * 1000
+        stream = HashingSpooledFile(max_size=1024)
+        for offset in range(0, len(content), 100):
+            stream.write(content[offset:offset + 100])
+        stream.seek(0)
+        self.assertEqual(content_digest(stream), hashlib.sha256(content).hexdigest())
+        self.assertEqual(content_digest(BytesIO(content)), hashlib.sha256(content).hexdigest())
+
+    def bulk_delete(self, ids, headers=None):
+        return self.client.post('/attachments/delete',
+                                headers=headers or self.headers,
+                                json=dict(ids=ids))
+
+    def test_attachment_bulk_delete(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            ids = [self.upload_image('test%i.png' % i, PNG_HEADER + bytes([i])).json['id']
+                   for i in range(3)]
+            shared = self.upload_image('shared.png', PNG_HEADER + bytes([0])).json['id']
+
+        token2 = self.signup_login("abc2@abcmart.com")
+        headers2 = {'Authorization': '{}'.format(token2['auth_token'])}
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            other = self.upload_image('other.png', headers=headers2).json['id']
+
+        with patch('deepscent.attachment.s3.delete_objects') as mock:
+            mock.return_value = {}
+            rv = self.bulk_delete(ids + [other, 'missing', '5a4dbd3d1d41c8a3c4b0c5d1'])
+            self.assertEqual(rv.status_code, 200)
+            mock.assert_called_once()
+            # the content of ids[0] is still referenced by shared
+            deleted_keys = [o['Key'] for o in mock.call_args[1]['Delete']['Objects']]
+            self.assertEqual(len(deleted_keys), 2)
+
+        self.assertEqual(rv.json['results'], [
+            dict(id=ids[0], result='deleted'),
+            dict(id=ids[1], result='deleted'),
+            dict(id=ids[2], result='deleted'),
+            dict(id=other, result='forbidden'),
+            dict(id='missing', result='invalid'),
+            dict(id='5a4dbd3d1d41c8a3c4b0c5d1', result='not_found')])
+        self.assertEqual(ImageAttachmentModel.objects(id__in=ids).count(), 0)
+        self.assertIsNotNone(ImageAttachmentModel.objects.with_id(shared))
+        self.assertIsNotNone(ImageAttachmentModel.objects.with_id(other))
+
+    def test_attachment_bulk_delete_s3_error(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            ids = [self.upload_image('test%i.png' % i, PNG_HEADER + bytes([i])).json['id']
+                   for i in range(2)]
+
+        with patch('deepscent.attachment.s3.delete_objects') as mock:
+            first = ImageAttachmentModel.objects.with_id(ids[0])
+            mock.return_value = dict(Errors=[dict(Key=first.s3filename, Code='InternalError')])
+            rv = self.bulk_delete(ids)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual([r['result'] for r in rv.json['results']], ['error', 'deleted'])
+            self.assertIsNotNone(ImageAttachmentModel.objects.with_id(ids[0]))
+            # the failed key is retried on its own
+            self.assertEqual(mock.call_args[1]['Delete']['Objects'], [dict(Key=first.s3filename)])
+            blob = ImageBlobModel.objects.get(digest=first.blob)
+            self.assertEqual((blob.status, blob.ref_count), ('broken', 1))
+
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            # the next upload of the content puts it again
+            self.upload_image('again.png', PNG_HEADER + bytes([0]))
+            mock.assert_called_once()
+        self.assertEqual(ImageBlobModel.objects.get(digest=first.blob).status, 'stored')
+
+        with patch('deepscent.attachment.s3.delete_objects') as mock:
+            mock.return_value = {}
+            rv = self.bulk_delete(ids)
+            self.assertEqual([r['result'] for r in rv.json['results']], ['deleted', 'not_found'])
+        # the content stays referenced by again.png
+        self.assertEqual(ImageBlobModel.objects.get().ref_count, 1)
+
+    def test_attachment_bulk_delete_leased(self):
+        with patch('deepscent.attachment.s3.upload_fileobj') as mock:
+            attachment_id = self.upload_image('test.png').json['id']
+        # held by another bulk delete in progress
+        ImageAttachmentModel.objects(id=attachment_id).update(
+            set__delete_lease='other',
+            set__lease_until=datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+
+        with patch('deepscent.attachment.s3.delete_objects') as mock:
+            rv = self.bulk_delete([attachment_id])
+            self.assertEqual(rv.json['results'], [dict(id=attachment_id, result='busy')])
+            mock.assert_not_called()
+        self.assertEqual(ImageBlobModel.objects.get().ref_count, 1)
+
+    def test_attachment_bulk_delete_invalid_ids(self):
+        for ids in [[['5a4dbd3d1d41c8a3c4b0c5d1']], [{'id': 1}], [12]]:
+            rv = self.bulk_delete(ids)
+            self.assertEqual(rv.status_code, 400)
+
+    def test_attachment_bulk_delete_batches(self):
+        with patch('deepscent.attachment.s3.delete_objects') as mock:
+            mock.return_value = {}
+            keys = ['key%i' % i for i in range(2500)]
+            self.assertEqual(attachment.delete_keys(keys), set())
+            self.assertEqual([len(c[1]['Delete']['Objects']) for c in mock.call_args_list],
+                             [1000, 1000, 500])
@@ -1,5 +1,6 @@
 from tests.common import BaseTest
-from deepscent.db import HelpDataModel, drop_all_collection
+from deepscent.db import HelpDataModel, OutboxModel, drop_all_collection
+from deepscent.outbox import outbox
 from unittest.mock import patch
 
 class HelpTest(BaseTest):
@@ -55,6 +56,8 @@ class HelpTest(BaseTest):
                         details='카트리지 교체는 어떻게 하나요?')
             rv = self.app.post('/help/contact', data=data)
             self.assertEqual(rv.status_code, 200)
+            self.assertEqual(outbox.dispatch(), 1)
+            self.assertEqual(mock.call_args[1]['Destination']['CcAddresses'], ['abc1@abcmart.com'])
 
     def test_contact_email_error(self):
         data = dict(email='abc1@abcmart.com',
@@ -65,5 +68,7 @@ class HelpTest(BaseTest):
                 patch('deepscent.help.render_template') as template_mock:
             mock.side_effect = Exception()
             rv = self.app.post('/help/contact', data=data)
-            self.assertEqual(rv.status_code, 500)
+            self.assertEqual(rv.status_code, 200)
+            outbox.dispatch()
+            self.assertEqual(OutboxModel.objects.get(cc='abc1@abcmart.com').status, 'pending')
 
@@ -1,7 +1,8 @@
-from tests.common import BaseTest
+from tests.common import BaseTest, StubServer
 from unittest.mock import Mock, patch
 from flask import json
 from deepscent.db import UserModel
+from deepscent.app import app
 
 class FacebookTest(BaseTest):
     def tearDown(self):
@@ -36,6 +37,22 @@ class FacebookTest(BaseTest):
             self.assertEqual(rv.status_code, 200)
             self.assertTrue(rv.json['result'])
 
+    def test_facebook_login_mongo_commands(self):
+        with patch('deepscent.facebook.FacebookApi.debug_token') as mock:
+            mock.return_value = dict(data=dict(
+                user_id='12345678', is_valid=True, app_id='187908931794227'))
+            UserModel(
+                user_id='qwer1234-poiu0987',
+                facebook_id='12345678',
+                email='abcfacebook@abcmart.com',
+                password='abc123!@#'
+            ).save()
+            token = '1idlfawfi'
+            with self.count_commands() as commands:
+                rv = self.app.post('/facebook/login', data=dict(facebook_auth_token=token))
+                self.assertEqual(rv.status_code, 200)
+            self.assertEqual(commands, ['find', 'insert'])
+
     def test_facebook_signup(self):
         facebook_id = '12345678'
         with patch('deepscent.facebook.FacebookApi.debug_token') as mock:
@@ -79,3 +96,26 @@ class FacebookTest(BaseTest):
                 facebook_auth_token=token,
                 email=email))
             self.assertEqual(rv.status_code, 403)
+
+    def test_facebook_login_single_outbound_call(self):
+        UserModel(
+            user_id='qwer1234-poiu0987',
+            facebook_id='12345678',
+            email='abcfacebook@abcmart.com',
+            password='abc123!@#'
+        ).save()
+        server = StubServer({'/debug_token/': [(200, dict(data=dict(
+            user_id='12345678', is_valid=True, app_id=app.config['FACEBOOK_APP_ID'])))]})
+        try:
+            with patch.dict(app.config, FACEBOOK_API_SERVER=server.url):
+                rv = self.app.post('/facebook/login', data=dict(facebook_auth_token='1idlfawfi'))
+        finally:
+            server.stop()
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(server.requests), 1)
+        path, query = server.requests[0]
+        self.assertEqual(path, '/debug_token/')
+        self.assertEqual(query['input_token'], ['1idlfawfi'])
+        self.assertEqual(query['access_token'], ['{}|{}'.format(
+            app.config['FACEBOOK_APP_ID'], app.config['FACEBOOK_APP_SECRET'])])
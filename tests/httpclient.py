@@ -0,0 +1,55 @@
+from unittest.mock import patch
+from tests.common import BaseTest, StubServer
+from deepscent.app import app
+from deepscent.error import InvalidUsage
+from deepscent.httpclient import HttpClient
+
+
+class HttpClientTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.server = StubServer({
+            '/user/me': [(200, dict(id=1234))],
+            '/flaky': [(503, {}), (503, {}), (200, dict(ok=True))],
+            '/down': [(503, {})],
+        })
+        self.http = HttpClient(retries=2, backoff=0.001)
+
+    def tearDown(self):
+        self.http.close()
+        self.server.stop()
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            resp = self.http.get('kakao', self.server.url + '/user/me')
+            self.assertEqual(resp.json(), dict(id=1234))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.ports), 1)
+        self.assertEqual(self.http.stats()['kakao']['requests'], 5)
+
+    def test_retry_idempotent(self):
+        resp = self.http.get('kakao', self.server.url + '/flaky')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.http.stats()['kakao']['retries'], 2)
+
+    def test_post_not_retried(self):
+        resp = self.http.request('kakao', 'POST', self.server.url + '/down')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual([path for path, _ in self.server.requests], ['/down'])
+        self.assertEqual(self.http.stats()['kakao']['retries'], 0)
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        self.http.configure(read_timeout=0.1, retries=1)
+        with self.assertRaises(InvalidUsage) as ctx:
+            self.http.get('facebook', self.server.url + '/user/me')
+        self.assertEqual(ctx.exception.status_code, 502)
+        self.assertEqual(self.http.stats()['facebook']['errors'], 2)
+
+    def test_kakao_login_through_stub(self):
+        self.server.routes['/user/access_token_info'] = [(200, dict(code=-401))]
+        with patch.dict(app.config, KAKAO_API_SERVER=self.server.url):
+            rv = self.client.post('/kakao/login', data=dict(kakao_auth_token='abc'))
+        self.assertEqual(rv.status_code, 403)
+        path, _ = self.server.requests[-1]
+        self.assertEqual(path, '/user/access_token_info')
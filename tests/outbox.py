@@ -0,0 +1,111 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+from tests.common import BaseTest
+from deepscent.db import OutboxModel
+from deepscent.outbox import Outbox, FileTransport
+
+
+class FailingTransport(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    def send(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise Exception('transport down')
+        self.sent.append(message.message_id)
+
+
+class OutboxTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        OutboxModel.objects.delete()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        OutboxModel.objects.delete()
+
+    def enqueue(self, outbox, **kwargs):
+        return outbox.enqueue(
+            to=['abc1@abcmart.com'], subject='title', html='<p>body</p>',
+            source='example@example.com', **kwargs)
+
+    def test_file_transport(self):
+        outbox = Outbox(FileTransport(self.directory))
+        message_id = self.enqueue(outbox)
+        self.assertEqual(outbox.dispatch(), 1)
+        self.assertEqual(outbox.dispatch(), 0)
+
+        with open(os.path.join(self.directory, message_id + '.eml')) as f:
+            self.assertIn('To: abc1@abcmart.com', f.read())
+        message = OutboxModel.objects.get(message_id=message_id)
+        self.assertEqual(message.status, 'sent')
+        self.assertIsNotNone(message.expire_at)
+
+    def test_enqueue_idempotent(self):
+        outbox = Outbox(FileTransport(self.directory))
+        self.enqueue(outbox, key='welcome:abc1')
+        self.enqueue(outbox, key='welcome:abc1')
+        self.assertEqual(OutboxModel.objects.count(), 1)
+
+    def test_backoff_and_give_up(self):
+        transport = FailingTransport(failures=2)
+        outbox = Outbox(transport, max_attempts=2, backoff_base=60)
+        message_id = self.enqueue(outbox)
+
+        self.assertEqual(outbox.dispatch(), 1)
+        message = OutboxModel.objects.get(message_id=message_id)
+        self.assertEqual((message.status, message.attempts), ('pending', 1))
+        self.assertGreater(message.next_attempt_at, datetime.utcnow() + timedelta(seconds=20))
+        # not due yet
+        self.assertEqual(outbox.dispatch(), 0)
+
+        message.update(set__next_attempt_at=datetime.utcnow())
+        self.assertEqual(outbox.dispatch(), 1)
+        message.reload()
+        self.assertEqual((message.status, message.attempts), ('failed', 2))
+        self.assertEqual(transport.sent, [])
+
+    def test_expired_lease_is_reclaimed(self):
+        transport = FailingTransport(failures=0)
+        outbox = Outbox(transport, batch_size=10)
+        message_id = self.enqueue(outbox)
+
+        claimed = outbox.claim(datetime.utcnow())
+        self.assertEqual(claimed.message_id, message_id)
+        # leased by a worker that is still sending
+        self.assertEqual(outbox.dispatch(), 0)
+
+        claimed.update(set__lease_until=datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual(outbox.dispatch(), 1)
+        self.assertEqual(transport.sent, [message_id])
+        # the late worker no longer owns the lease
+        outbox.deliver(claimed)
+        self.assertEqual(OutboxModel.objects.get(message_id=message_id).attempts, 1)
+
+    def test_body_dropped_once_sent(self):
+        outbox = Outbox(FileTransport(self.directory))
+        message_id = self.enqueue(outbox)
+        outbox.dispatch()
+        message = OutboxModel.objects.get(message_id=message_id)
+        self.assertEqual(message.status, 'sent')
+        self.assertIsNone(message.html)
+
+    def test_deadline(self):
+        transport = FailingTransport(failures=1)
+        outbox = Outbox(transport, backoff_base=60)
+        # not retried past the deadline
+        message_id = self.enqueue(outbox, deadline=datetime.utcnow() + timedelta(seconds=20))
+        self.assertIsNotNone(OutboxModel.objects.get(message_id=message_id).expire_at)
+        self.assertEqual(outbox.dispatch(), 1)
+        message = OutboxModel.objects.get(message_id=message_id)
+        self.assertEqual((message.status, message.attempts), ('failed', 1))
+        self.assertIsNone(message.html)
+        self.assertIsNotNone(message.expire_at)
+
+        # never claimed once passed
+        self.enqueue(outbox, deadline=datetime.utcnow() - timedelta(seconds=1))
+        self.assertEqual(outbox.dispatch(), 0)
+        self.assertEqual(transport.sent, [])
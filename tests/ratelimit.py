@@ -0,0 +1,63 @@
+from tests.common import BaseTest
+from deepscent.app import app
+from deepscent.db import UserModel, RateLimitModel
+from deepscent.ratelimit import MemoryBackend, MongoBackend
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class RateLimitTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        RateLimitModel.drop_collection()
+
+    def tearDown(self):
+        app.config['RATE_LIMITS'] = {}
+        app.config['RATE_LIMIT_BACKEND'] = 'memory'
+        try:
+            UserModel.objects.get(email='abc1@abcmart.com').delete()
+        except UserModel.DoesNotExist:
+            pass
+
+    def check_bucket(self, backend, timer):
+        for i in range(3):
+            self.assertEqual(backend.take('key', 1.0, 3), 0)
+        self.assertAlmostEqual(backend.take('key', 1.0, 3), 1.0)
+
+        timer.now += 1
+        self.assertEqual(backend.take('key', 1.0, 3), 0)
+        self.assertGreater(backend.take('key', 1.0, 3), 0)
+        self.assertEqual(backend.take('other', 1.0, 3), 0)
+
+    def test_memory_backend(self):
+        timer = FakeTimer()
+        self.check_bucket(MemoryBackend(timer=timer), timer)
+
+    def test_memory_backend_bounded(self):
+        backend = MemoryBackend(max_keys=2)
+        for key in ('a', 'b', 'c'):
+            backend.take(key, 1.0, 3)
+        self.assertEqual(list(backend._buckets), ['b', 'c'])
+
+    def test_mongo_backend(self):
+        timer = FakeTimer()
+        self.check_bucket(MongoBackend(timer=timer), timer)
+
+    def test_login_throttled(self):
+        rv = self.client.post('/auth/signup', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 200)
+
+        app.config['RATE_LIMIT_ENABLED'] = True
+        app.config['RATE_LIMITS'] = {'login': (2, 60)}
+        app.config['RATE_LIMIT_BACKEND'] = 'mongo'
+        for i in range(2):
+            rv = self.client.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefh'))
+            self.assertEqual(rv.status_code, 400)
+
+        rv = self.client.post('/auth/login', data=dict(email='abc1@abcmart.com', pwd='abcdefg'))
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(rv.headers['Retry-After'], '30')
@@ -0,0 +1,73 @@
+from tests.common import BaseTest
+from deepscent.app import app
+from deepscent.db import ExceptionCountModel, OutboxModel
+from deepscent.report import ExceptionReporter
+
+
+class ExceptionReportTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        OutboxModel.objects.delete()
+        self.reporter = ExceptionReporter(max_fingerprints=2)
+        self.reporter.configure(app=app, to='admin@example.com', source='server@example.com')
+
+    def tearDown(self):
+        OutboxModel.objects.delete()
+        ExceptionCountModel.objects.delete()
+
+    def test_dedup_by_fingerprint(self):
+        for _ in range(100):
+            self.reporter.report('/attachments', 'Image Not Found', user_id='u1')
+        self.reporter.report('/attachments', 'Invalid Image Type', user_id='u2')
+        self.reporter.report('/devices', 'Already Registered Device')
+
+        [(_, errors, dropped)] = self.reporter.take()
+        self.assertEqual([(e['message'], e['count']) for e in errors],
+                         [('Image Not Found', 100), ('Invalid Image Type', 1)])
+        self.assertEqual(errors[0]['user_id'], 'u1')
+        self.assertEqual(dropped, 1)
+        self.assertEqual(self.reporter.take()[0][1], [])
+
+    def test_one_digest_per_window(self):
+        self.assertFalse(self.reporter.flush())
+        for _ in range(50):
+            self.reporter.report('/attachments', 'Image Not Found')
+
+        self.assertTrue(self.reporter.flush())
+        message = OutboxModel.objects.get()
+        self.assertEqual(message.to, ['admin@example.com'])
+        self.assertIn('50', message.subject)
+        self.assertIn('Image Not Found', message.html)
+        self.assertFalse(self.reporter.flush())
+
+    def test_due_only_after_the_window(self):
+        now = [1000.0]
+        reporter = ExceptionReporter(window=300, timer=lambda: now[0])
+        reporter.configure(app=app, to='admin@example.com', source='server@example.com')
+        reporter.report('/attachments', 'Image Not Found')
+
+        self.assertFalse(reporter.flush(due=True))
+        now[0] += 300
+        self.assertTrue(reporter.flush(due=True))
+        self.assertEqual(OutboxModel.objects.count(), 1)
+
+    def test_mongo_digest_shared_by_workers(self):
+        now = [1200.0]
+        workers = [ExceptionReporter(window=300, timer=lambda: now[0], backend='mongo')
+                   for _ in range(2)]
+        for worker in workers:
+            worker.configure(app=app, to='admin@example.com', source='server@example.com')
+            for _ in range(3):
+                worker.report('/attachments', 'Image Not Found', user_id='u1')
+        workers[1].report('/devices', 'Already Registered Device')
+
+        # the window is still open
+        self.assertFalse(workers[0].flush(due=True))
+        now[0] += 300
+        self.assertTrue(workers[0].flush(due=True))
+        self.assertFalse(workers[1].flush(due=True))
+
+        message = OutboxModel.objects.get()
+        self.assertIn('7', message.subject)
+        self.assertIn('Already Registered Device', message.html)
+        self.assertEqual(ExceptionCountModel.objects.count(), 0)
@@ -0,0 +1,76 @@
+from unittest.mock import patch
+from tests.common import BaseTest
+from deepscent.cache import TTLCache
+from deepscent.error import InvalidUsage
+from deepscent.social import VerifiedTokens, verified_tokens
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class VerifiedTokensTest(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.clock = Clock()
+        self.tokens = VerifiedTokens(negative_ttl=10)
+        self.tokens.cache = TTLCache(16, 300, timer=self.clock)
+        self.calls = []
+
+    def verify(self, answer):
+        def func(token):
+            self.calls.append(token)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        return func
+
+    def test_valid_token_until_provider_expiry(self):
+        verify = self.verify(('1234', 60))
+        self.assertEqual(self.tokens.user_id('kakao', 'tok', verify), '1234')
+        self.assertEqual(self.tokens.user_id('kakao', 'tok', verify), '1234')
+        self.assertEqual(len(self.calls), 1)
+        # another provider never shares an entry
+        self.tokens.user_id('facebook', 'tok', verify)
+        self.assertEqual(len(self.calls), 2)
+
+        self.clock.now = 61
+        self.tokens.user_id('kakao', 'tok', verify)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_negative_cache(self):
+        verify = self.verify((None, None))
+        for _ in range(5):
+            with self.assertRaises(InvalidUsage) as ctx:
+                self.tokens.user_id('kakao', 'revoked', verify)
+            self.assertEqual(ctx.exception.status_code, 403)
+        self.assertEqual(len(self.calls), 1)
+
+        self.clock.now = 11
+        with self.assertRaises(InvalidUsage):
+            self.tokens.user_id('kakao', 'revoked', verify)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_transient_failure_not_cached(self):
+        verify = self.verify(InvalidUsage('kakao server is not responding. Try again.', 502))
+        for _ in range(2):
+            with self.assertRaises(InvalidUsage):
+                self.tokens.user_id('kakao', 'tok', verify)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_kakao_login_retry(self):
+        verified_tokens.configure(ttl=300)
+        try:
+            with patch('deepscent.kakao.KakaoApi.access_token_info') as mock:
+                mock.return_value = dict(code=-401)
+                for _ in range(3):
+                    rv = self.app.post('/kakao/login', data=dict(kakao_auth_token='replayed'))
+                    self.assertEqual(rv.status_code, 403)
+                self.assertEqual(mock.call_count, 1)
+        finally:
+            verified_tokens.configure(ttl=0)
+            verified_tokens.cache.clear()
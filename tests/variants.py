@@ -0,0 +1,138 @@
+import io
+from concurrent.futures import Future
+from PIL import Image
+from tests.common import BaseTest
+from deepscent.db import ImageAttachmentModel
+from deepscent.variants import VariantPipeline, render_variants
+
+SPECS = dict(
+    thumbnail=dict(size=(100, 100), format='JPEG'),
+    webp=dict(size=(400, 400), format='WEBP'))
+
+
+def encoded_image(size=(1200, 600), fmt='PNG', mode='RGBA'):
+    out = io.BytesIO()
+    Image.new(mode, size, (200, 10, 10, 255)[:len(mode)]).save(out, fmt)
+    return out.getvalue()
+
+
+class StandInStorage(object):
+    """s3 client stand-in keeping objects in a dict"""
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return dict(Body=io.BytesIO(self.objects[(Bucket, Key)]))
+
+    def put_object(self, Bucket, Key, Body, ACL, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class VariantTest(BaseTest):
+    def tearDown(self):
+        ImageAttachmentModel.objects(user_id='variant-user').delete()
+
+    def test_render_variants(self):
+        rendered = render_variants(encoded_image(), SPECS)
+
+        data, content_type, extension = rendered['thumbnail']
+        self.assertEqual((content_type, extension), ('image/jpeg', 'jpg'))
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (100, 50))
+
+        data, content_type, extension = rendered['webp']
+        self.assertEqual(extension, 'webp')
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (400, 200))
+
+    def test_small_images_are_not_enlarged(self):
+        rendered = render_variants(encoded_image((60, 30), 'JPEG', 'RGB'), SPECS)
+        self.assertEqual(Image.open(io.BytesIO(rendered['webp'][0])).size, (60, 30))
+
+    def test_pipeline(self):
+        storage = StandInStorage()
+        pipeline = VariantPipeline(SPECS, workers=0, client=storage, bucket='bucket')
+        img = ImageAttachmentModel(user_id='variant-user', extension='png',
+                                   orignal_name='a.png')
+        img.save()
+        storage.objects[('bucket', img.s3filename)] = encoded_image()
+
+        pipeline.submit(img.id).result()
+        self.assertEqual(pipeline.stats()['generated'], 1)
+        self.assertIn(('bucket', '{}_thumbnail.jpg'.format(img.id)), storage.objects)
+
+        img.reload()
+        self.assertEqual(img.variants, dict(thumbnail='jpg', webp='webp'))
+        urls = img.marshall()['variants']
+        self.assertTrue(urls['webp'].endswith('{}_webp.webp'.format(img.id)))
+
+    def test_pipeline_failure_keeps_original(self):
+        pipeline = VariantPipeline(SPECS, workers=0, client=StandInStorage(), bucket='bucket')
+        img = ImageAttachmentModel(user_id='variant-user', extension='png',
+                                   orignal_name='a.png')
+        img.save()
+
+        pipeline.submit(img.id).result()
+        self.assertEqual(pipeline.stats()['failed'], 1)
+        self.assertEqual(img.marshall()['variants'], {})
+
+    def test_pipeline_deferred(self):
+        storage = StandInStorage()
+        pipeline = VariantPipeline(SPECS, workers=0, client=storage, bucket='bucket',
+                                   background=False)
+        img = ImageAttachmentModel(user_id='variant-user', extension='png',
+                                   orignal_name='a.png')
+        img.save()
+        storage.objects[('bucket', img.s3filename)] = encoded_image()
+
+        # nothing is rendered on the request, nor left for a frozen thread
+        self.assertIsNone(pipeline.submit(img.id))
+        img.reload()
+        self.assertEqual(img.variants, {})
+        self.assertIsNotNone(img.variants_pending)
+
+        self.assertEqual(pipeline.drain(), 1)
+        img.reload()
+        self.assertEqual(img.variants, dict(thumbnail='jpg', webp='webp'))
+        self.assertIsNone(img.variants_pending)
+        self.assertEqual(pipeline.drain(), 0)
+
+    def test_render_timeout(self):
+        class StuckExecutor(object):
+            def submit(self, *args):
+                return Future()
+
+        storage = StandInStorage()
+        pipeline = VariantPipeline(SPECS, workers=1, client=storage, bucket='bucket',
+                                   timeout=0.01)
+        pipeline._executor = StuckExecutor()
+        img = ImageAttachmentModel(user_id='variant-user', extension='png',
+                                   orignal_name='a.png')
+        img.save()
+        storage.objects[('bucket', img.s3filename)] = encoded_image()
+
+        pipeline.submit(img.id).result(timeout=5)
+        self.assertEqual(pipeline.stats()['timed_out'], 1)
+        self.assertEqual(pipeline.stats()['failed'], 1)
+        img.reload()
+        self.assertEqual(img.variants, {})
+
+    def test_deleted_while_rendering(self):
+        storage = StandInStorage()
+        pipeline = VariantPipeline(SPECS, workers=0, client=storage, bucket='bucket')
+        img = ImageAttachmentModel(user_id='variant-user', extension='png',
+                                   orignal_name='a.png')
+        img.save()
+        storage.objects[('bucket', img.s3filename)] = encoded_image()
+
+        render = pipeline._render
+        def render_then_delete(data):
+            rendered = render(data)
+            ImageAttachmentModel.objects(id=img.id).delete()
+            return rendered
+        pipeline._render = render_then_delete
+
+        self.assertIsNone(pipeline.generate(img.id))
+        self.assertEqual(pipeline.stats()['orphaned'], 1)
+        self.assertEqual(list(storage.objects), [('bucket', img.s3filename)])